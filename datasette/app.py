@@ -1,5 +1,6 @@
 import asyncio
 import collections
+import functools
 import hashlib
 import itertools
 import json
@@ -29,6 +30,15 @@ from .views.special import JsonDataView
 from .views.table import RowView, TableView
 
 from . import hookspecs
+from .cache import CountCache, QueryCache, params_key
+from .executor import (
+    STREAM_BATCH_SIZE,
+    ExecutorLanes,
+    QueryCancellation,
+    QueueFullError,
+    RowStream,
+)
+from .pool import ConnectionPool
 from .utils import (
     InterruptedError,
     Results,
@@ -39,13 +49,22 @@ from .utils import (
     sqlite_timelimit,
     to_css_class
 )
-from .inspect import inspect_hash, inspect_views, inspect_tables
+from .inspect import (
+    inspect_cache_key,
+    inspect_count,
+    inspect_count_in_process,
+    inspect_hash,
+    inspect_table_names,
+    inspect_tables,
+    inspect_views,
+    LazyTables,
+    read_inspect_cache,
+    write_inspect_cache,
+)
 from .version import __version__
 
 app_root = Path(__file__).parent.parent
 
-connections = threading.local()
-
 pm = pluggy.PluginManager("datasette")
 pm.add_hookspecs(hookspecs)
 pm.load_setuptools_entrypoints("datasette")
@@ -64,6 +83,30 @@ CONFIG_OPTIONS = (
     ConfigOption("num_sql_threads", 3, """
         Number of threads in the thread pool for executing SQLite queries
     """.strip()),
+    ConfigOption("facet_sql_threads", 0, """
+        Threads reserved for facet queries (0 == share the num_sql_threads pool)
+    """.strip()),
+    ConfigOption("suggest_sql_threads", 0, """
+        Threads reserved for suggested facet queries (0 == share the num_sql_threads pool)
+    """.strip()),
+    ConfigOption("count_sql_threads", 0, """
+        Threads reserved for row count queries (0 == share the num_sql_threads pool)
+    """.strip()),
+    ConfigOption("export_sql_threads", 2, """
+        Threads reserved for streaming exports (0 == share the num_sql_threads pool)
+    """.strip()),
+    ConfigOption("sql_threads_per_database", False, """
+        Give every database its own set of SQL thread pools
+    """.strip()),
+    ConfigOption("sql_queue_limit", 0, """
+        Maximum queries waiting for each SQL thread pool, beyond that return 503 (0 == no limit)
+    """.strip()),
+    ConfigOption("sql_queue_time_limit_ms", 0, """
+        Maximum time a query can wait for a SQL thread before returning 503 (0 == no limit)
+    """.strip()),
+    ConfigOption("connections_per_database", 0, """
+        Size of the SQLite connection pool for each database (0 == one per SQL thread)
+    """.strip()),
     ConfigOption("sql_time_limit_ms", 1000, """
         Time limit for a SQL query in milliseconds
     """.strip()),
@@ -76,6 +119,9 @@ CONFIG_OPTIONS = (
     ConfigOption("facet_suggest_time_limit_ms", 50, """
         Time limit for calculating a suggested facet
     """.strip()),
+    ConfigOption("facet_suggest_sample_size", 10000, """
+        Number of matching rows checked when suggesting facets, 0 for all
+    """.strip()),
     ConfigOption("allow_facet", True, """
         Allow users to specify columns to facet using ?_facet= parameter
     """.strip()),
@@ -94,12 +140,45 @@ CONFIG_OPTIONS = (
     ConfigOption("cache_size_kb", 0, """
         SQLite cache size in KB (0 == use SQLite default)
     """.strip()),
+    ConfigOption("mmap_size_mb", 0, """
+        Memory-map up to this many MB of each database file (0 == disable)
+    """.strip()),
+    ConfigOption("hash_strategy", "sha256", """
+        How to hash database files: sha256, blake2b, tree or header
+    """.strip()),
+    ConfigOption("inspect_counts", "exact", """
+        How to count table rows on startup: exact, approximate or deferred
+    """.strip()),
+    ConfigOption("lazy_inspect", False, """
+        Inspect each table the first time it is used, rather than on startup
+    """.strip()),
+    ConfigOption("inspect_column_stats", False, """
+        Calculate statistics for every column when inspecting databases
+    """.strip()),
+    ConfigOption("inspect_facets", False, """
+        Precompute the facets configured in metadata when inspecting databases
+    """.strip()),
+    ConfigOption("inspect_processes", 0, """
+        Number of processes to use when inspecting databases (0 == inspect in this process)
+    """.strip()),
+    ConfigOption("inspect_cache", True, """
+        Reuse the inspection of unchanged database files between restarts
+    """.strip()),
+    ConfigOption("memory_db_max_mb", 0, """
+        Copy databases up to this size in MB into memory at startup (0 == disable)
+    """.strip()),
     ConfigOption("allow_csv_stream", True, """
         Allow .csv?_stream=1 to download all rows (ignoring max_returned_rows)
     """.strip()),
     ConfigOption("max_csv_mb", 100, """
         Maximum size allowed for CSV export in MB. Set 0 to disable this limit.
     """.strip()),
+    ConfigOption("query_cache_mb", 0, """
+        Memory to use for caching query results in MB (0 == disable the cache)
+    """.strip()),
+    ConfigOption("count_cache_size", 1000, """
+        Number of filtered table row counts to remember (0 == disable)
+    """.strip()),
 )
 DEFAULT_CONFIG = {
     option.name: option.default
@@ -139,12 +218,33 @@ class Datasette:
         self.static_mounts = static_mounts or []
         self.config = dict(DEFAULT_CONFIG, **(config or {}))
         self.version_note = version_note
-        self.executor = futures.ThreadPoolExecutor(
-            max_workers=self.config["num_sql_threads"]
+        self.executor_lanes = ExecutorLanes({
+            "primary": self.config["num_sql_threads"],
+            "facet": self.config["facet_sql_threads"],
+            "suggest": self.config["suggest_sql_threads"],
+            "count": self.config["count_sql_threads"],
+            "export": self.config["export_sql_threads"],
+        },
+            per_database=self.config["sql_threads_per_database"],
+            max_queued=self.config["sql_queue_limit"],
+            max_queue_wait_ms=self.config["sql_queue_time_limit_ms"],
         )
         self.max_returned_rows = self.config["max_returned_rows"]
         self.sql_time_limit_ms = self.config["sql_time_limit_ms"]
         self.page_size = self.config["default_page_size"]
+        self.query_cache = QueryCache(self.config["query_cache_mb"] * 1024 * 1024)
+        self.count_cache = CountCache(self.config["count_cache_size"])
+        self._in_flight_queries = {}
+        self._connection_pools = {}
+        # Database name => True for databases served from in-memory copies,
+        # False for those served from disk. Filled in when each database is
+        # first connected to.
+        self._memory_databases = {}
+        # Database name => connection that keeps its in-memory copy alive
+        self._memory_copies = {}
+        self._memory_lock = threading.Lock()
+        self._refining_counts = False
+        self.in_flight_shared = 0
         # Execute plugins in constructor, to ensure they are available
         # when the rest of `datasette inspect` executes
         if self.plugins_dir:
@@ -234,7 +334,16 @@ class Datasette:
             }
         )
 
-    def prepare_connection(self, conn):
+    def mmap_size_mb(self, database):
+        "Memory-mapped I/O limit for database, allowing a metadata override"
+        mmap_size_mb = self.metadata.get("databases", {}).get(
+            database, {}
+        ).get("mmap_size_mb")
+        if mmap_size_mb is None:
+            mmap_size_mb = self.config["mmap_size_mb"]
+        return mmap_size_mb
+
+    def prepare_connection(self, conn, database=None):
         conn.row_factory = sqlite3.Row
         conn.text_factory = lambda x: str(x, "utf-8", "replace")
         for name, num_args, func in self.sqlite_functions:
@@ -245,35 +354,317 @@ class Datasette:
                 conn.execute("SELECT load_extension('{}')".format(extension))
         if self.config["cache_size_kb"]:
             conn.execute('PRAGMA cache_size=-{}'.format(self.config["cache_size_kb"]))
+        if database is not None and self.mmap_size_mb(database):
+            conn.execute('PRAGMA mmap_size={}'.format(
+                int(self.mmap_size_mb(database) * 1024 * 1024)
+            ))
         pm.hook.prepare_connection(conn=conn)
 
+    def database_file(self, db_name):
+        "Path to the file for db_name, without loading its inspect data"
+        for filename in self.files:
+            if Path(filename).stem == db_name:
+                return str(filename)
+        return self.inspect()[db_name]["file"]
+
+    def serves_from_memory(self, db_name):
+        """
+        True if db_name is served from an in-memory copy: if it is no larger
+        than memory_db_max_mb, and this version of Python and SQLite can
+        make a copy that every pooled connection shares.
+        """
+        with self._memory_lock:
+            if db_name not in self._memory_databases:
+                max_mb = self.config["memory_db_max_mb"]
+                self._memory_databases[db_name] = bool(
+                    max_mb and
+                    # Connection.backup() needs Python 3.7
+                    hasattr(sqlite3.Connection, "backup") and
+                    # The memdb VFS needs SQLite 3.36
+                    sqlite3.sqlite_version_info >= (3, 36, 0) and
+                    os.path.getsize(self.database_file(db_name)) <=
+                    max_mb * 1024 * 1024
+                )
+            return self._memory_databases[db_name]
+
+    def memory_database_names(self):
+        "Names of the databases that are being served from memory"
+        with self._memory_lock:
+            return sorted(
+                db_name for db_name, in_memory
+                in self._memory_databases.items()
+                if in_memory
+            )
+
+    def connect(self, db_name):
+        "Open and prepare a new read-only connection to db_name"
+        path = self.database_file(db_name)
+        if self.serves_from_memory(db_name):
+            conn = sqlite3.connect(
+                self.load_into_memory(db_name, path) + "&mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            conn = sqlite3.connect(
+                "file:{}?immutable=1".format(path),
+                uri=True,
+                check_same_thread=False,
+            )
+        self.prepare_connection(conn, db_name)
+        return conn
+
+    def load_into_memory(self, db_name, path):
+        """
+        Copy the database file at path into memory the first time it is
+        called for db_name, returning the URI of the copy.
+
+        The copy lives in SQLite's memdb VFS, so every pooled connection
+        reads the same pages without the table locks of a shared cache
+        database. It is kept alive by a connection that is never used for
+        queries, so it survives connections being discarded and replaced.
+        """
+        uri = "file:/datasette-{}-{}?vfs=memdb".format(
+            id(self), urllib.parse.quote(db_name, safe="")
+        )
+        with self._memory_lock:
+            if db_name not in self._memory_copies:
+                source = sqlite3.connect(
+                    "file:{}?immutable=1".format(path), uri=True
+                )
+                copy = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                try:
+                    source.backup(copy)
+                except Exception:
+                    copy.close()
+                    raise
+                finally:
+                    source.close()
+                self._memory_copies[db_name] = copy
+        return uri
+
+    def connection_pool(self, db_name):
+        pool = self._connection_pools.get(db_name)
+        if pool is None:
+            size = (
+                self.config["connections_per_database"] or
+                self.executor_lanes.max_workers()
+            )
+            pool = ConnectionPool(lambda: self.connect(db_name), size)
+            self._connection_pools[db_name] = pool
+        return pool
+
+    def warm_connections(self):
+        """
+        Open every pooled connection, and copy databases into memory, so
+        setup costs are paid at startup. Only the database files are needed
+        for this, so inspect data is not loaded.
+        """
+        for filename in self.files:
+            self.connection_pool(Path(filename).stem).warm()
+
     def table_exists(self, database, table):
         return table in self.inspect().get(database, {}).get("tables")
 
     def inspect(self):
         " Inspect the database and return a dictionary of table metadata "
-        if self._inspect:
-            return self._inspect
+        if not self._inspect:
+            self._inspect = {}
+            to_inspect = []
+            for filename in self.files:
+                path = Path(filename)
+                name = path.stem
+                if name in self._inspect:
+                    raise Exception("Multiple files with same stem %s" % name)
 
-        self._inspect = {}
-        for filename in self.files:
-            path = Path(filename)
-            name = path.stem
-            if name in self._inspect:
-                raise Exception("Multiple files with same stem %s" % name)
-
-            with sqlite3.connect(
-                "file:{}?immutable=1".format(path), uri=True
-            ) as conn:
-                self.prepare_connection(conn)
-                self._inspect[name] = {
-                    "hash": inspect_hash(path),
-                    "file": str(path),
-                    "views": inspect_views(conn),
-                    "tables": inspect_tables(conn, self.metadata.get("databases", {}).get(name, {}))
-                }
+                database_metadata = self.metadata.get("databases", {}).get(name, {})
+                info = None
+                if self.config["inspect_cache"]:
+                    info = read_inspect_cache(
+                        path, self.inspect_cache_key(path, database_metadata)
+                    )
+                if info is None:
+                    to_inspect.append((name, path, database_metadata))
+                # None is a placeholder that keeps databases in their order
+                self._inspect[name] = info
+            for name, info in self.inspect_files(to_inspect).items():
+                self._inspect[name] = info
+            for filename in self.files:
+                path = Path(filename)
+                self._inspect[path.stem]["file"] = str(path)
         return self._inspect
 
+    def inspect_cache_key(self, path, database_metadata):
+        return inspect_cache_key(
+            path,
+            database_metadata,
+            hash_strategy=self.config["hash_strategy"],
+            approximate_counts=self.config["inspect_counts"] != "exact",
+            column_stats=self.config["inspect_column_stats"],
+            facet_size=self.inspect_facet_size(),
+        )
+
+    def inspect_facet_size(self):
+        "Facet size to precompute metadata facets for, or None"
+        if self.config["inspect_facets"]:
+            return self.config["default_facet_size"]
+        return None
+
+    def inspect_connection(self, name, path):
+        "Open and prepare a connection to the database at path, for inspection"
+        conn = sqlite3.connect("file:{}?immutable=1".format(path), uri=True)
+        self.prepare_connection(conn, name)
+        return conn
+
+    def materialized_inspect(self):
+        "Like inspect(), but with every lazily inspected table loaded"
+        return {
+            name: dict(info, tables=dict(info["tables"].items()))
+            for name, info in self.inspect().items()
+        }
+
+    async def ensure_inspected(self, db_name, tables=None):
+        """
+        With lazy_inspect, inspect tables of db_name (default: all of them)
+        and the tables they refer to in a worker thread, so that looking
+        them up in inspect() afterwards does not block the event loop.
+        """
+        info = self.inspect().get(db_name)
+        lazy_tables = info and info["tables"]
+        if not isinstance(lazy_tables, LazyTables):
+            return
+        missing = lazy_tables.uninspected(tables)
+        if missing:
+            await self.executor_lanes.lane(db_name).run(
+                lambda: lazy_tables.inspect_with_related(missing)
+            )
+
+    async def inspect_all_tables(self):
+        "Like materialized_inspect(), but inspects lazy tables off the loop"
+        for db_name in self.inspect():
+            await self.ensure_inspected(db_name)
+        data = self.materialized_inspect()
+        for db_name, info in data.items():
+            info["memory"] = self.serves_from_memory(db_name)
+        return data
+
+    def inspect_files(self, files):
+        """
+        Inspect a list of (name, path, database_metadata) tuples, returning
+        a dictionary of name => inspect data.
+
+        If inspect_processes is set, files are hashed and their tables are
+        counted in parallel using a pool of that many processes.
+        """
+        processes = self.config["inspect_processes"]
+        pool = None
+        if processes and files:
+            pool = futures.ProcessPoolExecutor(max_workers=processes)
+        try:
+            cache_keys = {}
+            if self.config["inspect_cache"]:
+                # Taken before inspecting, so a file that changes part way
+                # through can never be cached against its new state
+                cache_keys = {
+                    name: self.inspect_cache_key(path, database_metadata)
+                    for name, path, database_metadata in files
+                }
+            approximate = self.config["inspect_counts"] != "exact"
+            hashes = {}
+            counts = {}
+            if pool is not None:
+                for name, path, _ in files:
+                    hashes[name] = pool.submit(
+                        inspect_hash, path, self.config["hash_strategy"]
+                    )
+                    if approximate or self.config["lazy_inspect"]:
+                        continue
+                    with sqlite3.connect(
+                        "file:{}?immutable=1".format(path), uri=True
+                    ) as conn:
+                        table_names = inspect_table_names(conn)
+                    counts[name] = {
+                        table: pool.submit(
+                            inspect_count_in_process,
+                            str(path),
+                            table,
+                            self.sqlite_extensions,
+                        )
+                        for table in table_names
+                    }
+            inspected = {}
+            for name, path, database_metadata in files:
+                table_counts = None
+                if name in counts:
+                    table_counts = {
+                        table: future.result()
+                        for table, future in counts[name].items()
+                    }
+                conn = self.inspect_connection(name, path)
+                try:
+                    if self.config["lazy_inspect"]:
+                        tables = LazyTables(
+                            inspect_table_names(conn),
+                            functools.partial(
+                                self.inspect_connection, name, path
+                            ),
+                            database_metadata,
+                            approximate=approximate,
+                            column_stats=self.config["inspect_column_stats"],
+                            facet_size=self.inspect_facet_size(),
+                        )
+                    else:
+                        tables = inspect_tables(
+                            conn,
+                            database_metadata,
+                            counts=table_counts,
+                            approximate=approximate,
+                            column_stats=self.config["inspect_column_stats"],
+                            facet_size=self.inspect_facet_size(),
+                        )
+                    info = {
+                        "hash": hashes[name].result() if name in hashes else
+                        inspect_hash(path, self.config["hash_strategy"]),
+                        "views": inspect_views(conn),
+                        "tables": tables,
+                    }
+                finally:
+                    conn.close()
+                if name in cache_keys and not self.config["lazy_inspect"]:
+                    write_inspect_cache(path, cache_keys[name], info)
+                inspected[name] = info
+            return inspected
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def refine_counts(self):
+        "Replace approximate row counts with exact ones in a background thread"
+        if self._refining_counts:
+            return None
+        self._refining_counts = True
+
+        def refine():
+            for db_name, info in self.inspect().items():
+                tables = [
+                    table for table in info["tables"].values()
+                    if table.get("count_approximate")
+                ]
+                if not tables:
+                    continue
+                # Borrow a pooled connection, rather than opening (and for
+                # databases served from memory, copying) a new one
+                with self.connection_pool(db_name).connection() as conn:
+                    for table in tables:
+                        table["count"] = inspect_count(conn, table["name"])
+                        table.pop("count_approximate", None)
+
+        thread = threading.Thread(
+            target=refine, name="datasette-refine-counts", daemon=True
+        )
+        thread.start()
+        return thread
+
     def register_custom_units(self):
         "Register any custom units defined in the metadata.json with Pint"
         for unit in self.metadata.get("custom_units", []):
@@ -332,6 +723,50 @@ class Datasette:
             for p in get_plugins(pm)
         ]
 
+    def stats(self):
+        return {
+            "query_cache": self.query_cache.stats(),
+            "count_cache": self.count_cache.stats(),
+            "in_flight_queries": {
+                "executing": len(self._in_flight_queries),
+                "shared": self.in_flight_shared,
+            },
+            "connections": {
+                db_name: self.connection_pool(db_name).stats()
+                for db_name in self.inspect()
+            },
+            "memory_databases": self.memory_database_names(),
+            "executors": self.executor_lanes.stats(),
+        }
+
+    def time_limit_ms(self, custom_time_limit=None):
+        "The time limit for a query, which custom_time_limit can only lower"
+        time_limit_ms = self.sql_time_limit_ms
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+        return time_limit_ms
+
+    def in_thread(self, db_name, fn, time_limit_ms, cancellation):
+        """
+        Wrap fn(conn) into a function for an executor lane to run, which
+        calls it with a pooled connection to db_name under time_limit_ms.
+        Interrupted queries - cancelled or over the time limit - raise
+        InterruptedError.
+        """
+        pool = self.connection_pool(db_name)
+
+        def fn_in_thread():
+            with pool.connection() as conn, cancellation.running_on(conn), \
+                    sqlite_timelimit(conn, time_limit_ms):
+                try:
+                    return fn(conn)
+                except sqlite3.OperationalError as e:
+                    if e.args == ('interrupted',):
+                        raise InterruptedError(e)
+                    raise
+
+        return fn_in_thread
+
     async def execute(
         self,
         db_name,
@@ -340,49 +775,55 @@ class Datasette:
         truncate=False,
         custom_time_limit=None,
         page_size=None,
+        use_cache=True,
+        workload="primary",
     ):
-        """Executes sql against db_name in a thread"""
+        """Executes sql against db_name in a thread
+
+        workload is one of datasette.executor.WORKLOADS and selects the
+        executor lane the query runs in.
+        """
         page_size = page_size or self.page_size
 
-        def sql_operation_in_thread():
-            conn = getattr(connections, db_name, None)
-            if not conn:
-                info = self.inspect()[db_name]
-                conn = sqlite3.connect(
-                    "file:{}?immutable=1".format(info["file"]),
-                    uri=True,
-                    check_same_thread=False,
-                )
-                self.prepare_connection(conn)
-                setattr(connections, db_name, conn)
+        cache_key = None
+        if use_cache and self.query_cache.enabled:
+            cache_key = (
+                db_name,
+                self.inspect()[db_name]["hash"],
+                sql,
+                params_key(params),
+                truncate,
+                page_size,
+            )
+            cached = self.query_cache.get(cache_key)
+            if cached is not None:
+                return cached
 
-            time_limit_ms = self.sql_time_limit_ms
-            if custom_time_limit and custom_time_limit < time_limit_ms:
-                time_limit_ms = custom_time_limit
+        time_limit_ms = self.time_limit_ms(custom_time_limit)
+        cancellation = QueryCancellation()
 
-            with sqlite_timelimit(conn, time_limit_ms):
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(sql, params or {})
-                    max_returned_rows = self.max_returned_rows
-                    if max_returned_rows == page_size:
-                        max_returned_rows += 1
-                    if max_returned_rows and truncate:
-                        rows = cursor.fetchmany(max_returned_rows + 1)
-                        truncated = len(rows) > max_returned_rows
-                        rows = rows[:max_returned_rows]
-                    else:
-                        rows = cursor.fetchall()
-                        truncated = False
-                except sqlite3.OperationalError as e:
-                    if e.args == ('interrupted',):
-                        raise InterruptedError(e)
+        def sql_operation(conn):
+            try:
+                cursor = conn.cursor()
+                cursor.execute(sql, params or {})
+                max_returned_rows = self.max_returned_rows
+                if max_returned_rows == page_size:
+                    max_returned_rows += 1
+                if max_returned_rows and truncate:
+                    rows = cursor.fetchmany(max_returned_rows + 1)
+                    truncated = len(rows) > max_returned_rows
+                    rows = rows[:max_returned_rows]
+                else:
+                    rows = cursor.fetchall()
+                    truncated = False
+            except sqlite3.OperationalError as e:
+                if e.args != ('interrupted',):
                     print(
                         "ERROR: conn={}, sql = {}, params = {}: {}".format(
                             conn, repr(sql), params, e
                         )
                     )
-                    raise
+                raise
 
             if truncate:
                 return Results(rows, truncated, cursor.description)
@@ -390,9 +831,125 @@ class Datasette:
             else:
                 return Results(rows, False, cursor.description)
 
-        return await asyncio.get_event_loop().run_in_executor(
-            self.executor, sql_operation_in_thread
+        # Concurrent calls for an identical query share a single execution
+        # and a single Results object, so a burst of requests for the same
+        # page costs one query rather than one per request
+        in_flight_key = (
+            db_name, sql, params_key(params), truncate, page_size, time_limit_ms
+        )
+        loop = asyncio.get_event_loop()
+        in_flight = self._in_flight_queries.get(in_flight_key)
+        if in_flight is not None and in_flight[0] is loop and not in_flight[1].done():
+            _, future, cancellation = in_flight
+            self.in_flight_shared += 1
+        else:
+            future = self.executor_lanes.lane(db_name, workload).run(
+                self.in_thread(
+                    db_name, sql_operation, time_limit_ms, cancellation
+                )
+            )
+            self._in_flight_queries[in_flight_key] = (loop, future, cancellation)
+
+            def query_done(future):
+                in_flight = self._in_flight_queries.get(in_flight_key)
+                if in_flight is not None and in_flight[1] is future:
+                    del self._in_flight_queries[in_flight_key]
+                if (
+                    cache_key is not None and
+                    not future.cancelled() and
+                    future.exception() is None
+                ):
+                    self.query_cache.set(cache_key, future.result())
+
+            future.add_done_callback(query_done)
+        # shield() so that one cancelled caller does not cancel the others.
+        # Once every caller has been cancelled - usually because their HTTP
+        # clients disconnected - the query is interrupted, handing its
+        # thread and connection straight back.
+        cancellation.waiters += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancellation.waiters -= 1
+            if not cancellation.waiters:
+                cancellation.cancel()
+                future.cancel()
+            raise
+
+    async def execute_fn(
+        self, db_name, fn, custom_time_limit=None, workload="primary"
+    ):
+        """Runs fn(conn) in a thread against a connection to db_name
+
+        The same time limits, executor lanes and cancellation apply as for
+        execute(). Returns whatever fn returns.
+        """
+        cancellation = QueryCancellation()
+        future = self.executor_lanes.lane(db_name, workload).run(
+            self.in_thread(
+                db_name, fn, self.time_limit_ms(custom_time_limit),
+                cancellation,
+            )
         )
+        try:
+            return await future
+        except asyncio.CancelledError:
+            cancellation.cancel()
+            raise
+
+    async def execute_stream(
+        self,
+        db_name,
+        sql,
+        params=None,
+        custom_time_limit=None,
+        workload="export",
+        batch_size=STREAM_BATCH_SIZE,
+    ):
+        """Executes sql against db_name in a thread, returning a RowStream
+
+        Unlike execute() every row is returned, read from a single cursor in
+        batches of batch_size. The time limit applies to reading each batch
+        rather than to the query as a whole. Errors raised before the first
+        row is read, such as invalid SQL, are raised here.
+        """
+        time_limit_ms = self.time_limit_ms(custom_time_limit)
+        pool = self.connection_pool(db_name)
+        stream = RowStream(asyncio.get_event_loop())
+
+        def stream_in_thread():
+            with pool.connection() as conn, \
+                    stream.cancellation.running_on(conn):
+                try:
+                    with sqlite_timelimit(conn, time_limit_ms):
+                        cursor = conn.execute(sql, params or {})
+                    stream.start(cursor.description)
+                    while True:
+                        with sqlite_timelimit(conn, time_limit_ms):
+                            rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        if not stream.put(rows):
+                            return
+                except sqlite3.OperationalError as e:
+                    if e.args == ('interrupted',):
+                        e = InterruptedError(e)
+                    stream.fail(e)
+                    return
+                except Exception as e:
+                    stream.fail(e)
+                    return
+            stream.finish()
+
+        future = self.executor_lanes.lane(db_name, workload).run(
+            stream_in_thread
+        )
+        try:
+            await stream.started(future)
+        except BaseException:
+            stream.close()
+            raise
+        return stream
 
     def app(self):
         app = Sanic(__name__)
@@ -435,7 +992,7 @@ class Datasette:
                 modpath = "/-/static-plugins/{}/".format(plugin["name"])
                 app.static(modpath, plugin["static_path"])
         app.add_route(
-            JsonDataView.as_view(self, "inspect.json", self.inspect),
+            JsonDataView.as_view(self, "inspect.json", self.inspect_all_tables),
             "/-/inspect<as_format:(\.json)?$>",
         )
         app.add_route(
@@ -454,11 +1011,15 @@ class Datasette:
             JsonDataView.as_view(self, "config.json", lambda: self.config),
             "/-/config<as_format:(\.json)?$>",
         )
+        app.add_route(
+            JsonDataView.as_view(self, "stats.json", self.stats),
+            "/-/stats<as_format:(\.json)?$>",
+        )
         app.add_route(
             DatabaseDownload.as_view(self), "/<db_name:[^/]+?><as_db:(\.db)$>"
         )
         app.add_route(
-            DatabaseView.as_view(self), "/<db_name:[^/]+?><as_format:(\.jsono?|\.csv)?$>"
+            DatabaseView.as_view(self), "/<db_name:[^/]+?><as_format:(\.jsono?|\.csv|\.ndjson|\.arrow)?$>"
         )
         app.add_route(
             TableView.as_view(self),
@@ -469,6 +1030,12 @@ class Datasette:
             "/<db_name:[^/]+>/<table:[^/]+?>/<pk_path:[^/]+?><as_format:(\.jsono?)?$>",
         )
         self.register_custom_units()
+
+        if self.config["inspect_counts"] == "deferred":
+            @app.listener("after_server_start")
+            async def refine_counts(app, loop):
+                self.refine_counts()
+
         # On 404 with a trailing slash redirect to path without that slash:
         @app.middleware("response")
         def redirect_on_404_with_trailing_slash(request, original_response):
@@ -483,6 +1050,7 @@ class Datasette:
         def on_exception(request, exception):
             title = None
             help = None
+            headers = {}
             if isinstance(exception, NotFound):
                 status = 404
                 info = {}
@@ -498,6 +1066,12 @@ class Datasette:
                 if exception.messagge_is_html:
                     message = Markup(message)
                 title = exception.title
+            elif isinstance(exception, QueueFullError):
+                # Shed load quickly rather than letting every request time out
+                status = 503
+                info = {}
+                message = str(exception)
+                headers["Retry-After"] = str(exception.retry_after)
             else:
                 status = 500
                 info = {}
@@ -510,10 +1084,12 @@ class Datasette:
                 {"ok": False, "error": message, "status": status, "title": title}
             )
             if request.path.split("?")[0].endswith(".json"):
-                return response.json(info, status=status)
+                return response.json(info, status=status, headers=headers)
 
             else:
                 template = self.jinja_env.select_template(templates)
-                return response.html(template.render(info), status=status)
+                return response.html(
+                    template.render(info), status=status, headers=headers
+                )
 
         return app
@@ -0,0 +1,248 @@
+"""
+Apache Arrow IPC output for the .arrow format. This needs the optional
+pyarrow dependency: pip install datasette[arrow]
+"""
+from .utils import escape_sqlite
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Kinds of value each Python type returned by SQLite belongs to
+VALUE_KINDS = {
+    int: "int",
+    float: "float",
+    str: "str",
+    bytes: "bytes",
+}
+
+
+def declared_column_types(conn, table):
+    "Map the columns of a table or view to the types they were declared with"
+    return {
+        r[1]: r[2]
+        for r in conn.execute(
+            "PRAGMA table_info({});".format(escape_sqlite(table))
+        ).fetchall()
+    }
+
+
+def declared_kind(declared_type):
+    """
+    The kind of value a column declared with this type is expected to hold,
+    following SQLite's type affinity rules - or None if it could hold more
+    than one kind (BLOB and NUMERIC affinity).
+    """
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return "int"
+    if any(t in declared_type for t in ("CHAR", "CLOB", "TEXT")):
+        return "str"
+    if "BLOB" in declared_type or not declared_type:
+        return None
+    if any(t in declared_type for t in ("REAL", "FLOA", "DOUB")):
+        return "float"
+    return None
+
+
+def infer_kind(declared_type, values):
+    """
+    Pick the kind of Arrow column for values, a sample of the values in a
+    column declared with declared_type.
+    """
+    kinds = {VALUE_KINDS.get(type(v), "str") for v in values if v is not None}
+    declared = declared_kind(declared_type)
+    if not kinds:
+        return declared or "str"
+    if kinds == {"int"}:
+        return "float" if declared == "float" else "int"
+    if kinds == {"int", "float"}:
+        return "float"
+    if len(kinds) == 1:
+        return kinds.pop()
+    if "bytes" in kinds:
+        return "bytes"
+    return "str"
+
+
+class ArrowTypeError(ValueError):
+    "Raised for a value that cannot be stored in its column's Arrow type"
+
+
+def to_int(value):
+    if value is None or type(value) is int:
+        return value
+    if type(value) is float and value.is_integer():
+        return int(value)
+    raise ArrowTypeError(value)
+
+
+def to_float(value):
+    if value is None or type(value) is float:
+        return value
+    # Integers too large to be represented exactly are not converted
+    if type(value) is int and float(value) == value:
+        return float(value)
+    raise ArrowTypeError(value)
+
+
+def to_str(value):
+    if value is None or type(value) is str:
+        return value
+    if type(value) is bytes:
+        return value.decode("utf8", "replace")
+    return str(value)
+
+
+def to_bytes(value):
+    if value is None or type(value) is bytes:
+        return value
+    return to_str(value).encode("utf8")
+
+
+CONVERTERS = {
+    "int": to_int,
+    "float": to_float,
+    "str": to_str,
+    "bytes": to_bytes,
+}
+
+
+def arrow_type(kind):
+    return {
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "str": pyarrow.string(),
+        "bytes": pyarrow.binary(),
+    }[kind]
+
+
+class ChunkSink:
+    "Write-only file that holds on to whatever was written since take()"
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ArrowStreamWriter:
+    """
+    Encodes batches of rows as an Arrow IPC stream, one record batch per
+    batch of rows.
+
+    The schema is inferred from the declared types of the columns and the
+    values in the first batch, and cannot change after that. Later values
+    are converted to their column's type if that can be done without losing
+    anything - an integer in a float column, say, or any value in a string
+    column. Otherwise write() raises ArrowTypeError, rather than exporting
+    a null in place of the value.
+
+    Expanded foreign key columns, whose cells are {"value": ..., "label":
+    ...} dicts, get an extra string column for their labels, named
+    column_label as in CSV exports.
+    """
+
+    def __init__(self, columns, expanded_columns=(), declared_types=None):
+        if pyarrow is None:
+            raise ImportError(
+                "Arrow output needs pyarrow: pip install datasette[arrow]"
+            )
+        self.columns = columns
+        self.expanded_columns = set(expanded_columns)
+        self.declared_types = declared_types or {}
+        self.sink = ChunkSink()
+        self.writer = None
+        self.names = []
+        self.kinds = []
+
+    def start(self, rows):
+        "Infer the schema from the first batch of rows and write it"
+        for index, column in enumerate(self.columns):
+            values = [
+                row[index]["value"] if isinstance(row[index], dict)
+                else row[index]
+                for row in rows
+            ]
+            self.names.append(column)
+            self.kinds.append(
+                infer_kind(self.declared_types.get(column), values)
+            )
+            if column in self.expanded_columns:
+                self.names.append("{}_label".format(column))
+                self.kinds.append("str")
+        schema = pyarrow.schema([
+            pyarrow.field(name, arrow_type(kind))
+            for name, kind in zip(self.names, self.kinds)
+        ])
+        self.writer = pyarrow.RecordBatchStreamWriter(
+            pyarrow.PythonFile(self.sink, mode="w"), schema
+        )
+
+    def write(self, rows):
+        "Return the bytes for a batch of rows, preceded by the schema if first"
+        if self.writer is None:
+            self.start(rows)
+        values = [[] for _ in self.names]
+        for row in rows:
+            i = 0
+            for column, cell in zip(self.columns, row):
+                if column in self.expanded_columns:
+                    if isinstance(cell, dict):
+                        values[i].append(cell["value"])
+                        values[i + 1].append(cell["label"])
+                    else:
+                        values[i].append(cell)
+                        values[i + 1].append(None)
+                    i += 2
+                else:
+                    values[i].append(cell)
+                    i += 1
+        arrays = [
+            self.array(name, kind, column_values)
+            for name, kind, column_values in zip(
+                self.names, self.kinds, values
+            )
+        ]
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(arrays, self.names)
+        )
+        return self.sink.take()
+
+    def array(self, name, kind, values):
+        convert = CONVERTERS[kind]
+        try:
+            converted = [convert(value) for value in values]
+        except ArrowTypeError as e:
+            raise ArrowTypeError(
+                "Column {} was exported as {} based on its first rows, but "
+                "also contains {}. Use a SQL query with CAST() to choose its "
+                "type.".format(name, arrow_type(kind), repr(e.args[0])[:50])
+            )
+        return pyarrow.array(converted, type=arrow_type(kind))
+
+    def close(self):
+        "Return the bytes that end the stream - and the schema, if no rows"
+        if self.writer is None:
+            self.start([])
+        self.writer.close()
+        return self.sink.take()
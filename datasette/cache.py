@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import sys
+
+
+def results_size(results):
+    "Approximate number of bytes of memory held by a Results object"
+    size = sys.getsizeof(results.rows)
+    for row in results.rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+def params_key(params):
+    "Hashable representation of a dictionary or list of SQL parameters"
+    if not params:
+        return ()
+    if isinstance(params, dict):
+        return tuple(sorted(params.items()))
+    return tuple(params)
+
+
+class QueryCache:
+    """
+    Least-recently-used cache of query results, bounded by the approximate
+    size in bytes of the results it holds.
+
+    Every database is opened immutable and keys include the database hash,
+    so a cached result can never go stale while the server is running.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes)
+
+    def get(self, key):
+        try:
+            results, size = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return results
+
+    def set(self, key, results):
+        size = results_size(results)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (results, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_bytes": self.max_bytes,
+            "bytes": self.bytes,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class CountCache:
+    """
+    Least-recently-used cache of the number of rows matched by a table's
+    filters, bounded by the number of counts it holds.
+
+    Keys include the database hash, so like the query cache a count can
+    never go stale while the server is running.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self):
+        return bool(self.max_entries)
+
+    def get(self, key):
+        try:
+            count = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def set(self, key, count):
+        if not self.enabled:
+            return
+        self._entries[key] = count
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_entries": self.max_entries,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
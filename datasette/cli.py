@@ -7,6 +7,12 @@ import shutil
 from subprocess import call, check_output
 import sys
 from .app import Datasette, DEFAULT_CONFIG, CONFIG_OPTIONS
+from .inspect import (
+    HASH_STRATEGIES,
+    INSPECT_COUNTS,
+    load_inspect_file,
+    write_inspect_file,
+)
 from .utils import (
     temporary_docker_directory,
     temporary_heroku_directory,
@@ -30,6 +36,13 @@ class StaticMount(click.ParamType):
         return path, dirpath
 
 
+# Config options that only accept one of a fixed set of values
+CONFIG_CHOICES = {
+    "hash_strategy": HASH_STRATEGIES,
+    "inspect_counts": INSPECT_COUNTS,
+}
+
+
 class Config(click.ParamType):
     name = "config"
 
@@ -64,6 +77,15 @@ class Config(click.ParamType):
                 )
                 return
             return name, int(value)
+        elif isinstance(default, str):
+            choices = CONFIG_CHOICES.get(name)
+            if choices and value not in choices:
+                self.fail(
+                    '"{}" should be one of {}'.format(name, ", ".join(choices)),
+                    param, ctx
+                )
+                return
+            return name, value
         else:
             # Should never happen:
             self.fail('Invalid option')
@@ -88,9 +110,71 @@ def cli():
     type=click.Path(exists=True, resolve_path=True),
     help="Path to a SQLite extension to load",
 )
-def inspect(files, inspect_file, sqlite_extensions):
-    app = Datasette(files, sqlite_extensions=sqlite_extensions)
-    open(inspect_file, "w").write(json.dumps(app.inspect(), indent=2))
+@click.option(
+    "--processes",
+    type=int,
+    default=0,
+    help="Number of processes to use to hash files and count tables in parallel",
+)
+@click.option(
+    "--hash-strategy",
+    type=click.Choice(HASH_STRATEGIES),
+    default=DEFAULT_CONFIG["hash_strategy"],
+    help="How to hash each database file",
+)
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["json", "binary"]),
+    default="json",
+    help="Write JSON, or a compact binary file that is faster to load",
+)
+@click.option(
+    "--column-stats",
+    is_flag=True,
+    help="Calculate null counts, distinct counts, min, max and most common values for every column",
+)
+@click.option(
+    "-m",
+    "--metadata",
+    type=click.File(mode="r"),
+    help="Path to JSON file containing metadata, used to find facets to precompute",
+)
+@click.option(
+    "--facets",
+    is_flag=True,
+    help="Precompute counts for the facets configured in metadata",
+)
+def inspect(
+    files,
+    inspect_file,
+    sqlite_extensions,
+    processes,
+    hash_strategy,
+    format_,
+    column_stats,
+    metadata,
+    facets,
+):
+    metadata_data = None
+    if metadata:
+        metadata_data = json.loads(metadata.read())
+    app = Datasette(
+        files,
+        metadata=metadata_data,
+        sqlite_extensions=sqlite_extensions,
+        config={
+            "inspect_processes": processes,
+            "hash_strategy": hash_strategy,
+            "inspect_column_stats": column_stats,
+            "inspect_facets": facets,
+        },
+    )
+    if format_ == "binary":
+        with open(inspect_file, "wb") as fp:
+            write_inspect_file(fp, app.materialized_inspect())
+    else:
+        open(inspect_file, "w").write(json.dumps(app.materialized_inspect(), indent=2))
 
 
 @cli.command()
@@ -454,7 +538,8 @@ def package(
     help="Path to a SQLite extension to load",
 )
 @click.option(
-    "--inspect-file", help='Path to JSON file created using "datasette inspect"'
+    "--inspect-file",
+    help='Path to JSON or binary file created using "datasette inspect"',
 )
 @click.option(
     "-m",
@@ -528,7 +613,7 @@ def serve(
 
     inspect_data = None
     if inspect_file:
-        inspect_data = json.load(open(inspect_file))
+        inspect_data = load_inspect_file(inspect_file)
 
     metadata_data = None
     if metadata:
@@ -550,4 +635,6 @@ def serve(
     )
     # Force initial hashing/table counting
     ds.inspect()
+    # Open and prepare pooled connections before accepting any requests
+    ds.warm_connections()
     ds.app().run(host=host, port=port, debug=debug)
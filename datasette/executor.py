@@ -0,0 +1,370 @@
+from concurrent import futures
+from contextlib import contextmanager
+import asyncio
+import threading
+import time
+
+from .utils import InterruptedError
+
+
+# Kinds of work that can be given their own executor lane
+WORKLOADS = ("primary", "facet", "suggest", "count", "export")
+# Rows are streamed in batches of this size, with at most this many batches
+# waiting for the client before the query pauses
+STREAM_BATCH_SIZE = 1000
+STREAM_MAX_BATCHES = 4
+# A worker thread waiting to queue a batch checks every
+# STREAM_PUT_POLL_INTERVAL seconds whether the stream has been closed, and
+# gives up if nothing takes a batch for STREAM_MAX_WAIT seconds
+STREAM_PUT_POLL_INTERVAL = 0.1
+STREAM_MAX_WAIT = 10
+
+
+class QueueFullError(Exception):
+    "Raised when an executor lane is too busy to accept more work"
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueryCancellation:
+    """
+    Lets a query running in a worker thread be interrupted from the event
+    loop, for example because the client that asked for it went away.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        # Number of callers still waiting for the result
+        self.waiters = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def running_on(self, conn):
+        "Mark conn as executing this query for the duration of the block"
+        with self._lock:
+            if self.cancelled:
+                raise InterruptedError("Query was cancelled")
+            self._conn = conn
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
+
+
+class RowStream:
+    """
+    The rows returned by a single query, read by a worker thread and handed
+    to the event loop in batches through a bounded queue. The worker thread
+    waits whenever max_batches batches are queued, so a slow client slows
+    the query down rather than filling up memory.
+
+    The worker thread calls start(), put() and finish() or fail(). The event
+    loop awaits started(), then calls fetch() until it returns None and
+    close() when it is done - closing early interrupts the query. If nothing
+    fetches a batch for max_wait seconds the worker thread stops waiting,
+    and fetch() raises InterruptedError.
+    """
+
+    _END = object()
+
+    def __init__(
+        self, loop, max_batches=STREAM_MAX_BATCHES, max_wait=STREAM_MAX_WAIT
+    ):
+        self.loop = loop
+        self.max_wait = max_wait
+        self.description = None
+        self.cancellation = QueryCancellation()
+        self.closed = False
+        self._error = None
+        self._queue = asyncio.Queue(maxsize=max_batches, loop=loop)
+        self._started = loop.create_future()
+
+    # Called from the worker thread
+
+    def start(self, description):
+        self.description = description
+        self.loop.call_soon_threadsafe(self._set_started)
+
+    def put(self, rows):
+        "Queue a batch of rows, waiting for space. False if the stream closed"
+        if self.closed:
+            return False
+        future = asyncio.run_coroutine_threadsafe(
+            self._queue.put(rows), self.loop
+        )
+        deadline = time.perf_counter() + self.max_wait
+        while True:
+            try:
+                future.result(timeout=STREAM_PUT_POLL_INTERVAL)
+                return not self.closed
+            except futures.TimeoutError:
+                pass
+            if self.closed or self.cancellation.cancelled:
+                future.cancel()
+                return False
+            if self.loop.is_closed():
+                self.closed = True
+                return False
+            if self.max_wait and time.perf_counter() > deadline:
+                future.cancel()
+                self.loop.call_soon_threadsafe(
+                    self._give_up,
+                    InterruptedError(
+                        "Rows were not read for {} seconds".format(self.max_wait)
+                    ),
+                )
+                return False
+
+    def finish(self):
+        self.put(self._END)
+
+    def fail(self, exception):
+        "Raise exception from started() or, once rows are flowing, fetch()"
+        def fail_in_loop():
+            if not self._started.done():
+                self._started.set_exception(exception)
+        if self.description is None:
+            self.loop.call_soon_threadsafe(fail_in_loop)
+        else:
+            self.put(exception)
+
+    def _give_up(self, exception):
+        self._error = exception
+        self.close()
+
+    def _set_started(self):
+        if not self._started.done():
+            self._started.set_result(self.description)
+
+    # Called from the event loop
+
+    async def started(self, future):
+        """
+        Wait for the query to start returning rows. future is the worker
+        thread's future - if it finishes first, its exception is raised.
+        """
+        await asyncio.wait(
+            [self._started, future], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not self._started.done():
+            future.result()
+        return await self._started
+
+    async def fetch(self):
+        "Return the next batch of rows, or None once they have all been read"
+        if self.closed:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return None
+        batch = await self._queue.get()
+        if batch is self._END:
+            self.closed = True
+            return None
+        if isinstance(batch, Exception):
+            self.closed = True
+            raise batch
+        return batch
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cancellation.cancel()
+        # Make room for a worker thread waiting in put(), so it can see that
+        # the stream has been closed
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+class ExecutorLane:
+    """
+    A thread pool with its own concurrency limit, queue and counters.
+
+    max_queued limits how many jobs can wait for a free thread and
+    max_queue_wait_ms how long a job may wait before it is abandoned - in
+    both cases QueueFullError is raised instead. 0 means no limit.
+    """
+
+    def __init__(self, name, max_workers, max_queued=0, max_queue_wait_ms=0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_queue_wait_ms = max_queue_wait_ms
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_ms = 0.0
+        self.max_queue_wait_seen_ms = 0.0
+        self.execution_ms = 0.0
+
+    def run(self, fn):
+        "Run fn in this lane, returning an asyncio future"
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            waiting = self.queued + self.running - self.max_workers
+            if self.max_queued and waiting >= self.max_queued:
+                self.rejected += 1
+                raise QueueFullError(
+                    "Too many queued queries for {}".format(self.name)
+                )
+            self.queued += 1
+        result = loop.create_future()
+        # Guarded by self._lock: "started", or "abandoned" if the job was
+        # cancelled or waited longer than max_queue_wait_ms before starting
+        state = {"status": None}
+        submitted = time.perf_counter()
+
+        def run_and_count():
+            with self._lock:
+                if state["status"] == "abandoned":
+                    return
+                state["status"] = "started"
+                self.queued -= 1
+                self.running += 1
+                waited_ms = (time.perf_counter() - submitted) * 1000
+                self.queue_wait_ms += waited_ms
+                self.max_queue_wait_seen_ms = max(
+                    self.max_queue_wait_seen_ms, waited_ms
+                )
+            start = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.execution_ms += (time.perf_counter() - start) * 1000
+
+        def set_result(concurrent_future):
+            if result.done():
+                return
+            if concurrent_future.cancelled():
+                result.cancel()
+            elif concurrent_future.exception() is not None:
+                result.set_exception(concurrent_future.exception())
+            else:
+                result.set_result(concurrent_future.result())
+
+        def abandon():
+            with self._lock:
+                if state["status"] is not None:
+                    return False
+                state["status"] = "abandoned"
+                self.queued -= 1
+                return True
+
+        def expire():
+            if abandon() and not result.done():
+                with self._lock:
+                    self.rejected += 1
+                result.set_exception(QueueFullError(
+                    "Query waited more than {}ms for {}".format(
+                        self.max_queue_wait_ms, self.name
+                    )
+                ))
+
+        def schedule_set_result(concurrent_future):
+            try:
+                loop.call_soon_threadsafe(set_result, concurrent_future)
+            except RuntimeError:
+                # The loop has shut down while this job was finishing, for
+                # example a streamed query that returned after its last
+                # batch had been sent. Nothing is waiting for the result.
+                pass
+
+        concurrent_future = self.executor.submit(run_and_count)
+        concurrent_future.add_done_callback(schedule_set_result)
+
+        def abandon_if_cancelled(result):
+            if result.cancelled():
+                abandon()
+
+        result.add_done_callback(abandon_if_cancelled)
+        if self.max_queue_wait_ms:
+            timer = loop.call_later(self.max_queue_wait_ms / 1000, expire)
+            result.add_done_callback(lambda r: timer.cancel())
+        return result
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_ms": round(self.queue_wait_ms, 3),
+            "max_queue_wait_ms": round(self.max_queue_wait_seen_ms, 3),
+            "execution_ms": round(self.execution_ms, 3),
+        }
+
+
+class ExecutorLanes:
+    """
+    Routes SQL work to an ExecutorLane based on its workload and, optionally,
+    the database it runs against.
+
+    thread_counts maps each workload to a number of threads. Workloads with
+    no threads of their own share the "primary" lane. If per_database is
+    True every database gets its own set of lanes, so a slow database
+    cannot starve queries against the others. max_queued and
+    max_queue_wait_ms are applied to every lane.
+    """
+
+    def __init__(
+        self, thread_counts, per_database=False, max_queued=0, max_queue_wait_ms=0
+    ):
+        self.thread_counts = thread_counts
+        self.per_database = per_database
+        self.max_queued = max_queued
+        self.max_queue_wait_ms = max_queue_wait_ms
+        self._lanes = {}
+
+    def lane_name(self, db_name, workload):
+        if workload not in WORKLOADS:
+            raise ValueError("Unknown workload: {}".format(workload))
+        if not self.thread_counts.get(workload):
+            workload = "primary"
+        if self.per_database and db_name is not None:
+            return "{}:{}".format(db_name, workload)
+        return workload
+
+    def lane(self, db_name=None, workload="primary"):
+        name = self.lane_name(db_name, workload)
+        lane = self._lanes.get(name)
+        if lane is None:
+            lane = ExecutorLane(
+                name,
+                self.thread_counts[name.split(":")[-1]],
+                max_queued=self.max_queued,
+                max_queue_wait_ms=self.max_queue_wait_ms,
+            )
+            self._lanes[name] = lane
+        return lane
+
+    def max_workers(self):
+        "Maximum number of threads that can run against a single database"
+        return sum(
+            self.thread_counts[workload]
+            for workload in WORKLOADS
+            if self.thread_counts.get(workload)
+        )
+
+    def stats(self):
+        return {
+            name: lane.stats()
+            for name, lane in sorted(self._lanes.items())
+        }
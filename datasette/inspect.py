@@ -1,25 +1,421 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent import futures
+from contextlib import contextmanager
 import hashlib
+import json
+import mmap
+import os
+import re
 import sqlite3
+import struct
+import threading
 
-from .utils import detect_spatialite, detect_fts, escape_sqlite, get_all_foreign_keys
+from .utils import (
+    detect_all_fts,
+    detect_spatialite,
+    escape_sqlite,
+    get_all_columns,
+    get_all_foreign_keys,
+    get_all_indexed_columns,
+)
+from .version import __version__
 
 
 HASH_BLOCK_SIZE = 1024 * 1024
+COLUMN_STATS_TOP_K = 10
+COLUMN_STATS_BATCH_SIZE = 200
+HASH_STRATEGIES = ("sha256", "blake2b", "tree", "header")
+# Values of the inspect_counts config option
+INSPECT_COUNTS = ("exact", "approximate", "deferred")
+TREE_CHUNK_SIZE = 64 * 1024 * 1024
+# The SQLite database header includes the file change counter, page count
+# and schema cookie, so it changes whenever the file is written to
+SQLITE_HEADER_SIZE = 100
+# Matches EXPLAIN QUERY PLAN details like "SEARCH t USING INDEX t_a (a=?)",
+# including the "SEARCH TABLE t" format used before SQLite 3.24
+EXPLAIN_SEARCH_RE = re.compile(
+    r"^SEARCH (?:TABLE )?(.+?) USING "
+    r"((?:COVERING )?INDEX \S+|INTEGER PRIMARY KEY) \((.*)\)$"
+)
 
 
-def inspect_hash(path):
-    " Calculate the hash of a database, efficiently. "
-    m = hashlib.sha256()
+def inspect_hash(path, strategy="sha256"):
+    """ Calculate the hash of a database, efficiently.
+
+        strategy is one of HASH_STRATEGIES:
+
+        * sha256 - SHA-256 of the entire file
+        * blake2b - BLAKE2b of the entire file, read using mmap
+        * tree - BLAKE2b of fixed size chunks of the file, calculated in
+          parallel, hashed again to give a single value
+        * header - SHA-256 of the SQLite header and the size of the file,
+          which changes whenever the database is written to
+    """
+    if strategy == "sha256":
+        m = hashlib.sha256()
+        with path.open("rb") as fp:
+            while True:
+                data = fp.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                m.update(data)
+        return m.hexdigest()
+    elif strategy == "blake2b":
+        with mapped_file(path) as data:
+            return hashlib.blake2b(data).hexdigest()
+    elif strategy == "tree":
+        return inspect_tree_hash(path)
+    elif strategy == "header":
+        size = path.stat().st_size
+        with path.open("rb") as fp:
+            header = fp.read(SQLITE_HEADER_SIZE)
+        return hashlib.sha256(
+            header + str(size).encode("utf8")
+        ).hexdigest()
+    raise ValueError("Unknown hash strategy: {}".format(strategy))
+
+
+@contextmanager
+def mapped_file(path):
+    " Read-only view of the contents of path, using mmap where possible. "
     with path.open("rb") as fp:
-        while True:
-            data = fp.read(HASH_BLOCK_SIZE)
-            if not data:
-                break
-            m.update(data)
+        if not os.fstat(fp.fileno()).st_size:
+            # Empty files cannot be mapped
+            yield b""
+            return
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            view.release()
+            mapped.close()
 
+
+def inspect_tree_hash(path):
+    " Hash TREE_CHUNK_SIZE chunks of path in parallel, then hash the hashes. "
+    with mapped_file(path) as data:
+        chunks = [
+            data[start:start + TREE_CHUNK_SIZE]
+            for start in range(0, len(data), TREE_CHUNK_SIZE)
+        ]
+        # hashlib releases the GIL while hashing, so threads run in parallel
+        with futures.ThreadPoolExecutor() as executor:
+            digests = list(executor.map(
+                lambda chunk: hashlib.blake2b(chunk).digest(), chunks
+            ))
+        for chunk in chunks:
+            if isinstance(chunk, memoryview):
+                chunk.release()
+    m = hashlib.blake2b()
+    m.update(str(TREE_CHUNK_SIZE).encode("utf8"))
+    for digest in digests:
+        m.update(digest)
     return m.hexdigest()
 
 
+# Binary inspect files start with INSPECT_FILE_MAGIC followed by a header
+# of (format version, index offset, index length). The index maps each
+# database name to the (offset, length) of its encoded inspect data, so
+# databases can be decoded one at a time. Values are encoded in the same
+# way on every platform and Python version, see encode_inspect_value().
+INSPECT_FILE_MAGIC = b"DATASETTE-INSPECT"
+INSPECT_FILE_VERSION = 2
+INSPECT_FILE_HEADER = struct.Struct("<HQQ")
+INSPECT_FLOAT = struct.Struct("<d")
+# Every encoded value starts with one of these type tags
+(
+    INSPECT_TAG_NONE,
+    INSPECT_TAG_TRUE,
+    INSPECT_TAG_FALSE,
+    INSPECT_TAG_INT,
+    INSPECT_TAG_FLOAT,
+    INSPECT_TAG_STR,
+    INSPECT_TAG_BYTES,
+    INSPECT_TAG_LIST,
+    INSPECT_TAG_DICT,
+) = b"NTFidsblm"
+
+
+def write_varint(out, n):
+    " Append the non-negative integer n to out, seven bits per byte. "
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def encode_inspect_value(out, value):
+    """ Append the binary encoding of value to the bytearray out.
+
+        value is made up of None, booleans, integers, floats, strings, bytes,
+        lists, tuples and dictionaries. Integers and lengths are written as
+        varints, so small values take up a single byte.
+    """
+    if value is None:
+        out.append(INSPECT_TAG_NONE)
+    elif value is True:
+        out.append(INSPECT_TAG_TRUE)
+    elif value is False:
+        out.append(INSPECT_TAG_FALSE)
+    elif isinstance(value, int):
+        out.append(INSPECT_TAG_INT)
+        # Zigzag encoding, so negative numbers are small too
+        write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.append(INSPECT_TAG_FLOAT)
+        out += INSPECT_FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode("utf8")
+        out.append(INSPECT_TAG_STR)
+        write_varint(out, len(data))
+        out += data
+    elif isinstance(value, bytes):
+        out.append(INSPECT_TAG_BYTES)
+        write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(INSPECT_TAG_LIST)
+        write_varint(out, len(value))
+        for item in value:
+            encode_inspect_value(out, item)
+    elif isinstance(value, dict):
+        out.append(INSPECT_TAG_DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            encode_inspect_value(out, key)
+            encode_inspect_value(out, item)
+    else:
+        raise TypeError(
+            "Cannot write {!r} to a binary inspect file".format(value)
+        )
+
+
+class InspectDecoder:
+    " Decodes the values written by encode_inspect_value() from data. "
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def decode(self):
+        " Decode the whole of data, raising ValueError if it is not valid. "
+        try:
+            value = self.value()
+        except (IndexError, struct.error, UnicodeDecodeError, RecursionError):
+            value = None
+            self.position = -1
+        if self.position != len(self.data):
+            raise ValueError("Binary inspect data is corrupt")
+        return value
+
+    def varint(self):
+        n = 0
+        shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def raw(self):
+        length = self.varint()
+        start = self.position
+        self.position += length
+        if self.position > len(self.data):
+            raise IndexError(self.position)
+        return self.data[start:self.position]
+
+    def value(self):
+        tag = self.data[self.position]
+        self.position += 1
+        if tag == INSPECT_TAG_STR:
+            return self.raw().decode("utf8")
+        if tag == INSPECT_TAG_INT:
+            n = self.varint()
+            return n // 2 if not n & 1 else -(n + 1) // 2
+        if tag == INSPECT_TAG_DICT:
+            value = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                value[key] = self.value()
+            return value
+        if tag == INSPECT_TAG_LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == INSPECT_TAG_NONE:
+            return None
+        if tag == INSPECT_TAG_TRUE:
+            return True
+        if tag == INSPECT_TAG_FALSE:
+            return False
+        if tag == INSPECT_TAG_FLOAT:
+            value, = INSPECT_FLOAT.unpack_from(self.data, self.position)
+            self.position += INSPECT_FLOAT.size
+            return value
+        if tag == INSPECT_TAG_BYTES:
+            return bytes(self.raw())
+        raise ValueError("Binary inspect data is corrupt")
+
+
+def encode_inspect_data(value):
+    out = bytearray()
+    encode_inspect_value(out, value)
+    return bytes(out)
+
+
+def write_inspect_file(fp, data):
+    " Write inspect data to a binary file opened in 'wb' mode. "
+    blobs = []
+    index = []
+    offset = len(INSPECT_FILE_MAGIC) + INSPECT_FILE_HEADER.size
+    for name, info in data.items():
+        blob = encode_inspect_data(info)
+        # Databases in the order they were given
+        index.append([name, offset, len(blob)])
+        blobs.append(blob)
+        offset += len(blob)
+    index_blob = encode_inspect_data(index)
+    fp.write(INSPECT_FILE_MAGIC)
+    fp.write(INSPECT_FILE_HEADER.pack(
+        INSPECT_FILE_VERSION, offset, len(index_blob)
+    ))
+    for blob in blobs:
+        fp.write(blob)
+    fp.write(index_blob)
+
+
+def load_inspect_file(path):
+    """ Load a file created by "datasette inspect", in either JSON or the
+        binary format.
+    """
+    with open(path, "rb") as fp:
+        magic = fp.read(len(INSPECT_FILE_MAGIC))
+    if magic == INSPECT_FILE_MAGIC:
+        return InspectFile(path)
+    with open(path) as fp:
+        return json.load(fp)
+
+
+class InspectFile(Mapping):
+    """ Read-only view of a binary inspect file.
+
+        The file is memory-mapped and the data for each database is only
+        decoded the first time it is looked up.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(INSPECT_FILE_MAGIC)
+        version, index_offset, index_length = (
+            INSPECT_FILE_HEADER.unpack_from(self._mmap, start)
+        )
+        if version != INSPECT_FILE_VERSION:
+            raise ValueError(
+                "{} was created by a different version of Datasette - run "
+                '"datasette inspect" again to recreate it'.format(path)
+            )
+        self._index = OrderedDict(
+            (name, (offset, length))
+            for name, offset, length in InspectDecoder(
+                self._mmap[index_offset:index_offset + index_length]
+            ).decode()
+        )
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            offset, length = self._index[name]
+            self._databases[name] = InspectDecoder(
+                self._mmap[offset:offset + length]
+            ).decode()
+        return self._databases[name]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def inspect_cache_path(path):
+    " Path of the sidecar file used to cache the inspection of path. "
+    return path.with_name(".{}.datasette-inspect.json".format(path.name))
+
+
+def inspect_cache_key(
+    path,
+    database_metadata,
+    hash_strategy="sha256",
+    approximate_counts=False,
+    column_stats=False,
+    facet_size=None,
+):
+    """ Describe the current state of a database file.
+
+        A cached inspection is only reused if every part of this key matches,
+        including the SQLite header and any write-ahead log next to the file.
+    """
+    stat = path.stat()
+    with path.open("rb") as fp:
+        header = fp.read(SQLITE_HEADER_SIZE)
+    wal_path = path.with_name(path.name + "-wal")
+    wal = None
+    if wal_path.exists():
+        wal_stat = wal_path.stat()
+        wal = [wal_stat.st_size, wal_stat.st_mtime_ns]
+    return {
+        "datasette_version": __version__,
+        "hash_strategy": hash_strategy,
+        "approximate_counts": approximate_counts,
+        "column_stats": column_stats,
+        "facet_size": facet_size,
+        "path": str(path.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+        "header": header.hex(),
+        "wal": wal,
+        # Hidden tables and facets can be configured in metadata
+        "metadata": hashlib.sha256(
+            json.dumps(database_metadata, sort_keys=True).encode("utf8")
+        ).hexdigest(),
+    }
+
+
+def read_inspect_cache(path, key):
+    " Return the cached inspection of path, or None if it is missing or stale. "
+    try:
+        with inspect_cache_path(path).open() as fp:
+            cached = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached.get("info")
+
+
+def write_inspect_cache(path, key, info):
+    " Save an inspection of path, ignoring errors such as read-only directories. "
+    cache_path = inspect_cache_path(path)
+    tmp_path = cache_path.with_name("{}.{}".format(cache_path.name, os.getpid()))
+    try:
+        with tmp_path.open("w") as fp:
+            json.dump({"key": key, "info": info}, fp)
+        os.replace(str(tmp_path), str(cache_path))
+    except OSError:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+
+
 def inspect_views(conn):
     " List views in a database. "
     return [v[0] for v in conn.execute('select name from sqlite_master where type = "view"')]
@@ -36,64 +432,344 @@ def detect_label_column(column_names):
     return None
 
 
-def detect_primary_keys(conn, table):
-    " Figure out primary keys for a table. "
-    table_info_rows = [
-        row
-        for row in conn.execute(
-            'PRAGMA table_info("{}")'.format(table)
-        ).fetchall()
-        if row[-1]
-    ]
-    table_info_rows.sort(key=lambda row: row[-1])
-    return [str(r[1]) for r in table_info_rows]
+def primary_keys_from_columns(columns):
+    " Primary keys, in order, from a list of (column, pk) pairs. "
+    pk_columns = [column for column in columns if column[1]]
+    pk_columns.sort(key=lambda column: column[1])
+    return [str(column[0]) for column in pk_columns]
 
 
-def inspect_tables(conn, database_metadata):
-    " List tables and their row counts, excluding uninteresting tables. "
-    tables = {}
-    table_names = [
-        r["name"]
+def inspect_columns(conn, table_names, batch=True):
+    """ Return a dictionary of table => list of (column, pk) pairs.
+
+        If batch is True the columns of every table in the database are read
+        using a single query.
+    """
+    all_columns = None
+    if batch:
+        try:
+            all_columns = get_all_columns(conn)
+        except sqlite3.OperationalError:
+            # Table-valued pragma functions need SQLite 3.16 or higher
+            pass
+    if all_columns is None:
+        all_columns = {
+            table: [
+                (row[1], row[-1])
+                for row in conn.execute(
+                    "PRAGMA table_info({});".format(escape_sqlite(table))
+                ).fetchall()
+            ]
+            for table in table_names
+        }
+    return {table: all_columns.get(table, []) for table in table_names}
+
+
+def inspect_table_names(conn):
+    " List every table in a database. "
+    return [
+        r[0]
         for r in conn.execute(
-            'select * from sqlite_master where type="table"'
+            'select name from sqlite_master where type="table"'
         )
     ]
 
-    for table in table_names:
-        table_metadata = database_metadata.get("tables", {}).get(
-            table, {}
-        )
 
-        try:
-            count = conn.execute(
-                "select count(*) from {}".format(escape_sqlite(table))
-            ).fetchone()[0]
-        except sqlite3.OperationalError:
-            # This can happen when running against a FTS virtual table
-            # e.g. "select count(*) from some_fts;"
-            count = 0
+def inspect_count(conn, table):
+    " Count the rows in a table. "
+    try:
+        return conn.execute(
+            "select count(*) from {}".format(escape_sqlite(table))
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # This can happen when running against a FTS virtual table
+        # e.g. "select count(*) from some_fts;"
+        return 0
 
-        column_names = [
-            r[1]
-            for r in conn.execute(
-                "PRAGMA table_info({});".format(escape_sqlite(table))
-            ).fetchall()
+
+def inspect_approximate_count(conn, table):
+    """ Estimate the number of rows in a table without scanning it.
+
+        Uses the row counts recorded by ANALYZE in sqlite_stat1 if there are
+        any, otherwise the largest rowid in the table. Returns None if neither
+        is available.
+    """
+    try:
+        stats = conn.execute(
+            "select stat from sqlite_stat1 where tbl = ?", [table]
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # No sqlite_stat1 table - ANALYZE has never been run
+        stats = []
+    counts = [
+        int(stat[0].split()[0])
+        for stat in stats
+        if stat[0] and stat[0].split()[0].isdigit()
+    ]
+    if counts:
+        return max(counts)
+    try:
+        max_rowid = conn.execute(
+            "select max(rowid) from {}".format(escape_sqlite(table))
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID and some virtual tables have no rowid
+        return None
+    if not isinstance(max_rowid, int):
+        return None
+    return max(max_rowid, 0)
+
+
+def inspect_estimated_count(conn, table, from_sql, params):
+    """ Estimate the number of rows "select count(*) from_sql" would count,
+        without running it.
+
+        If the query plan looks rows up using equality constraints on an
+        index, the average number of rows per key recorded by ANALYZE in
+        sqlite_stat1 for that index is used. Returns None if there is no
+        such estimate.
+    """
+    try:
+        plan = [
+            row[-1] for row in conn.execute(
+                "explain query plan select count(*) {}".format(from_sql),
+                params,
+            )
         ]
+    except sqlite3.OperationalError:
+        return None
+    # Subqueries, such as full-text searches, make the plan impossible to
+    # estimate from
+    if len(plan) != 1:
+        return None
+    match = EXPLAIN_SEARCH_RE.match(plan[0])
+    if match is None or match.group(1) != table:
+        return None
+    index, constraints = match.group(2), match.group(3)
+    if index == "INTEGER PRIMARY KEY":
+        return 1 if constraints == "rowid=?" else None
+    equalities = 0
+    for constraint in constraints.split(" AND "):
+        if not constraint.endswith("=?") or constraint[-3] in "<>!":
+            break
+        equalities += 1
+    if not equalities:
+        return None
+    try:
+        stat = conn.execute(
+            "select stat from sqlite_stat1 where tbl = ? and idx = ?",
+            [table, index.split()[-1]],
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # No sqlite_stat1 table - ANALYZE has never been run
+        return None
+    if stat is None or not stat[0]:
+        return None
+    parts = stat[0].split()
+    if len(parts) <= equalities or not parts[equalities].isdigit():
+        return None
+    return int(parts[equalities])
+
+
+def inspect_column_stats(conn, table, column_names):
+    """ Calculate statistics for each column in a table.
+
+        Returns a dictionary of column => {nulls, distinct, min, max, top},
+        where top lists the COLUMN_STATS_TOP_K most common values and their
+        counts. BLOB values are left out.
+    """
+    table_sql = escape_sqlite(table)
+    stats = {}
+    try:
+        # Up to COLUMN_STATS_BATCH_SIZE columns are summarized by each scan
+        for start in range(0, len(column_names), COLUMN_STATS_BATCH_SIZE):
+            batch = column_names[start:start + COLUMN_STATS_BATCH_SIZE]
+            row = tuple(conn.execute("select count(*), {} from {}".format(
+                ", ".join(
+                    "count({column}), min({column}), max({column})".format(
+                        column=escape_sqlite(column)
+                    )
+                    for column in batch
+                ),
+                table_sql,
+            )).fetchone())
+            for i, column in enumerate(batch):
+                not_null, min_value, max_value = row[1 + i * 3:4 + i * 3]
+                stats[column] = {
+                    "nulls": row[0] - not_null,
+                    "min": None if isinstance(min_value, bytes) else min_value,
+                    "max": None if isinstance(max_value, bytes) else max_value,
+                }
+        for column in column_names:
+            column_sql = escape_sqlite(column)
+            stats[column]["distinct"] = conn.execute("""
+                select count(*) from (
+                    select 1 from {table} where {column} is not null
+                    group by {column}
+                )
+            """.format(table=table_sql, column=column_sql)).fetchone()[0]
+            stats[column]["top"] = [
+                [value, count]
+                for value, count in conn.execute("""
+                    select {column}, count(*) from {table}
+                    where {column} is not null
+                    group by {column} order by count(*) desc, {column}
+                    limit {limit}
+                """.format(
+                    table=table_sql,
+                    column=column_sql,
+                    limit=COLUMN_STATS_TOP_K,
+                ))
+                if not isinstance(value, bytes)
+            ]
+    except sqlite3.OperationalError:
+        # For example an FTS virtual table with a missing module
+        return {}
+    return stats
+
+
+def inspect_facet_counts(conn, table, columns, facet_size):
+    """ Precompute facet counts for some of the columns of a table.
+
+        Returns a dictionary with the facet_size the counts were calculated
+        for, the counts for each column across the whole table and, in
+        filtered, the counts for each column once a single value of one of
+        the other columns has been selected - keyed by that column and by the
+        value as it would appear in the querystring. Each list of counts holds
+        up to facet_size + 1 [value, count] pairs, like the facet queries.
+        Columns containing BLOB values are left out.
+    """
+    limit = facet_size + 1
+    table_sql = escape_sqlite(table)
+    counts = {}
+    filtered = {}
+    try:
+        for column in columns:
+            rows = conn.execute("""
+                select {column}, count(*) from {table}
+                where {column} is not null
+                group by {column} order by count(*) desc, {column}
+                limit {limit}
+            """.format(
+                table=table_sql, column=escape_sqlite(column), limit=limit
+            )).fetchall()
+            if not any(isinstance(value, bytes) for value, _ in rows):
+                counts[column] = [[value, count] for value, count in rows]
+        for column, rows in counts.items():
+            # Only values that a ?column=value filter would match can be
+            # looked up by the querystring value. The comparison applies the
+            # column's affinity to each querystring value, just as the
+            # filter's "column = ?" does.
+            querystring_values = list({str(value) for value, _ in rows})
+            matched = set()
+            if querystring_values:
+                matched = {row[0] for row in conn.execute("""
+                    with querystring_values(value) as (values {values})
+                    select distinct querystring_values.value
+                    from {table} join querystring_values
+                    on {column} = querystring_values.value
+                """.format(
+                    values=", ".join("(?)" for _ in querystring_values),
+                    table=table_sql,
+                    column=escape_sqlite(column),
+                ), querystring_values)}
+            selections = {
+                str(value): {column: [[value, count]]}
+                for value, count in rows
+                if str(value) in matched
+            }
+            for other in counts:
+                if other == column:
+                    continue
+                for selection in selections.values():
+                    selection[other] = []
+                for value, other_value, count in conn.execute("""
+                    select {column}, {other}, count(*) from {table}
+                    where {column} is not null and {other} is not null
+                    group by {column}, {other}
+                    order by {column}, count(*) desc, {other}
+                """.format(
+                    table=table_sql,
+                    column=escape_sqlite(column),
+                    other=escape_sqlite(other),
+                )):
+                    selection = selections.get(str(value))
+                    if selection is None or selection[other] is None:
+                        continue
+                    if isinstance(other_value, bytes):
+                        selection[other] = None
+                    elif len(selection[other]) < limit:
+                        selection[other].append([other_value, count])
+                for selection in selections.values():
+                    if selection[other] is None:
+                        del selection[other]
+            filtered[column] = selections
+    except sqlite3.OperationalError:
+        # For example a column listed in metadata that does not exist
+        return None
+    return {
+        "size": facet_size,
+        "counts": counts,
+        "filtered": filtered,
+    }
+
+
+def inspect_count_in_process(path, table, sqlite_extensions):
+    """ Count the rows in a table, using a new connection.
+
+        Used to count tables in parallel in a process pool.
+    """
+    conn = sqlite3.connect("file:{}?immutable=1".format(path), uri=True)
+    try:
+        if sqlite_extensions:
+            conn.enable_load_extension(True)
+            for extension in sqlite_extensions:
+                conn.execute("SELECT load_extension('{}')".format(extension))
+        return inspect_count(conn, table)
+    finally:
+        conn.close()
 
-        tables[table] = {
-            "name": table,
-            "columns": column_names,
-            "primary_keys": detect_primary_keys(conn, table),
-            "count": count,
-            "label_column": detect_label_column(column_names),
-            "hidden": table_metadata.get("hidden") or False,
-            "fts_table": detect_fts(conn, table),
-        }
 
-    foreign_keys = get_all_foreign_keys(conn)
-    for table, info in foreign_keys.items():
-        tables[table]["foreign_keys"] = info
+def inspect_tables(
+    conn,
+    database_metadata,
+    counts=None,
+    approximate=False,
+    column_stats=False,
+    facet_size=None,
+):
+    """ List tables and their row counts, excluding uninteresting tables.
 
+        counts can be a dictionary of row counts that have already been
+        calculated for every table. If approximate is True, counts are
+        estimated where possible and those tables are marked with
+        count_approximate. If column_stats is True, statistics for every
+        column are included as column_stats. If facet_size is set, the
+        facets configured in metadata are precomputed as facet_counts.
+    """
+    table_names = inspect_table_names(conn)
+    all_columns = inspect_columns(conn, table_names)
+    inspector = TableInspector(
+        conn,
+        table_names,
+        database_metadata,
+        approximate,
+        column_stats,
+        facet_size,
+    )
+    return {
+        table: inspector.inspect_table(
+            conn,
+            table,
+            columns=all_columns[table],
+            count=counts[table] if counts is not None else None,
+        )
+        for table in table_names
+    }
+
+
+def inspect_hidden_tables(conn):
+    " List tables, or prefixes of table names, that should be hidden. "
     # Mark tables 'hidden' if they relate to FTS virtual tables
     hidden_tables = [
         r["name"]
@@ -128,11 +804,169 @@ def inspect_tables(conn, database_metadata):
                 """
             )
         ]
+    return hidden_tables
+
+
+class TableInspector:
+    """ Inspects the tables in a database one at a time.
+
+        Foreign keys, FTS tables and hidden tables are found by looking at
+        the whole database, so they are worked out once when the inspector
+        is created.
+    """
+
+    def __init__(
+        self,
+        conn,
+        table_names,
+        database_metadata,
+        approximate=False,
+        column_stats=False,
+        facet_size=None,
+    ):
+        self.database_metadata = database_metadata
+        self.approximate = approximate
+        self.column_stats = column_stats
+        self.facet_size = facet_size
+        self.foreign_keys = get_all_foreign_keys(conn)
+        self.fts_tables = detect_all_fts(conn, table_names)
+        self.hidden_tables = inspect_hidden_tables(conn)
+        self.indexed_columns = get_all_indexed_columns(conn)
 
-    for t in tables.keys():
-        for hidden_table in hidden_tables:
-            if t == hidden_table or t.startswith(hidden_table):
-                tables[t]["hidden"] = True
-                continue
+    def inspect_table(self, conn, table, columns=None, count=None):
+        if columns is None:
+            columns = inspect_columns(conn, [table], batch=False)[table]
+        column_names = [column for column, _ in columns]
+        table_metadata = self.database_metadata.get("tables", {}).get(
+            table, {}
+        )
+
+        approximate_count = False
+        if count is None and self.approximate:
+            count = inspect_approximate_count(conn, table)
+            approximate_count = count is not None
+        if count is None:
+            count = inspect_count(conn, table)
+
+        info = {
+            "name": table,
+            "columns": column_names,
+            "primary_keys": primary_keys_from_columns(columns),
+            "count": count,
+            "label_column": detect_label_column(column_names),
+            "hidden": table_metadata.get("hidden") or False,
+            "fts_table": self.fts_tables.get(table),
+            "indexed_columns": self.indexed_columns.get(table, []),
+        }
+        if approximate_count:
+            info["count_approximate"] = True
+        if table in self.foreign_keys:
+            info["foreign_keys"] = self.foreign_keys[table]
+        if self.column_stats:
+            info["column_stats"] = inspect_column_stats(conn, table, column_names)
+        facets = [
+            column for column in table_metadata.get("facets", [])
+            if column in column_names
+        ]
+        if self.facet_size and facets:
+            facet_counts = inspect_facet_counts(
+                conn, table, facets, self.facet_size
+            )
+            if facet_counts is not None:
+                info["facet_counts"] = facet_counts
+        for hidden_table in self.hidden_tables:
+            if table == hidden_table or table.startswith(hidden_table):
+                info["hidden"] = True
+        return info
+
+
+class LazyTables(Mapping):
+    """ Dictionary of table name => inspect data that only inspects a table
+        the first time it is looked up.
+
+        connect is a function returning a new connection to the database.
+    """
+
+    def __init__(
+        self,
+        table_names,
+        connect,
+        database_metadata,
+        approximate=False,
+        column_stats=False,
+        facet_size=None,
+    ):
+        self.table_names = table_names
+        self.connect = connect
+        self.database_metadata = database_metadata
+        self.approximate = approximate
+        self.column_stats = column_stats
+        self.facet_size = facet_size
+        self._table_names = set(table_names)
+        self._tables = {}
+        self._inspector = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, table):
+        if table not in self._table_names:
+            raise KeyError(table)
+        if table in self._tables:
+            return self._tables[table]
+        with self._lock:
+            if table not in self._tables:
+                conn = self.connect()
+                try:
+                    if self._inspector is None:
+                        self._inspector = TableInspector(
+                            conn,
+                            self.table_names,
+                            self.database_metadata,
+                            self.approximate,
+                            self.column_stats,
+                            self.facet_size,
+                        )
+                    self._tables[table] = self._inspector.inspect_table(
+                        conn, table
+                    )
+                finally:
+                    conn.close()
+            return self._tables[table]
+
+    def __contains__(self, table):
+        return table in self._table_names
+
+    def __iter__(self):
+        return iter(self.table_names)
+
+    def __len__(self):
+        return len(self.table_names)
+
+    @property
+    def inspected(self):
+        " Number of tables that have been inspected so far. "
+        return len(self._tables)
+
+    def uninspected(self, tables=None):
+        " Names of tables (default: all of them) not inspected yet. "
+        if tables is None:
+            tables = self.table_names
+        return [
+            table for table in tables
+            if table in self._table_names and table not in self._tables
+        ]
 
-    return tables
+    def inspect_with_related(self, tables):
+        """ Inspect tables, plus the tables their outgoing foreign keys point
+            to and their FTS tables - a table page needs all of these.
+            Blocks, so should be called from a worker thread.
+        """
+        for table in tables:
+            info = self[table]
+            related = [
+                fk["other_table"] for fk in info["foreign_keys"]["outgoing"]
+            ]
+            if info.get("fts_table"):
+                related.append(info["fts_table"])
+            for other_table in related:
+                if other_table in self:
+                    self[other_table]
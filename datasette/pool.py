@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+# DatabaseErrors that are caused by a query rather than a broken connection
+QUERY_ERRORS = (
+    sqlite3.OperationalError,
+    sqlite3.ProgrammingError,
+    sqlite3.IntegrityError,
+    sqlite3.DataError,
+    sqlite3.NotSupportedError,
+)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of SQLite connections to a single database.
+
+    connect is a function that returns a new, fully prepared connection.
+    Connections are handed out to one thread at a time and returned to the
+    pool afterwards. A connection that raises a DatabaseError suggesting the
+    database is corrupt, such as "database disk image is malformed", is
+    closed and replaced. Errors caused by the query - bad SQL, interrupted
+    queries, misused cursors or constraint violations - keep it.
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        # Used as a stack, so the most recently used (and best cached)
+        # connection is the one that gets handed out next
+        self._idle = []
+        # Notified whenever a connection is returned, or a slot is freed up
+        # by a discarded connection or one that failed to open
+        self._condition = threading.Condition()
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.discarded = 0
+        self.last_error = None
+
+    def warm(self):
+        "Open every connection in the pool ahead of time"
+        while True:
+            with self._condition:
+                if self.open >= self.size:
+                    return
+                self.open += 1
+            conn = self._new_connection()
+            with self._condition:
+                self._idle.append(conn)
+                self._condition.notify()
+
+    def _new_connection(self):
+        try:
+            return self.connect()
+        except Exception as e:
+            with self._condition:
+                self.open -= 1
+                self.last_error = str(e)
+                self._condition.notify()
+            raise
+
+    def acquire(self):
+        conn = None
+        with self._condition:
+            waited = False
+            while not self._idle and self.open >= self.size:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._condition.wait()
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                # Open a new connection, or replace one that was discarded
+                self.open += 1
+        if conn is None:
+            conn = self._new_connection()
+        with self._condition:
+            self.in_use += 1
+            self.checkouts += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        with self._condition:
+            self.in_use -= 1
+            if discard:
+                self.open -= 1
+                self.discarded += 1
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+        if discard:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except QUERY_ERRORS:
+            raise
+        except sqlite3.DatabaseError as e:
+            discard = True
+            self.last_error = str(e)
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self.open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "open": self.open,
+            "in_use": self.in_use,
+            "idle": self.open - self.in_use,
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "discarded": self.discarded,
+            "last_error": self.last_error,
+        }
@@ -1,9 +1,11 @@
 from jinja2 import Environment
 
 from contextlib import contextmanager
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from operator import itemgetter
 import base64
 import hashlib
+import heapq
 import imp
 import json
 import os
@@ -130,6 +132,91 @@ class CustomJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# Number of rows json_chunks() encodes into each chunk
+JSON_CHUNK_ROWS = 100
+
+
+def encode_json_float(value):
+    "Encode a float the way json.dumps() does, NaN and infinities included"
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "Infinity"
+    if value == float("-inf"):
+        return "-Infinity"
+    return float.__repr__(value)
+
+
+def json_chunks(data, columns=None, rows_as_objects=False, chunk_rows=JSON_CHUNK_ROWS):
+    """
+    Encode data as JSON, yielding the output a chunk of rows at a time
+    instead of building it as a single string.
+
+    data is either a list of rows or a dictionary whose "rows" key is one;
+    anything else is encoded in one go. If rows_as_objects is True each row
+    is written as an object keyed by columns, without building a dictionary
+    per row, unless columns has repeated names. Cells that are str, int, float or None are encoded directly;
+    anything else goes through CustomJSONEncoder.
+    """
+    encoder = CustomJSONEncoder()
+    encode_str = json.encoder.encode_basestring_ascii
+    fast_encoders = {
+        str: encode_str,
+        int: int.__repr__,
+        float: encode_json_float,
+        type(None): lambda value: "null",
+    }
+
+    def encode_cell(value):
+        fast_encoder = fast_encoders.get(type(value))
+        if fast_encoder is not None:
+            return fast_encoder(value)
+        return encoder.encode(value)
+
+    if rows_as_objects and columns and len(set(columns)) != len(columns):
+        # Repeated column names, so build dictionaries in which the last
+        # value for each name wins, as dict(zip(columns, row)) does
+        def encode_row(row):
+            return encoder.encode(dict(zip(columns, row)))
+    elif rows_as_objects and columns:
+        keys = [encode_str(column) + ": " for column in columns]
+
+        def encode_row(row):
+            return "{" + ", ".join(
+                key + encode_cell(value) for key, value in zip(keys, row)
+            ) + "}"
+    else:
+        def encode_row(row):
+            if isinstance(row, (list, tuple, sqlite3.Row)):
+                return "[" + ", ".join(encode_cell(value) for value in row) + "]"
+            return encoder.encode(row)
+
+    def encode_rows(rows):
+        if not rows:
+            yield "[]"
+            return
+        for i in range(0, len(rows), chunk_rows):
+            yield ("[" if i == 0 else ", ") + ", ".join(
+                encode_row(row) for row in rows[i:i + chunk_rows]
+            )
+        yield "]"
+
+    if isinstance(data, list):
+        yield from encode_rows(data)
+    elif isinstance(data, dict) and isinstance(data.get("rows"), list):
+        # Everything but the rows is small enough to encode in one go
+        for i, (key, value) in enumerate(data.items()):
+            prefix = ("{" if i == 0 else ", ") + encode_str(str(key)) + ": "
+            if key == "rows":
+                yield prefix
+                yield from encode_rows(value)
+            else:
+                yield prefix + encoder.encode(value)
+        yield "}"
+    else:
+        yield encoder.encode(data)
+
+
 @contextmanager
 def sqlite_timelimit(conn, ms):
     deadline = time.time() + (ms / 1000)
@@ -468,6 +555,26 @@ def temporary_heroku_directory(
         os.chdir(saved_cwd)
 
 
+def get_all_columns(conn):
+    """
+    Return a dictionary mapping every table to a list of (column, pk) pairs,
+    where pk is the column's position in the primary key or 0. Uses a single
+    query against the pragma_table_info() table-valued function.
+    """
+    table_to_columns = OrderedDict()
+    for table, column, pk in conn.execute(
+        """
+            select sqlite_master.name, table_info.name, table_info.pk
+            from sqlite_master
+            join pragma_table_info(sqlite_master.name) as table_info
+            where sqlite_master.type = 'table'
+            order by sqlite_master.rowid, table_info.cid
+        """
+    ):
+        table_to_columns.setdefault(table, []).append((column, pk))
+    return table_to_columns
+
+
 def get_all_foreign_keys(conn):
     tables = [r[0] for r in conn.execute('select name from sqlite_master where type="table"')]
     table_to_foreign_keys = {}
@@ -476,31 +583,184 @@ def get_all_foreign_keys(conn):
             'incoming': [],
             'outgoing': [],
         }
-    for table in tables:
-        infos = conn.execute(
-            'PRAGMA foreign_key_list([{}])'.format(table)
+    try:
+        # pragma_foreign_key_list() needs SQLite 3.16 or higher
+        # 'table' has to be single quoted here, as "table" is also the name
+        # of one of the columns returned by pragma_foreign_key_list()
+        rows = conn.execute(
+            """
+                select sqlite_master.name, foreign_key_list.*
+                from sqlite_master
+                join pragma_foreign_key_list(sqlite_master.name)
+                    as foreign_key_list
+                where sqlite_master.type = 'table'
+                order by sqlite_master.rowid
+            """
         ).fetchall()
-        for info in infos:
-            if info is not None:
-                id, seq, table_name, from_, to_, on_update, on_delete, match = info
-                if table_name not in table_to_foreign_keys:
-                    # Weird edge case where something refers to a table that does
-                    # not actually exist
-                    continue
-                table_to_foreign_keys[table_name]['incoming'].append({
-                    'other_table': table,
-                    'column': to_,
-                    'other_column': from_
-                })
-                table_to_foreign_keys[table]['outgoing'].append({
-                    'other_table': table_name,
-                    'column': from_,
-                    'other_column': to_
-                })
+    except sqlite3.OperationalError:
+        rows = [
+            (table,) + tuple(info)
+            for table in tables
+            for info in conn.execute(
+                'PRAGMA foreign_key_list([{}])'.format(table)
+            ).fetchall()
+        ]
+    for row in rows:
+        table, id, seq, table_name, from_, to_, on_update, on_delete, match = row
+        if table_name not in table_to_foreign_keys:
+            # Weird edge case where something refers to a table that does
+            # not actually exist
+            continue
+        table_to_foreign_keys[table_name]['incoming'].append({
+            'other_table': table,
+            'column': to_,
+            'other_column': from_
+        })
+        table_to_foreign_keys[table]['outgoing'].append({
+            'other_table': table_name,
+            'column': from_,
+            'other_column': to_
+        })
 
     return table_to_foreign_keys
 
 
+def get_all_indexed_columns(conn):
+    """
+    Return a dictionary mapping tables to the columns that are the first
+    column of a (non-partial) index on that table, so filtering, grouping or
+    sorting by them does not need a full table scan.
+    """
+    tables = [r[0] for r in conn.execute('select name from sqlite_master where type="table"')]
+    table_to_indexed_columns = {}
+    try:
+        # pragma_index_list() needs SQLite 3.16 or higher
+        rows = conn.execute(
+            """
+                select sqlite_master.name, index_info.name
+                from sqlite_master
+                join pragma_index_list(sqlite_master.name) as index_list
+                join pragma_index_info(index_list.name) as index_info
+                where sqlite_master.type = 'table'
+                and not index_list.partial and index_info.seqno = 0
+            """
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+        for table in tables:
+            for index in conn.execute(
+                'PRAGMA index_list([{}])'.format(table)
+            ).fetchall():
+                if len(index) > 4 and index[4]:
+                    # Partial index
+                    continue
+                rows.extend(
+                    (table, info[2]) for info in conn.execute(
+                        'PRAGMA index_info([{}])'.format(index[1])
+                    ).fetchall()
+                    if info[0] == 0
+                )
+    for table, column in rows:
+        # Indexes on expressions have no column name
+        if column is not None:
+            columns = table_to_indexed_columns.setdefault(table, [])
+            if column not in columns:
+                columns.append(column)
+    return table_to_indexed_columns
+
+
+def sqlite_sort_key(value):
+    "Sort key that orders Python values the way SQLite orders them"
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, bytes(value))
+
+
+def count_facet_values(conn, columns, from_sql, params, limit, batch_size=1000):
+    """
+    Count how often each non-null value appears in each of columns using a
+    single scan of "select columns from_sql". Returns a dictionary of
+    column => list of (value, count) pairs for the limit most common values,
+    ordered by count and then by value - the same results as a
+    "group by column order by count desc, column limit limit" query for
+    each column.
+    """
+    counters = [Counter() for _ in columns]
+    cursor = conn.execute(
+        "select {} {}".format(
+            ", ".join(escape_sqlite(column) for column in columns), from_sql
+        ),
+        params,
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        # map() and itemgetter() keep the counting loop in C
+        for i, counter in enumerate(counters):
+            counter.update(map(itemgetter(i), rows))
+    cursor.close()
+    facet_counts = {}
+    for column, counter in zip(columns, counters):
+        counter.pop(None, None)
+        facet_counts[column] = heapq.nsmallest(
+            limit,
+            counter.items(),
+            key=lambda item: (-item[1], sqlite_sort_key(item[0])),
+        )
+    return facet_counts
+
+
+def count_distinct_values(
+    conn, columns, from_sql, params, limit, sample_size=None, batch_size=1000
+):
+    """
+    Count the distinct non-null values in each of columns using a single
+    scan of "select columns from_sql", or of its first sample_size rows.
+    Returns a dictionary of column => count.
+
+    A column stops being tracked once it has more than limit distinct values
+    and is reported as having limit + 1. The scan ends early if that happens
+    to every column. If the scan is interrupted, by a time limit for
+    example, only those columns are included.
+    """
+    counts = {}
+    tracking = [(i, column, set()) for i, column in enumerate(columns)]
+    sql = "select {} {}".format(
+        ", ".join(escape_sqlite(column) for column in columns), from_sql
+    )
+    if sample_size:
+        sql = "select * from ({}) limit {}".format(sql, int(sample_size))
+    cursor = conn.execute(sql, params)
+    try:
+        while tracking:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            still_tracking = []
+            for i, column, values in tracking:
+                values.update(row[i] for row in rows)
+                values.discard(None)
+                if len(values) > limit:
+                    counts[column] = limit + 1
+                else:
+                    still_tracking.append((i, column, values))
+            tracking = still_tracking
+    except sqlite3.OperationalError as e:
+        if e.args != ('interrupted',):
+            raise
+        return counts
+    finally:
+        cursor.close()
+    for i, column, values in tracking:
+        counts[column] = len(values)
+    return counts
+
+
 def detect_spatialite(conn):
     rows = conn.execute('select 1 from sqlite_master where tbl_name = "geometry_columns"').fetchall()
     return len(rows) > 0
@@ -515,6 +775,29 @@ def detect_fts(conn, table):
         return rows[0][0]
 
 
+def detect_all_fts(conn, tables):
+    """
+    Like detect_fts() but for every table in tables at once, returning a
+    dictionary of table => FTS table or None
+    """
+    fts_tables = conn.execute(
+        r'''
+            select name, tbl_name, sql from sqlite_master
+                where rootpage = 0
+                and sql like '%VIRTUAL TABLE%USING FTS%'
+        '''
+    ).fetchall()
+    table_to_fts = {}
+    for table in tables:
+        content = 'content="{}"'.format(table).lower()
+        table_to_fts[table] = next((
+            name
+            for name, tbl_name, sql in fts_tables
+            if tbl_name == table or content in sql.lower()
+        ), None)
+    return table_to_fts
+
+
 def detect_fts_sql(table):
     return r'''
         select name from sqlite_master
@@ -791,7 +1074,7 @@ def get_plugins(pm):
     return plugins
 
 
-FORMATS = ('csv', 'json', 'jsono')
+FORMATS = ('csv', 'json', 'jsono', 'ndjson', 'arrow')
 
 
 def resolve_table_and_format(table_and_format, table_exists):
@@ -1,6 +1,8 @@
 import asyncio
 import csv
+import io
 import json
+import logging
 import re
 import sqlite3
 import time
@@ -11,12 +13,13 @@ from sanic import response
 from sanic.exceptions import NotFound
 from sanic.views import HTTPMethodView
 
-from datasette import __version__
+from datasette import __version__, arrow
 from datasette.utils import (
     CustomJSONEncoder,
     InterruptedError,
     InvalidSql,
     LimitedWriter,
+    json_chunks,
     path_from_row_pks,
     path_with_added_args,
     path_with_format,
@@ -26,8 +29,19 @@ from datasette.utils import (
 
 ureg = pint.UnitRegistry()
 
+logger = logging.getLogger(__name__)
+
 HASH_LENGTH = 7
 
+# Seconds between checks for a client that has disconnected mid-request
+DISCONNECT_POLL_INTERVAL = 0.1
+# Streamed responses pause while the client has this many bytes left to
+# receive, checking again every STREAM_WRITE_POLL_INTERVAL seconds
+STREAM_WRITE_BUFFER_SIZE = 1024 * 1024
+STREAM_WRITE_POLL_INTERVAL = 0.01
+# JSON responses larger than this are streamed to the client
+JSON_STREAM_MIN_BYTES = 64 * 1024
+
 
 class DatasetteError(Exception):
 
@@ -39,6 +53,155 @@ class DatasetteError(Exception):
         self.messagge_is_html = messagge_is_html
 
 
+async def cancel_on_disconnect(transport, coroutine):
+    """
+    Await coroutine, cancelling it if the client connection using transport
+    is closed before it completes - any SQL queries it is waiting on are then
+    interrupted. Returns None if the client disconnected.
+    """
+    task = asyncio.ensure_future(coroutine)
+    if transport is None:
+        return await task
+    loop = asyncio.get_event_loop()
+    disconnected = False
+
+    def check_connection():
+        nonlocal disconnected
+        if task.done():
+            return
+        if transport.is_closing():
+            disconnected = True
+            task.cancel()
+        else:
+            loop.call_later(DISCONNECT_POLL_INTERVAL, check_connection)
+
+    loop.call_later(DISCONNECT_POLL_INTERVAL, check_connection)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if disconnected:
+            return None
+        raise
+
+
+def close_on_disconnect(transport, stream):
+    """
+    Close stream once the client connection using transport is closed. This
+    happens even if the response that was going to read the stream never
+    starts, so its worker thread is not left waiting for space.
+    """
+    if transport is None:
+        return
+    loop = asyncio.get_event_loop()
+
+    def check_connection():
+        if stream.closed:
+            return
+        if transport.is_closing():
+            stream.close()
+        else:
+            loop.call_later(DISCONNECT_POLL_INTERVAL, check_connection)
+
+    loop.call_later(DISCONNECT_POLL_INTERVAL, check_connection)
+
+
+async def wait_for_client(transport):
+    """
+    Wait while more than STREAM_WRITE_BUFFER_SIZE bytes of a streamed
+    response are still waiting to be sent to the client.
+    """
+    while (
+        transport is not None and
+        not transport.is_closing() and
+        transport.get_write_buffer_size() > STREAM_WRITE_BUFFER_SIZE
+    ):
+        await asyncio.sleep(STREAM_WRITE_POLL_INTERVAL)
+
+
+class ExportStream:
+    """
+    Every row of a table or query, for the streaming export formats.
+
+    The rows are read by a single RowStream cursor. Foreign key columns the
+    request asked for labels for are expanded into {"value": ..., "label":
+    ...} dicts, one batch of rows at a time.
+    """
+
+    def __init__(self, view, name, data, rows):
+        self.view = view
+        self.name = name
+        self.table = data.get("table")
+        self.rows = rows
+        self.columns = [r[0] for r in rows.description]
+        self.expanded_columns = [
+            column for column in data["columns_to_expand"]
+            if column in self.columns
+        ]
+
+    async def fetch(self):
+        "Return the next batch of rows, or None once they have all been read"
+        batch = await self.rows.fetch()
+        if batch is None or not self.expanded_columns:
+            return batch
+        labels = {}
+        for column in self.expanded_columns:
+            index = self.columns.index(column)
+            labels.update(await self.view.expand_foreign_keys(
+                self.name, self.table, column, [row[index] for row in batch]
+            ))
+        return [
+            [
+                {"value": value, "label": labels[(column, value)]}
+                if (column, value) in labels else value
+                for column, value in zip(self.columns, row)
+            ]
+            for row in batch
+        ]
+
+    async def write(
+        self, r, encode, max_mb, prefix="", end=None, error_text=None
+    ):
+        """
+        Write prefix and then every batch of rows, converted to a string or
+        bytes by encode, to the streamed response r - followed by the result
+        of calling end, if provided, once every row has been written. Stops
+        early if the client disconnects.
+
+        The headers have already been sent by the time an error can happen,
+        so if error_text is provided the response ends with error_text(e).
+        Otherwise the connection is aborted, so the client sees an
+        incomplete response instead of one that looks complete.
+        """
+        writer = LimitedWriter(r, max_mb)
+        try:
+            if prefix:
+                writer.write(prefix)
+            while True:
+                batch = await cancel_on_disconnect(r.transport, self.fetch())
+                if batch is None:
+                    break
+                chunk = encode(batch)
+                # An empty chunk would end the chunked response
+                if chunk:
+                    writer.write(chunk)
+                await wait_for_client(r.transport)
+            if end is not None:
+                writer.write(end())
+        except Exception as e:
+            logger.warning(
+                "Streaming export from %s failed: %s", self.name, e
+            )
+            if error_text is not None:
+                r.write(error_text(e))
+            elif r.transport is not None:
+                r.transport.abort()
+        finally:
+            self.close()
+
+    def close(self):
+        self.rows.close()
+
+
 class RenderMixin(HTTPMethodView):
 
     def render(self, templates, **context):
@@ -68,7 +231,6 @@ class BaseView(RenderMixin):
         self.ds = datasette
         self.files = datasette.files
         self.jinja_env = datasette.jinja_env
-        self.executor = datasette.executor
         self.page_size = datasette.page_size
         self.max_returned_rows = datasette.max_returned_rows
 
@@ -148,7 +310,50 @@ class BaseView(RenderMixin):
         if should_redirect:
             return self.redirect(request, should_redirect)
 
-        return await self.view_get(request, name, hash, **kwargs)
+        r = await cancel_on_disconnect(
+            request.transport, self.view_get(request, name, hash, **kwargs)
+        )
+        if r is None:
+            # Nobody is listening, but Sanic still expects a response
+            r = response.text("Client closed request", status=499)
+        return r
+
+    async def export_stream(self, request, name, hash, **kwargs):
+        """
+        Start reading every row of the table or query for a streaming export
+        format, returning an ExportStream - or an HTTPResponse, for example
+        if the request needs to be redirected.
+        """
+        custom_time_limit = None
+        if request.raw_args.get("_timelimit"):
+            custom_time_limit = int(request.raw_args["_timelimit"])
+        try:
+            response_or_template_contexts = await self.data(
+                request, name, hash, _stream=True, **kwargs
+            )
+            if isinstance(response_or_template_contexts, response.HTTPResponse):
+                return response_or_template_contexts
+            data = response_or_template_contexts[0]
+            if "sql" not in data:
+                raise DatasetteError(
+                    "Streaming is only available for tables and queries",
+                    status=400,
+                )
+            rows = await self.ds.execute_stream(
+                name,
+                data["sql"],
+                data["params"],
+                custom_time_limit=custom_time_limit,
+                workload="export",
+            )
+            close_on_disconnect(request.transport, rows)
+        except InterruptedError:
+            raise DatasetteError(
+                "SQL query took too long", title="SQL Interrupted", status=400
+            )
+        except (sqlite3.OperationalError, InvalidSql) as e:
+            raise DatasetteError(str(e), title="Invalid SQL", status=400)
+        return ExportStream(self, name, data, rows)
 
     async def as_csv(self, request, name, hash, **kwargs):
         stream = request.args.get("_stream")
@@ -160,71 +365,84 @@ class BaseView(RenderMixin):
                 raise DatasetteError(
                     "_next not allowed for CSV streaming", status=400
                 )
-            kwargs["_size"] = "max"
-        # Fetch the first page
-        try:
-            response_or_template_contexts = await self.data(
-                request, name, hash, **kwargs
-            )
-            if isinstance(response_or_template_contexts, response.HTTPResponse):
-                return response_or_template_contexts
-            else:
-                data, extra_template_data, templates = response_or_template_contexts
-        except (sqlite3.OperationalError, InvalidSql) as e:
-            raise DatasetteError(str(e), title="Invalid SQL", status=400)
-
-        except (sqlite3.OperationalError) as e:
-            raise DatasetteError(str(e))
-
-        except DatasetteError:
-            raise
+            export = await self.export_stream(request, name, hash, **kwargs)
+            if isinstance(export, response.HTTPResponse):
+                return export
+            columns = export.columns
+            expanded_columns = export.expanded_columns
+            rows = None
+        else:
+            # Just the first page
+            try:
+                response_or_template_contexts = await self.data(
+                    request, name, hash, **kwargs
+                )
+                if isinstance(response_or_template_contexts, response.HTTPResponse):
+                    return response_or_template_contexts
+                else:
+                    data, extra_template_data, templates = response_or_template_contexts
+            except (sqlite3.OperationalError, InvalidSql) as e:
+                raise DatasetteError(str(e), title="Invalid SQL", status=400)
+
+            except (sqlite3.OperationalError) as e:
+                raise DatasetteError(str(e))
+
+            except DatasetteError:
+                raise
+            columns = data["columns"]
+            expanded_columns = data.get("expanded_columns") or []
+            rows = data["rows"]
 
         # Convert rows and columns to CSV
-        headings = data["columns"]
+        headings = columns
         # if there are expanded_columns we need to add additional headings
-        expanded_columns = set(data.get("expanded_columns") or [])
+        expanded_columns = set(expanded_columns)
         if expanded_columns:
             headings = []
-            for column in data["columns"]:
+            for column in columns:
                 headings.append(column)
                 if column in expanded_columns:
                     headings.append("{}_label".format(column))
 
-        async def stream_fn(r):
-            nonlocal data
-            writer = csv.writer(LimitedWriter(r, self.ds.config["max_csv_mb"]))
-            first = True
-            next = None
-            while first or (next and stream):
-                try:
-                    if next:
-                        kwargs["_next"] = next
-                    if not first:
-                        data, extra_template_data, templates = await self.data(
-                            request, name, hash, **kwargs
-                        )
-                    if first:
-                        writer.writerow(headings)
-                        first = False
-                    next = data.get("next")
-                    for row in data["rows"]:
-                        if not expanded_columns:
-                            # Simple path
-                            writer.writerow(row)
+        def csv_rows(rows, expand=True):
+            # Writes a whole batch of rows as a single chunk
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                if not expand or not expanded_columns:
+                    # Simple path
+                    writer.writerow(row)
+                else:
+                    # Look for {"value": "label": } dicts and expand
+                    new_row = []
+                    for column, cell in zip(columns, row):
+                        if isinstance(cell, dict):
+                            new_row.append(cell["value"])
+                            new_row.append(cell["label"])
                         else:
-                            # Look for {"value": "label": } dicts and expand
-                            new_row = []
-                            for cell in row:
-                                if isinstance(cell, dict):
-                                    new_row.append(cell["value"])
-                                    new_row.append(cell["label"])
-                                else:
-                                    new_row.append(cell)
-                            writer.writerow(new_row)
-                except Exception as e:
-                    print('caught this', e)
-                    r.write(str(e))
-                    return
+                            new_row.append(cell)
+                            if column in expanded_columns:
+                                new_row.append("")
+                    writer.writerow(new_row)
+            return buffer.getvalue()
+
+        async def stream_fn(r):
+            if rows is None:
+                await export.write(
+                    r,
+                    csv_rows,
+                    self.ds.config["max_csv_mb"],
+                    prefix=csv_rows([headings], expand=False),
+                    error_text=str,
+                )
+                return
+            writer = LimitedWriter(r, self.ds.config["max_csv_mb"])
+            try:
+                writer.write(csv_rows([headings], expand=False))
+                writer.write(csv_rows(rows))
+            except Exception as e:
+                print('caught this', e)
+                r.write(str(e))
 
         content_type = "text/plain; charset=utf-8"
         headers = {}
@@ -243,6 +461,94 @@ class BaseView(RenderMixin):
             content_type=content_type
         )
 
+    async def as_ndjson(self, request, name, hash, **kwargs):
+        "Stream every row as newline-delimited JSON, one object per line"
+        if not self.ds.config["allow_csv_stream"]:
+            raise DatasetteError("NDJSON streaming is disabled", status=400)
+        if request.args.get("_next"):
+            raise DatasetteError(
+                "_next not allowed for NDJSON streaming", status=400
+            )
+        export = await self.export_stream(request, name, hash, **kwargs)
+        if isinstance(export, response.HTTPResponse):
+            return export
+        columns = export.columns
+        json_cols = request.args.get("_json") and request.args["_json"]
+
+        def ndjson_rows(rows):
+            # Writes a whole batch of rows as a single chunk
+            if json_cols:
+                rows = convert_specific_columns_to_json(rows, columns, json_cols)
+            return "".join(
+                json.dumps(dict(zip(columns, row)), cls=CustomJSONEncoder) + "\n"
+                for row in rows
+            )
+
+        async def stream_fn(r):
+            await export.write(r, ndjson_rows, self.ds.config["max_csv_mb"])
+
+        headers = {}
+        if self.ds.cors:
+            headers["Access-Control-Allow-Origin"] = "*"
+        if request.args.get("_dl", None):
+            disposition = 'attachment; filename="{}.ndjson"'.format(
+                kwargs.get('table', name)
+            )
+            headers["Content-Disposition"] = disposition
+
+        return response.stream(
+            stream_fn,
+            headers=headers,
+            content_type="application/x-ndjson; charset=utf-8"
+        )
+
+    async def as_arrow(self, request, name, hash, **kwargs):
+        "Stream every row as an Apache Arrow IPC stream"
+        if arrow.pyarrow is None:
+            raise DatasetteError(
+                "Arrow output needs pyarrow: pip install datasette[arrow]",
+                status=501,
+            )
+        if not self.ds.config["allow_csv_stream"]:
+            raise DatasetteError("Arrow streaming is disabled", status=400)
+        if request.args.get("_next"):
+            raise DatasetteError(
+                "_next not allowed for Arrow streaming", status=400
+            )
+        declared_types = {}
+        if kwargs.get("table"):
+            declared_types = await self.ds.execute_fn(
+                name,
+                lambda conn: arrow.declared_column_types(conn, kwargs["table"]),
+                workload="export",
+            )
+        export = await self.export_stream(request, name, hash, **kwargs)
+        if isinstance(export, response.HTTPResponse):
+            return export
+        writer = arrow.ArrowStreamWriter(
+            export.columns, export.expanded_columns, declared_types
+        )
+
+        async def stream_fn(r):
+            await export.write(
+                r, writer.write, self.ds.config["max_csv_mb"], end=writer.close
+            )
+
+        headers = {}
+        if self.ds.cors:
+            headers["Access-Control-Allow-Origin"] = "*"
+        if request.args.get("_dl", None):
+            disposition = 'attachment; filename="{}.arrow"'.format(
+                kwargs.get('table', name)
+            )
+            headers["Content-Disposition"] = disposition
+
+        return response.stream(
+            stream_fn,
+            headers=headers,
+            content_type="application/vnd.apache.arrow.stream"
+        )
+
     async def view_get(self, request, name, hash, **kwargs):
         # If ?_format= is provided, use that as the format
         _format = request.args.get("_format", None)
@@ -262,6 +568,14 @@ class BaseView(RenderMixin):
         if _format == "csv":
             return await self.as_csv(request, name, hash, **kwargs)
 
+        if "pk_path" not in kwargs:
+            if _format == "ndjson" or (
+                _format == "json" and request.args.get("_shape") == "ndjson"
+            ):
+                return await self.as_ndjson(request, name, hash, **kwargs)
+            if _format == "arrow":
+                return await self.as_arrow(request, name, hash, **kwargs)
+
         if _format is None:
             # HTML views default to expanding all forign key labels
             kwargs['default_labels'] = True
@@ -324,13 +638,18 @@ class BaseView(RenderMixin):
 
             # Deal with the _shape option
             shape = request.args.get("_shape", "arrays")
+            columns = data.get("columns")
+            rows_as_objects = False
             if shape == "arrayfirst":
                 data = [row[0] for row in data["rows"]]
             elif shape in ("objects", "object", "array"):
-                columns = data.get("columns")
                 rows = data.get("rows")
                 if rows and columns:
-                    data["rows"] = [dict(zip(columns, row)) for row in rows]
+                    if shape == "object":
+                        data["rows"] = [dict(zip(columns, row)) for row in rows]
+                    else:
+                        # json_chunks() writes these as objects directly
+                        rows_as_objects = True
                 if shape == "object":
                     error = None
                     if "primary_keys" not in data:
@@ -367,12 +686,50 @@ class BaseView(RenderMixin):
             headers = {}
             if self.ds.cors:
                 headers["Access-Control-Allow-Origin"] = "*"
-            r = response.HTTPResponse(
-                json.dumps(data, cls=CustomJSONEncoder),
-                status=status_code,
-                content_type="application/json",
-                headers=headers,
+            chunks = json_chunks(
+                data, columns=columns, rows_as_objects=rows_as_objects
             )
+            # Encoding errors in the start of the response can still be
+            # reported with an error status, and a response that turns out
+            # to be small is sent in one go
+            body = []
+            body_size = 0
+            for chunk in chunks:
+                body.append(chunk)
+                body_size += len(chunk)
+                if body_size >= JSON_STREAM_MIN_BYTES:
+                    break
+            if body_size < JSON_STREAM_MIN_BYTES:
+                r = response.HTTPResponse(
+                    "".join(body),
+                    status=status_code,
+                    content_type="application/json",
+                    headers=headers,
+                )
+            else:
+                async def stream_fn(r):
+                    try:
+                        r.write("".join(body))
+                        for chunk in chunks:
+                            # An empty chunk would end the chunked response
+                            if chunk:
+                                r.write(chunk)
+                            await wait_for_client(r.transport)
+                    except Exception as e:
+                        # The status has been sent, so abort the connection
+                        # rather than end a truncated body cleanly
+                        logger.warning(
+                            "Streaming JSON from %s failed: %s", name, e
+                        )
+                        if r.transport is not None:
+                            r.transport.abort()
+
+                r = response.stream(
+                    stream_fn,
+                    status=status_code,
+                    content_type="application/json",
+                    headers=headers,
+                )
         else:
             extras = {}
             if callable(extra_template_data):
@@ -427,7 +784,7 @@ class BaseView(RenderMixin):
 
     async def custom_sql(
         self, request, name, hash, sql, editable=True, canned_query=None,
-        _size=None
+        _size=None, workload="primary", _stream=False
     ):
         params = request.raw_args
         if "sql" in params:
@@ -451,8 +808,17 @@ class BaseView(RenderMixin):
             extra_args["custom_time_limit"] = int(params["_timelimit"])
         if _size:
             extra_args["page_size"] = _size
+        if params.get("_nocache"):
+            extra_args["use_cache"] = False
+        if _stream:
+            return {
+                "database": name,
+                "sql": sql,
+                "params": params,
+                "columns_to_expand": [],
+            }, None, None
         results = await self.ds.execute(
-            name, sql, params, truncate=True, **extra_args
+            name, sql, params, truncate=True, workload=workload, **extra_args
         )
         columns = [r[0] for r in results.description]
 
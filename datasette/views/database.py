@@ -9,15 +9,19 @@ from .base import BaseView, DatasetteError
 
 class DatabaseView(BaseView):
 
-    async def data(self, request, name, hash, default_labels=False, _size=None):
+    async def data(self, request, name, hash, default_labels=False, _size=None, _workload="primary", _stream=False):
         if request.args.get("sql"):
             if not self.ds.config["allow_sql"]:
                 raise DatasetteError("sql= is not allowed", status=400)
             sql = request.raw_args.pop("sql")
             expanded_sql = expand_sql(sql)
             validate_sql_select(sql)
-            return await self.custom_sql(request, name, hash, expanded_sql, _size=_size)
+            return await self.custom_sql(
+                request, name, hash, expanded_sql, _size=_size,
+                workload=_workload, _stream=_stream,
+            )
 
+        await self.ds.ensure_inspected(name)
         info = self.ds.inspect()[name]
         metadata = self.ds.metadata.get("databases", {}).get(name, {})
         self.ds.update_with_inherited_metadata(metadata)
@@ -14,9 +14,10 @@ class IndexView(RenderMixin):
         self.ds = datasette
         self.files = datasette.files
         self.jinja_env = datasette.jinja_env
-        self.executor = datasette.executor
 
     async def get(self, request, as_format):
+        for name in self.ds.inspect():
+            await self.ds.ensure_inspected(name)
         databases = []
         for key, info in sorted(self.ds.inspect().items()):
             tables = [t for t in info["tables"].values() if not t["hidden"]]
@@ -33,7 +34,13 @@ class IndexView(RenderMixin):
                 "tables_count": len(tables),
                 "tables_more": len(tables) > 5,
                 "table_rows_sum": sum(t["count"] for t in tables),
+                "table_rows_approximate": any(
+                    t.get("count_approximate") for t in tables
+                ),
                 "hidden_table_rows_sum": sum(t["count"] for t in hidden_tables),
+                "hidden_table_rows_approximate": any(
+                    t.get("count_approximate") for t in hidden_tables
+                ),
                 "hidden_tables_count": len(hidden_tables),
                 "views_count": len(info["views"]),
             }
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from sanic import response
 from .base import RenderMixin
@@ -12,6 +13,8 @@ class JsonDataView(RenderMixin):
 
     async def get(self, request, as_format):
         data = self.data_callback()
+        if asyncio.iscoroutine(data):
+            data = await data
         if as_format:
             headers = {}
             if self.ds.cors:
@@ -1,4 +1,6 @@
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+import asyncio
+import functools
 import sqlite3
 import urllib
 
@@ -6,12 +8,17 @@ import jinja2
 from sanic.exceptions import NotFound
 from sanic.request import RequestParameters
 
+from datasette.cache import params_key
+from datasette.executor import QueueFullError
+from datasette.inspect import inspect_estimated_count
 from datasette.utils import (
     CustomRow,
     Filters,
     InterruptedError,
     append_querystring,
     compound_keys_after_sql,
+    count_distinct_values,
+    count_facet_values,
     escape_sqlite,
     filters_should_redirect,
     is_url,
@@ -103,7 +110,7 @@ class RowTableShared(BaseView):
             results = await self.ds.execute(
                 database, sql, list(set(values))
             )
-        except InterruptedError:
+        except (InterruptedError, QueueFullError):
             pass
         else:
             for id, value in results:
@@ -221,7 +228,7 @@ class RowTableShared(BaseView):
 
 class TableView(RowTableShared):
 
-    async def data(self, request, name, hash, table, default_labels=False,  _next=None, _size=None):
+    async def data(self, request, name, hash, table, default_labels=False,  _next=None, _size=None, _workload="primary", _stream=False):
         canned_query = self.ds.get_canned_query(name, table)
         if canned_query is not None:
             return await self.custom_sql(
@@ -231,9 +238,12 @@ class TableView(RowTableShared):
                 canned_query["sql"],
                 editable=False,
                 canned_query=table,
+                workload=_workload,
+                _stream=_stream,
             )
 
         is_view = bool(await self.ds.get_view_definition(name, table))
+        await self.ds.ensure_inspected(name, [table])
         info = self.ds.inspect()
         table_info = info[name]["tables"].get(table) or {}
         if not is_view and not table_info:
@@ -459,7 +469,43 @@ class TableView(RowTableShared):
                 table_name=escape_sqlite(table),
                 where=where_clause,
             )
-            return await self.custom_sql(request, name, hash, sql, editable=True)
+            return await self.custom_sql(
+                request, name, hash, sql, editable=True, _stream=_stream
+            )
+
+        # Expand labeled columns if requested
+        expandable_columns = self.expandable_columns(name, table)
+        columns_to_expand = None
+        try:
+            all_labels = value_as_boolean(special_args.get("_labels", ""))
+        except ValueError:
+            all_labels = default_labels
+        # Check for explicit _label=
+        if "_label" in request.args:
+            columns_to_expand = request.args["_label"]
+        if columns_to_expand is None and all_labels:
+            # expand all columns with foreign keys
+            columns_to_expand = [
+                fk["column"] for fk, _ in expandable_columns
+            ]
+
+        if _stream:
+            # Every matching row, for the export engine to read in one go
+            return {
+                "database": name,
+                "table": table,
+                "sql": "select {select} from {table_name} {where}{order_by}".format(
+                    select=select,
+                    table_name=escape_sqlite(table),
+                    where=where_clause,
+                    order_by=order_by,
+                ),
+                "params": params,
+                "columns_to_expand": [
+                    fk["column"] for fk, _ in expandable_columns
+                    if fk["column"] in (columns_to_expand or [])
+                ],
+            }, None, None
 
         extra_args = {}
         # Handle ?_size=500
@@ -495,10 +541,10 @@ class TableView(RowTableShared):
 
         if request.raw_args.get("_timelimit"):
             extra_args["custom_time_limit"] = int(request.raw_args["_timelimit"])
-
-        results = await self.ds.execute(
-            name, sql, params, truncate=True, **extra_args
-        )
+        # ?_nocache=1 bypasses the query result cache for every query below
+        use_cache = not request.raw_args.get("_nocache")
+        if not use_cache:
+            extra_args["use_cache"] = False
 
         # facets support
         facet_size = self.ds.config["default_facet_size"]
@@ -510,15 +556,50 @@ class TableView(RowTableShared):
             facets.extend(request.args["_facet"])
         except KeyError:
             pass
+        # The same column can be requested by metadata and by ?_facet=
+        facets = list(OrderedDict.fromkeys(facets))
         facet_results = {}
         facets_timed_out = []
-        for column in facets:
-            if _next:
-                continue
+
+        # Facets precomputed by "datasette inspect --facets" can answer an
+        # unfiltered page, or one filtered by a single facet value
+        precomputed_facet_rows = {}
+        facet_counts = table_info.get("facet_counts") if not is_view else None
+        if facet_counts and facet_counts["size"] >= facet_size:
+            precomputed = None
+            if not from_sql_where_clauses:
+                precomputed = facet_counts["counts"]
+            elif (
+                len(from_sql_where_clauses) == 1 and
+                len(other_args) == 1 and
+                not search_descriptions
+            ):
+                (key, value), = other_args.items()
+                if key.endswith("__exact"):
+                    key = key[:-len("__exact")]
+                # Filters on columns with units compare converted values
+                if key not in units:
+                    precomputed = facet_counts["filtered"].get(
+                        key, {}
+                    ).get(value)
+            precomputed_facet_rows = {
+                column: [tuple(row) for row in rows[:facet_size + 1]]
+                for column, rows in (precomputed or {}).items()
+            }
+
+        # The page query, the count, the facets and the suggested facets are
+        # independent of each other, so they are scheduled together - the
+        # page then takes as long as the slowest of them, not their sum.
+        results_future = asyncio.ensure_future(self.ds.execute(
+            name, sql, params, truncate=True, workload=_workload, **extra_args
+        ))
+
+        async def execute_facet_rows(column):
+            # Returns list of (value, count) pairs, or None on time out
             facet_sql = """
                 select {col} as value, count(*) as count
                 {from_sql} {and_or_where} {col} is not null
-                group by {col} order by count desc limit {limit}
+                group by {col} order by count desc, {col} limit {limit}
             """.format(
                 col=escape_sqlite(column),
                 from_sql=from_sql,
@@ -530,43 +611,276 @@ class TableView(RowTableShared):
                     name, facet_sql, params,
                     truncate=False,
                     custom_time_limit=self.ds.config["facet_time_limit_ms"],
+                    use_cache=use_cache,
+                    workload="facet",
                 )
-                facet_results_values = []
-                facet_results[column] = {
-                    "name": column,
-                    "results": facet_results_values,
-                    "truncated": len(facet_rows_results) > facet_size,
-                }
-                facet_rows = facet_rows_results.rows[:facet_size]
-                # Attempt to expand foreign keys into labels
-                values = [row["value"] for row in facet_rows]
-                expanded = (await self.expand_foreign_keys(
-                    name, table, column, values
+            except (InterruptedError, QueueFullError):
+                return None
+            return [(row["value"], row["count"]) for row in facet_rows_results]
+
+        async def execute_facet_scan(columns):
+            # Counts the values of several facets with one scan of the rows
+            try:
+                return await self.ds.execute_fn(
+                    name,
+                    lambda conn: count_facet_values(
+                        conn, columns, from_sql, from_sql_params, facet_size+1
+                    ),
+                    custom_time_limit=self.ds.config["facet_time_limit_ms"],
+                    workload="facet",
+                )
+            except InterruptedError:
+                # Too slow to count them all at once - fall back to a group
+                # by query for each, with its own time limit, so the facets
+                # that can be counted in time are still shown
+                gathered = await asyncio.gather(
+                    *[execute_facet_rows(column) for column in columns]
+                )
+                return dict(zip(columns, gathered))
+            except QueueFullError:
+                return {column: None for column in columns}
+
+        async def execute_facets(columns):
+            live_columns = [
+                column for column in columns
+                if column not in precomputed_facet_rows
+            ]
+            # A group by on an indexed column can walk the index rather than
+            # scanning the table, so only the other columns are worth
+            # counting together - and only if there is more than one of them
+            indexed_columns = set(table_info.get("indexed_columns") or [])
+            scan_columns = [
+                column for column in live_columns
+                if column not in indexed_columns
+            ]
+            if len(scan_columns) < 2:
+                scan_columns = []
+            group_by_columns = [
+                column for column in live_columns if column not in scan_columns
+            ]
+            gathered = await asyncio.gather(
+                *[execute_facet_rows(column) for column in group_by_columns],
+                *([execute_facet_scan(scan_columns)] if scan_columns else [])
+            )
+            facet_rows = dict(zip(group_by_columns, gathered))
+            if scan_columns:
+                facet_rows.update(gathered[-1])
+            facet_rows.update(precomputed_facet_rows)
+            results = []
+            for column in columns:
+                if facet_rows[column] is None:
+                    facets_timed_out.append(column)
+                else:
+                    results.append(
+                        await facet_result(column, facet_rows[column])
+                    )
+            return results
+
+        async def facet_result(column, facet_rows):
+            facet_results_values = []
+            truncated = len(facet_rows) > facet_size
+            facet_rows = facet_rows[:facet_size]
+            # Attempt to expand foreign keys into labels
+            values = [value for value, _ in facet_rows]
+            expanded = (await self.expand_foreign_keys(
+                name, table, column, values
+            ))
+            for value, count in facet_rows:
+                selected = str(other_args.get(column)) == str(value)
+                if selected:
+                    toggle_path = path_with_removed_args(
+                        request, {column: str(value)}
+                    )
+                else:
+                    toggle_path = path_with_added_args(
+                        request, {column: value}
+                    )
+                facet_results_values.append({
+                    "value": value,
+                    "label": expanded.get((column, value), value),
+                    "count": count,
+                    "toggle_url": urllib.parse.urljoin(
+                        request.url, toggle_path
+                    ),
+                    "selected": selected,
+                })
+            return {
+                "name": column,
+                "results": facet_results_values,
+                "truncated": truncated,
+            }
+
+        async def execute_count():
+            # Returns (number of filtered rows in whole set, is approximate).
+            # The count does not depend on the page, so it is remembered for
+            # the following pages and for the other formats.
+            count_key = (
+                name,
+                info[name]["hash"],
+                table,
+                count_sql,
+                params_key(from_sql_params),
+            )
+            if use_cache:
+                count = self.ds.count_cache.get(count_key)
+                if count is not None:
+                    return count, False
+            # An unfiltered table has the number of rows found by inspect,
+            # unless that was only an estimate
+            if (
+                not is_view and
+                not from_sql_where_clauses and
+                table_info.get("count") is not None and
+                not table_info.get("count_approximate")
+            ):
+                return table_info["count"], False
+            try:
+                count_rows = list(await self.ds.execute(
+                    name, count_sql, from_sql_params,
+                    use_cache=use_cache,
+                    workload="count",
                 ))
-                for row in facet_rows:
-                    selected = str(other_args.get(column)) == str(row["value"])
-                    if selected:
-                        toggle_path = path_with_removed_args(
-                            request, {column: str(row["value"])}
-                        )
-                    else:
-                        toggle_path = path_with_added_args(
-                            request, {column: row["value"]}
-                        )
-                    facet_results_values.append({
-                        "value": row["value"],
-                        "label": expanded.get(
-                            (column, row["value"]),
-                            row["value"]
-                        ),
-                        "count": row["count"],
-                        "toggle_url": urllib.parse.urljoin(
-                            request.url, toggle_path
+                self.ds.count_cache.set(count_key, count_rows[0][0])
+                return count_rows[0][0], False
+            except (InterruptedError, QueueFullError):
+                pass
+            if is_view:
+                return None, False
+            if not from_sql_where_clauses:
+                # Too slow to count, so use the estimate made by inspect
+                count = table_info.get("count")
+                return count, count is not None
+            # Too slow to count, so estimate without scanning the table
+            try:
+                count = await self.ds.execute_fn(
+                    name,
+                    functools.partial(
+                        inspect_estimated_count,
+                        table=table,
+                        from_sql=from_sql,
+                        params=from_sql_params,
+                    ),
+                    workload="count",
+                )
+            except (InterruptedError, QueueFullError):
+                count = None
+            return count, count is not None
+
+        # Statistics gathered by "datasette inspect --column-stats" describe
+        # the whole table, so they can only be used when it is unfiltered
+        column_stats = {}
+        if not is_view and not from_sql_where_clauses:
+            column_stats = table_info.get("column_stats") or {}
+
+        async def execute_suggested_facets():
+            # Returns list of (column, number of distinct values) pairs
+            if not (
+                self.ds.config["suggest_facets"] and self.ds.config["allow_facet"]
+            ) or _next:
+                return []
+            if is_view:
+                # Columns of a view are only known once the query has run
+                candidate_columns = [
+                    r[0] for r in (await results_future).description
+                ]
+            else:
+                candidate_columns = (["rowid"] if use_rowid else []) + list(
+                    table_info["columns"]
+                )
+            candidate_columns = [
+                column for column in candidate_columns if column not in facets
+            ]
+            distinct_counts = {
+                column: min(column_stats[column]["distinct"], facet_size + 1)
+                for column in candidate_columns
+                if column in column_stats
+            }
+            # Every other column is checked using a single scan of the rows
+            columns_to_scan = [
+                column for column in candidate_columns
+                if column not in distinct_counts
+            ]
+            if columns_to_scan:
+                try:
+                    distinct_counts.update(await self.ds.execute_fn(
+                        name,
+                        lambda conn: count_distinct_values(
+                            conn,
+                            columns_to_scan,
+                            from_sql,
+                            from_sql_params,
+                            facet_size,
+                            self.ds.config["facet_suggest_sample_size"],
                         ),
-                        "selected": selected,
-                    })
-            except InterruptedError:
-                facets_timed_out.append(column)
+                        custom_time_limit=self.ds.config[
+                            "facet_suggest_time_limit_ms"
+                        ],
+                        workload="suggest",
+                    ))
+                except (InterruptedError, QueueFullError):
+                    pass
+            # Columns the scan ran out of time for get a query each, with a
+            # time limit of their own
+            undecided_columns = [
+                column for column in columns_to_scan
+                if column not in distinct_counts
+            ]
+            distinct_counts.update(zip(
+                undecided_columns,
+                await asyncio.gather(*[
+                    execute_distinct_count(column)
+                    for column in undecided_columns
+                ]),
+            ))
+            return [
+                (column, distinct_counts.get(column))
+                for column in candidate_columns
+            ]
+
+        async def execute_distinct_count(column):
+            # Returns number of distinct values up to facet_size + 1, or None
+            # on time out
+            suggested_facet_sql = """
+                select distinct {column} {from_sql}
+                {and_or_where} {column} is not null
+                limit {limit}
+            """.format(
+                column=escape_sqlite(column),
+                from_sql=from_sql,
+                and_or_where='and' if from_sql_where_clauses else 'where',
+                limit=facet_size+1,
+            )
+            try:
+                distinct_values = await self.ds.execute(
+                    name, suggested_facet_sql, from_sql_params,
+                    truncate=False,
+                    custom_time_limit=self.ds.config[
+                        "facet_suggest_time_limit_ms"
+                    ],
+                    use_cache=use_cache,
+                    workload="suggest",
+                )
+            except (InterruptedError, QueueFullError):
+                return None
+            return len(distinct_values)
+
+        gathered = await asyncio.gather(
+            results_future,
+            execute_count(),
+            execute_suggested_facets(),
+            execute_facets(facets if not _next else []),
+            return_exceptions=True
+        )
+        # Errors other than time limits are raised in the order the queries
+        # were scheduled, so a failing page query takes precedence
+        for result in gathered:
+            if isinstance(result, BaseException):
+                raise result
+        results, (
+            filtered_table_rows_count, filtered_table_rows_count_approximate
+        ), distinct_counts = gathered[:3]
+        for facet in gathered[3]:
+            facet_results[facet["name"]] = facet
 
         columns = [r[0] for r in results.description]
         rows = list(results.rows)
@@ -575,23 +889,7 @@ class TableView(RowTableShared):
         if use_rowid and filter_columns[0] == "rowid":
             filter_columns = filter_columns[1:]
 
-        # Expand labeled columns if requested
         expanded_columns = []
-        expandable_columns = self.expandable_columns(name, table)
-        columns_to_expand = None
-        try:
-            all_labels = value_as_boolean(special_args.get("_labels", ""))
-        except ValueError:
-            all_labels = default_labels
-        # Check for explicit _label=
-        if "_label" in request.args:
-            columns_to_expand = request.args["_label"]
-        if columns_to_expand is None and all_labels:
-            # expand all columns with foreign keys
-            columns_to_expand = [
-                fk["column"] for fk, _ in expandable_columns
-            ]
-
         if columns_to_expand:
             expanded_labels = {}
             for fk, label_column in expandable_columns:
@@ -651,59 +949,24 @@ class TableView(RowTableShared):
             )
             rows = rows[:page_size]
 
-        # Number of filtered rows in whole set:
-        filtered_table_rows_count = None
-        if count_sql:
-            try:
-                count_rows = list(await self.ds.execute(
-                    name, count_sql, from_sql_params
-                ))
-                filtered_table_rows_count = count_rows[0][0]
-            except InterruptedError:
-                pass
-
-            # Detect suggested facets
-            suggested_facets = []
-            if self.ds.config["suggest_facets"] and self.ds.config["allow_facet"]:
-                for facet_column in columns:
-                    if facet_column in facets:
-                        continue
-                    if _next:
-                        continue
-                    if not self.ds.config["suggest_facets"]:
-                        continue
-                    suggested_facet_sql = '''
-                        select distinct {column} {from_sql}
-                        {and_or_where} {column} is not null
-                        limit {limit}
-                    '''.format(
-                        column=escape_sqlite(facet_column),
-                        from_sql=from_sql,
-                        and_or_where='and' if from_sql_where_clauses else 'where',
-                        limit=facet_size+1
-                    )
-                    distinct_values = None
-                    try:
-                        distinct_values = await self.ds.execute(
-                            name, suggested_facet_sql, from_sql_params,
-                            truncate=False,
-                            custom_time_limit=self.ds.config["facet_suggest_time_limit_ms"],
-                        )
-                        num_distinct_values = len(distinct_values)
-                        if (
-                            num_distinct_values and
-                            num_distinct_values > 1 and
-                            num_distinct_values <= facet_size and
-                            num_distinct_values < filtered_table_rows_count
-                        ):
-                            suggested_facets.append({
-                                'name': facet_column,
-                                'toggle_url': path_with_added_args(
-                                    request, {'_facet': facet_column}
-                                ),
-                            })
-                    except InterruptedError:
-                        pass
+        # Detect suggested facets
+        suggested_facets = []
+        for facet_column, num_distinct_values in distinct_counts:
+            if (
+                num_distinct_values and
+                num_distinct_values > 1 and
+                num_distinct_values <= facet_size and
+                (
+                    filtered_table_rows_count is None or
+                    num_distinct_values < filtered_table_rows_count
+                )
+            ):
+                suggested_facets.append({
+                    'name': facet_column,
+                    'toggle_url': path_with_added_args(
+                        request, {'_facet': facet_column}
+                    ),
+                })
 
         # human_description_en combines filters AND search, if provided
         human_description_en = filters.human_description_en(extra=search_descriptions)
@@ -777,6 +1040,9 @@ class TableView(RowTableShared):
             "truncated": results.truncated,
             "table_rows_count": table_rows_count,
             "filtered_table_rows_count": filtered_table_rows_count,
+            "filtered_table_rows_count_approximate": (
+                filtered_table_rows_count_approximate
+            ),
             "expanded_columns": expanded_columns,
             "expandable_columns": expandable_columns,
             "columns": columns,
@@ -797,6 +1063,7 @@ class RowView(RowTableShared):
 
     async def data(self, request, name, hash, table, pk_path, default_labels=False):
         pk_values = urlsafe_components(pk_path)
+        await self.ds.ensure_inspected(name, [table])
         info = self.ds.inspect()[name]
         table_info = info["tables"].get(table) or {}
         pks = table_info.get("primary_keys") or []
@@ -52,7 +52,10 @@ setup(
             'pytest==3.6.0',
             'aiohttp==2.3.2',
             'beautifulsoup4==4.6.0',
-        ]
+        ],
+        'arrow': [
+            'pyarrow>=0.11',
+        ],
     },
     tests_require=[
         'datasette[test]',
@@ -30,6 +30,7 @@ def app_client(
     cors=False,
     config=None,
     filename="fixtures.db",
+    metadata=None,
 ):
     with tempfile.TemporaryDirectory() as tmpdir:
         filepath = os.path.join(tmpdir, filename)
@@ -51,7 +52,7 @@ def app_client(
         ds = Datasette(
             [filepath],
             cors=cors,
-            metadata=METADATA,
+            metadata=metadata or METADATA,
             plugins_dir=plugins_dir,
             config=config,
         )
@@ -71,6 +72,13 @@ def app_client_returned_rows_matches_page_size():
     yield from app_client(max_returned_rows=50)
 
 
+@pytest.fixture(scope='session')
+def app_client_with_query_cache():
+    yield from app_client(config={
+        'query_cache_mb': 10,
+    })
+
+
 @pytest.fixture(scope='session')
 def app_client_larger_cache_size():
     yield from app_client(config={
@@ -78,6 +86,56 @@ def app_client_larger_cache_size():
     })
 
 
+@pytest.fixture(scope='session')
+def app_client_with_mmap():
+    yield from app_client(config={
+        'mmap_size_mb': 64,
+    })
+
+
+@pytest.fixture(scope='session')
+def app_client_in_memory():
+    yield from app_client(config={
+        'memory_db_max_mb': 100,
+    })
+
+
+@pytest.fixture(scope='session')
+def app_client_approximate_counts():
+    yield from app_client(config={
+        'inspect_counts': 'approximate',
+        'inspect_cache': False,
+    })
+
+
+@pytest.fixture(scope='session')
+def app_client_lazy_inspect():
+    yield from app_client(config={
+        'lazy_inspect': True,
+        'inspect_cache': False,
+    })
+
+
+@pytest.fixture(scope='session')
+def app_client_with_column_stats():
+    yield from app_client(config={
+        'inspect_column_stats': True,
+        'inspect_cache': False,
+    })
+
+
+@pytest.fixture(scope='session')
+def app_client_with_precomputed_facets():
+    metadata = json.loads(json.dumps(METADATA))
+    metadata['databases']['fixtures']['tables']['facetable'] = {
+        'facets': ['state', 'city_id'],
+    }
+    yield from app_client(config={
+        'inspect_facets': True,
+        'inspect_cache': False,
+    }, metadata=metadata)
+
+
 @pytest.fixture(scope='session')
 def app_client_csv_max_mb_one():
     yield from app_client(config={
@@ -95,6 +153,39 @@ def app_client_with_cors():
     yield from app_client(cors=True)
 
 
+@pytest.fixture(scope='session')
+def app_client_wide_table():
+    # Too many rows and columns to scan together for suggested facets
+    # within facet_suggest_time_limit_ms
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'wide.db')
+        conn = sqlite3.connect(filepath)
+        columns = ['c{}'.format(i) for i in range(WIDE_TABLE_COLUMNS)]
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, {})'.format(
+            ', '.join(columns)
+        ))
+        # Column c0 has 2 distinct values, c1 has 3 and so on up to c19,
+        # then c20 has 2 again
+        conn.executemany(
+            'INSERT INTO t ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?' for _ in columns)
+            ),
+            (
+                [i % (j % 20 + 2) for j in range(WIDE_TABLE_COLUMNS)]
+                for i in range(30000)
+            ),
+        )
+        conn.commit()
+        conn.close()
+        ds = Datasette([filepath], config={
+            'facet_suggest_sample_size': 0,
+            'facet_suggest_time_limit_ms': 150,
+        })
+        client = TestClient(ds.app().test_client)
+        client.ds = ds
+        yield client
+
+
 def generate_compound_rows(num):
     for a, b, c in itertools.islice(
         itertools.product(string.ascii_lowercase, repeat=3), num
@@ -122,6 +213,8 @@ def generate_sortable_rows(num):
         }
 
 
+WIDE_TABLE_COLUMNS = 40
+
 METADATA = {
     'title': 'Datasette Fixtures',
     'description': 'An example SQLite database demonstrating Datasette',
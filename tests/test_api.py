@@ -1,14 +1,34 @@
 from .fixtures import ( # noqa
     app_client,
+    app_client_approximate_counts,
+    app_client_csv_max_mb_one,
     app_client_shorter_time_limit,
     app_client_larger_cache_size,
     app_client_returned_rows_matches_page_size,
+    app_client_in_memory,
+    app_client_lazy_inspect,
+    app_client_with_column_stats,
     app_client_with_dot,
+    app_client_with_mmap,
+    app_client_with_precomputed_facets,
+    app_client_with_query_cache,
+    app_client_wide_table,
     generate_compound_rows,
     generate_sortable_rows,
     METADATA,
+    WIDE_TABLE_COLUMNS,
 )
+from datasette.views import base, table
+from datasette.executor import QueueFullError
+from datasette.inspect import TableInspector
+from datasette.utils import InterruptedError
+from datasette.views.base import cancel_on_disconnect
+import asyncio
+import json
 import pytest
+import sqlite3
+import threading
+import time
 import urllib
 
 
@@ -33,6 +53,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': [],
         'primary_keys': [],
     }, {
         'columns': ['pk', 'content'],
@@ -42,6 +63,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk'],
         'primary_keys': ['pk'],
     }, {
         'columns': ['pk', 'f1', 'f2', 'f3'],
@@ -66,6 +88,7 @@ def test_database_page(app_client):
         'hidden': False,
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk'],
         'primary_keys': ['pk'],
     }, {
         'columns': ['pk1', 'pk2', 'content'],
@@ -75,6 +98,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk1'],
         'primary_keys': ['pk1', 'pk2'],
     }, {
         'columns': ['pk1', 'pk2', 'pk3', 'content'],
@@ -84,6 +108,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk1'],
         'primary_keys': ['pk1', 'pk2', 'pk3'],
     }, {
         'columns': ['pk', 'foreign_key_with_custom_label'],
@@ -100,6 +125,7 @@ def test_database_page(app_client):
         },
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk'],
         'primary_keys': ['pk'],
     }, {
         'columns': ['id', 'name'],
@@ -114,6 +140,7 @@ def test_database_page(app_client):
             'outgoing': []
         },
         'fts_table': None,
+        'indexed_columns': [],
         'hidden': False,
         'label_column': 'name',
         'primary_keys': ['id'],
@@ -130,6 +157,7 @@ def test_database_page(app_client):
             }],
         },
         'fts_table': None,
+        'indexed_columns': [],
         'hidden': False,
         'label_column': None,
         'primary_keys': ['pk'],
@@ -152,6 +180,7 @@ def test_database_page(app_client):
         },
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk'],
         'primary_keys': ['pk'],
     }, {
         'columns': ['id', 'content', 'content2'],
@@ -168,6 +197,7 @@ def test_database_page(app_client):
         'hidden': False,
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['id'],
         'primary_keys': ['id']
     }, {
         'columns': ['id', 'content', 'content2'],
@@ -184,6 +214,7 @@ def test_database_page(app_client):
         'hidden': False,
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['id'],
         'primary_keys': ['id']
     },  {
         'columns': ['pk', 'text1', 'text2', 'name with . and spaces'],
@@ -195,6 +226,7 @@ def test_database_page(app_client):
             "other_column": "searchable_id"
         }], 'outgoing': []},
         'fts_table': 'searchable_fts',
+        'indexed_columns': [],
         'hidden': False,
         'label_column': None,
         'primary_keys': ['pk'],
@@ -206,6 +238,7 @@ def test_database_page(app_client):
         "label_column": None,
         "hidden": False,
         "fts_table": None,
+        "indexed_columns": ["searchable_id"],
         "foreign_keys": {
             "incoming": [],
             "outgoing": [
@@ -229,6 +262,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': [],
         'primary_keys': [],
     }, {
         'columns': ['id', 'content'],
@@ -257,6 +291,7 @@ def test_database_page(app_client):
         },
         'label_column': 'content',
         'fts_table': None,
+        'indexed_columns': ['id'],
         'primary_keys': ['id'],
     }, {
         'columns': [
@@ -269,6 +304,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk1'],
         'primary_keys': ['pk1', 'pk2'],
     }, {
         'columns': ['pk', 'content'],
@@ -278,6 +314,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': ['pk'],
         'primary_keys': ['pk'],
     }, {
         "name": "tags",
@@ -287,6 +324,7 @@ def test_database_page(app_client):
         "label_column": None,
         "hidden": False,
         "fts_table": None,
+        "indexed_columns": ["tag"],
         "foreign_keys": {
             "incoming": [
                 {
@@ -305,6 +343,7 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': [],
         'primary_keys': ['pk'],
     },  {
         'columns': ['content', 'a', 'b', 'c'],
@@ -314,12 +353,14 @@ def test_database_page(app_client):
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
         'fts_table': None,
+        'indexed_columns': [],
         'primary_keys': [],
     },  {
         'columns': ['text1', 'text2', 'name with . and spaces', 'content'],
         'count': 2,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'fts_table': 'searchable_fts',
+        'indexed_columns': [],
         'hidden': True,
         'label_column': None,
         'name': 'searchable_fts',
@@ -329,6 +370,7 @@ def test_database_page(app_client):
         'count': 2,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'fts_table': None,
+        'indexed_columns': [],
         'hidden': True,
         'label_column': None,
         'name': 'searchable_fts_content',
@@ -341,6 +383,7 @@ def test_database_page(app_client):
         'count': 1,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'fts_table': None,
+        'indexed_columns': ['level'],
         'hidden': True,
         'label_column': None,
         'name': 'searchable_fts_segdir',
@@ -350,6 +393,7 @@ def test_database_page(app_client):
         'count': 0,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'fts_table': None,
+        'indexed_columns': [],
         'hidden': True,
         'label_column': None,
         'name': 'searchable_fts_segments',
@@ -526,6 +570,34 @@ def test_table_shape_array(app_client):
     }] == response.json
 
 
+def test_suggested_facets_when_scan_times_out(app_client_wide_table):
+    response = app_client_wide_table.get('/wide/t.json?_size=1')
+    assert [
+        'c{}'.format(i) for i in range(WIDE_TABLE_COLUMNS)
+    ] == sorted(
+        (facet['name'] for facet in response.json['suggested_facets']),
+        key=lambda name: int(name[1:]),
+    )
+
+
+def test_shape_array_repeated_column_names(app_client):
+    response = app_client.get(
+        '/fixtures.json?sql=select+1+as+a,+2+as+b,+3+as+a&_shape=array'
+    )
+    assert [{'a': 3, 'b': 2}] == response.json
+
+
+def test_json_streamed_only_if_large(app_client, monkeypatch):
+    monkeypatch.setattr(base, 'JSON_STREAM_MIN_BYTES', 1000)
+    response = app_client.get('/fixtures/simple_primary_key.json')
+    assert 'Content-Length' in response.headers
+    response = app_client.get(
+        '/fixtures/compound_three_primary_keys.json?_shape=objects'
+    )
+    assert 'chunked' == response.headers.get('Transfer-Encoding')
+    assert 50 == len(response.json['rows'])
+
+
 def test_table_shape_invalid(app_client):
     response = app_client.get(
         '/fixtures/simple_primary_key.json?_shape=invalid'
@@ -571,6 +643,89 @@ def test_table_shape_object_compound_primary_Key(app_client):
     } == response.json
 
 
+def test_table_ndjson(app_client):
+    response = app_client.get('/fixtures/compound_three_primary_keys.ndjson')
+    assert response.status == 200
+    assert response.headers['Content-Type'].startswith('application/x-ndjson')
+    lines = response.text.splitlines()
+    # Every row, not just the first max_returned_rows
+    assert 1001 == len(lines)
+    assert {
+        'pk1': 'a',
+        'pk2': 'a',
+        'pk3': 'a',
+        'content': 'a-a-a',
+    } == json.loads(lines[0])
+
+
+def test_table_shape_ndjson(app_client):
+    response = app_client.get(
+        '/fixtures/simple_primary_key.json?_shape=ndjson'
+    )
+    assert response.status == 200
+    assert [
+        {'id': '1', 'content': 'hello'},
+        {'id': '2', 'content': 'world'},
+        {'id': '3', 'content': ''},
+    ] == [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_table_ndjson_with_labels(app_client):
+    response = app_client.get(
+        '/fixtures/foreign_key_references.ndjson?_labels=on'
+    )
+    assert response.status == 200
+    assert [{
+        'pk': '1',
+        'foreign_key_with_label': {'value': '1', 'label': 'hello'},
+        'foreign_key_with_no_label': {'value': '1', 'label': '1'},
+    }] == [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_custom_sql_ndjson(app_client):
+    response = app_client.get(
+        '/fixtures.ndjson?sql=select+pk1,+pk2,+pk3+from+compound_three_primary_keys'
+        '&_dl=1'
+    )
+    assert response.status == 200
+    assert (
+        'attachment; filename="fixtures.ndjson"' ==
+        response.headers['Content-Disposition']
+    )
+    lines = response.text.splitlines()
+    assert 1001 == len(lines)
+    assert {'pk1': 'a', 'pk2': 'a', 'pk3': 'a'} == json.loads(lines[0])
+
+
+def test_custom_sql_ndjson_invalid_sql(app_client):
+    response = app_client.get('/fixtures.ndjson?sql=select+*+from+no_such_table')
+    assert response.status == 400
+
+
+def test_exports_have_their_own_threads_by_default(app_client):
+    # A slow download holds its thread, so must not hold up page queries
+    lanes = app_client.ds.executor_lanes
+    assert 'export' == lanes.lane_name('fixtures', 'export')
+    assert 'primary' == lanes.lane_name('fixtures', 'primary')
+    assert 2 == lanes.lane('fixtures', 'export').max_workers
+
+
+def test_ndjson_over_max_csv_mb_is_aborted(app_client_csv_max_mb_one):
+    # The limit is reached after the response has started, so the connection
+    # is aborted rather than ending the response with non-JSON error text
+    with pytest.raises(ValueError) as e:
+        app_client_csv_max_mb_one.get(
+            '/fixtures.ndjson?sql=select+hex(randomblob(10000))+as+b+'
+            'from+compound_three_primary_keys'
+        )
+    assert 'Response payload is not completed' in str(e.value)
+
+
+def test_ndjson_not_allowed_with_next(app_client):
+    response = app_client.get('/fixtures/facetable.ndjson?_next=1')
+    assert response.status == 400
+
+
 def test_table_with_slashes_in_name(app_client):
     response = app_client.get('/fixtures/table%2Fwith%2Fslashes.csv?_shape=objects&_format=json')
     assert response.status == 200
@@ -916,7 +1071,11 @@ def test_inspect_json(app_client):
     response = app_client.get(
         "/-/inspect.json"
     )
-    assert app_client.ds.inspect() == response.json
+    # /-/inspect also shows which databases are served from memory
+    assert {
+        name: dict(info, memory=False)
+        for name, info in app_client.ds.inspect().items()
+    } == response.json
 
 
 def test_plugins_json(app_client):
@@ -956,6 +1115,7 @@ def test_config_json(app_client):
         "default_page_size": 50,
         "default_facet_size": 30,
         "facet_suggest_time_limit_ms": 50,
+        "facet_suggest_sample_size": 10000,
         "facet_time_limit_ms": 200,
         "max_returned_rows": 100,
         "sql_time_limit_ms": 200,
@@ -965,9 +1125,28 @@ def test_config_json(app_client):
         "allow_sql": True,
         "default_cache_ttl": 365 * 24 * 60 * 60,
         "num_sql_threads": 3,
+        "facet_sql_threads": 0,
+        "suggest_sql_threads": 0,
+        "count_sql_threads": 0,
+        "export_sql_threads": 2,
+        "sql_threads_per_database": False,
+        "sql_queue_limit": 0,
+        "sql_queue_time_limit_ms": 0,
+        "connections_per_database": 0,
         "cache_size_kb": 0,
+        "mmap_size_mb": 0,
+        "hash_strategy": "sha256",
+        "inspect_counts": "exact",
+        "lazy_inspect": False,
+        "inspect_column_stats": False,
+        "inspect_facets": False,
+        "inspect_processes": 0,
+        "inspect_cache": True,
+        "memory_db_max_mb": 0,
         "allow_csv_stream": True,
         "max_csv_mb": 100,
+        "query_cache_mb": 0,
+        "count_cache_size": 1000,
     } == response.json
 
 
@@ -1140,6 +1319,192 @@ def test_suggested_facets(app_client):
     ).json["suggested_facets"]) > 0
 
 
+def recording(method, workloads):
+    def recording_method(*args, **kwargs):
+        workloads.append(kwargs.get("workload"))
+        return method(*args, **kwargs)
+    return recording_method
+
+
+def test_suggested_facets_single_scan(app_client, monkeypatch):
+    ds = app_client.ds
+    execute_workloads = []
+    execute_fn_workloads = []
+    monkeypatch.setattr(ds, "execute", recording(
+        ds.execute, execute_workloads
+    ))
+    monkeypatch.setattr(ds, "execute_fn", recording(
+        ds.execute_fn, execute_fn_workloads
+    ))
+    suggested_facets = app_client.get(
+        "/fixtures/facetable.json?_nocache=1"
+    ).json["suggested_facets"]
+    assert [
+        "planet_int", "on_earth", "state", "city_id", "neighborhood"
+    ] == [facet["name"] for facet in suggested_facets]
+    assert "suggest" not in execute_workloads
+    assert ["suggest"] == execute_fn_workloads
+
+
+def test_facets_single_scan(app_client, monkeypatch):
+    ds = app_client.ds
+    execute_workloads = []
+    execute_fn_workloads = []
+    monkeypatch.setattr(ds, "execute", recording(
+        ds.execute, execute_workloads
+    ))
+    monkeypatch.setattr(ds, "execute_fn", recording(
+        ds.execute_fn, execute_fn_workloads
+    ))
+    path = "/fixtures/facetable.json?_facet=state&_facet=city_id&_nocache=1"
+    facet_results = app_client.get(path).json["facet_results"]
+    assert ["state", "city_id"] == list(facet_results.keys())
+    assert [
+        ("CA", 10), ("MI", 4), ("MC", 1)
+    ] == [
+        (value["value"], value["count"])
+        for value in facet_results["state"]["results"]
+    ]
+    assert "facet" not in execute_workloads
+    assert 1 == execute_fn_workloads.count("facet")
+
+
+def test_facets_fall_back_to_group_by_when_scan_times_out(
+    app_client, monkeypatch
+):
+    ds = app_client.ds
+    execute_workloads = []
+    monkeypatch.setattr(ds, "execute", recording(
+        ds.execute, execute_workloads
+    ))
+
+    def interrupted_scan(*args, **kwargs):
+        raise sqlite3.OperationalError("interrupted")
+
+    monkeypatch.setattr(table, "count_facet_values", interrupted_scan)
+    path = "/fixtures/facetable.json?_facet=state&_facet=city_id&_nocache=1"
+    facet_results = app_client.get(path).json["facet_results"]
+    assert ["state", "city_id"] == list(facet_results.keys())
+    assert [
+        ("CA", 10), ("MI", 4), ("MC", 1)
+    ] == [
+        (value["value"], value["count"])
+        for value in facet_results["state"]["results"]
+    ]
+    # One group by query for each facet
+    assert 2 == execute_workloads.count("facet")
+
+
+def test_facets_indexed_column_uses_group_by(app_client, monkeypatch):
+    ds = app_client.ds
+    execute_workloads = []
+    execute_fn_workloads = []
+    monkeypatch.setattr(ds, "execute", recording(
+        ds.execute, execute_workloads
+    ))
+    monkeypatch.setattr(ds, "execute_fn", recording(
+        ds.execute_fn, execute_fn_workloads
+    ))
+    facet_results = app_client.get(
+        "/fixtures/compound_three_primary_keys.json"
+        "?_facet=pk1&_facet=content&_nocache=1"
+    ).json["facet_results"]
+    assert ["pk1", "content"] == list(facet_results.keys())
+    # pk1 is indexed and only one unindexed column remains
+    assert 2 == execute_workloads.count("facet")
+    assert "facet" not in execute_fn_workloads
+
+
+def test_column_stats(app_client_with_column_stats):
+    tables = app_client_with_column_stats.ds.inspect()["fixtures"]["tables"]
+    assert {
+        "nulls": 0,
+        "distinct": 3,
+        "min": "CA",
+        "max": "MI",
+        "top": [["CA", 10], ["MI", 4], ["MC", 1]],
+    } == tables["facetable"]["column_stats"]["state"]
+
+
+@pytest.mark.parametrize("path,expect_suggest_queries", [
+    ("/fixtures/facetable.json", False),
+    ("/fixtures/facetable.json?state=CA", True),
+])
+def test_suggested_facets_from_column_stats(
+    app_client_with_column_stats, app_client, monkeypatch, path,
+    expect_suggest_queries
+):
+    ds = app_client_with_column_stats.ds
+    workloads = []
+    for method in ("execute", "execute_fn"):
+        monkeypatch.setattr(
+            ds, method, recording(getattr(ds, method), workloads)
+        )
+    response = app_client_with_column_stats.get(path)
+    assert app_client.get(path).json["suggested_facets"] == (
+        response.json["suggested_facets"]
+    )
+    assert expect_suggest_queries == ("suggest" in workloads)
+
+
+def test_precomputed_facet_counts(app_client_with_precomputed_facets):
+    facet_counts = app_client_with_precomputed_facets.ds.inspect()[
+        "fixtures"
+    ]["tables"]["facetable"]["facet_counts"]
+    assert 30 == facet_counts["size"]
+    assert [["CA", 10], ["MI", 4], ["MC", 1]] == facet_counts["counts"]["state"]
+    assert {
+        "state": [["MI", 4]],
+        "city_id": [[3, 4]],
+    } == facet_counts["filtered"]["state"]["MI"]
+    assert ["1", "2", "3", "4"] == sorted(facet_counts["filtered"]["city_id"])
+
+
+@pytest.mark.parametrize("querystring,expect_facet_queries", [
+    ("", False),
+    ("state=CA", False),
+    ("city_id__exact=1", False),
+    ("state=CA&city_id=1", True),
+    ("state__contains=C", True),
+    ("_facet=neighborhood", True),
+])
+def test_precomputed_facets(
+    app_client_with_precomputed_facets, app_client, monkeypatch, querystring,
+    expect_facet_queries
+):
+    ds = app_client_with_precomputed_facets.ds
+    workloads = []
+    for method in ("execute", "execute_fn"):
+        monkeypatch.setattr(
+            ds, method, recording(getattr(ds, method), workloads)
+        )
+    facet_results = app_client_with_precomputed_facets.get(
+        "/fixtures/facetable.json?_nocache=1&" + querystring
+    ).json["facet_results"]
+    expected = app_client.get(
+        "/fixtures/facetable.json?_facet=state&_facet=city_id&" + querystring
+    ).json["facet_results"]
+    assert expected.keys() == facet_results.keys()
+    for name, facet in facet_results.items():
+        assert expected[name]["truncated"] == facet["truncated"]
+        assert [
+            (value["value"], value["label"], value["count"], value["selected"])
+            for value in expected[name]["results"]
+        ] == [
+            (value["value"], value["label"], value["count"], value["selected"])
+            for value in facet["results"]
+        ]
+    assert expect_facet_queries == ("facet" in workloads)
+
+
+def test_facet_invalid_column(app_client):
+    response = app_client.get(
+        "/fixtures/facetable.json?_facet=nonexistent_column"
+    )
+    assert 400 == response.status
+    assert "no such column" in response.json["error"]
+
+
 def test_allow_facet_off():
     for client in app_client(config={
         'allow_facet': False,
@@ -1263,3 +1628,355 @@ def test_config_cache_size(app_client_larger_cache_size):
         '/fixtures/pragma_cache_size.json'
     )
     assert [[-2500]] == response.json['rows']
+
+
+def test_config_mmap_size(app_client_with_mmap, app_client):
+    conn = app_client_with_mmap.ds.connect("fixtures")
+    assert 64 * 1024 * 1024 == conn.execute("PRAGMA mmap_size").fetchone()[0]
+    conn = app_client.ds.connect("fixtures")
+    assert 0 == conn.execute("PRAGMA mmap_size").fetchone()[0]
+
+
+def test_lazy_inspect(app_client_lazy_inspect, app_client):
+    tables = app_client_lazy_inspect.ds.inspect()["fixtures"]["tables"]
+    response = app_client_lazy_inspect.get("/fixtures/simple_primary_key.json")
+    assert 3 == len(response.json["rows"])
+    assert len(tables) > tables.inspected
+    response = app_client_lazy_inspect.get("/-/inspect.json")
+    assert len(tables) == tables.inspected
+    assert app_client.get("/-/inspect.json").json["fixtures"]["tables"] == (
+        response.json["fixtures"]["tables"]
+    )
+
+
+def test_lazy_inspect_runs_off_the_event_loop(monkeypatch):
+    inspected_in = []
+    inspect_table = TableInspector.inspect_table
+
+    def recording_inspect_table(self, conn, table):
+        inspected_in.append(threading.current_thread())
+        return inspect_table(self, conn, table)
+
+    monkeypatch.setattr(
+        TableInspector, "inspect_table", recording_inspect_table
+    )
+    for client in app_client(config={"lazy_inspect": True}):
+        for path in (
+            "/fixtures/facetable.json?_labels=on",
+            "/fixtures/searchable.json?_search=dog",
+            "/fixtures/simple_primary_key/1.json",
+            "/fixtures.json",
+            "/.json",
+            "/-/inspect.json",
+        ):
+            assert 200 == client.get(path).status
+    assert inspected_in
+    # The test client runs the event loop in the main thread
+    assert threading.main_thread() not in inspected_in
+
+
+def test_memory_database(app_client_in_memory, app_client):
+    ds = app_client_in_memory.ds
+    in_memory = hasattr(sqlite3.Connection, "backup")
+    response = app_client.get("/-/inspect.json")
+    assert not response.json["fixtures"]["memory"]
+    response = app_client_in_memory.get("/-/inspect.json")
+    assert in_memory == response.json["fixtures"]["memory"]
+    files = [
+        ds.connect("fixtures").execute(
+            "PRAGMA database_list"
+        ).fetchall()[0]["file"]
+        for _ in range(2)
+    ]
+    # Connections share a single in-memory copy, not the file on disk
+    assert files[0] == files[1]
+    assert in_memory == (files[0] != ds.database_file("fixtures"))
+    assert in_memory == ("fixtures" in ds._memory_copies)
+    if in_memory:
+        with pytest.raises(sqlite3.OperationalError):
+            ds.connect("fixtures").execute(
+                "delete from simple_primary_key"
+            )
+    response = app_client_in_memory.get("/fixtures/simple_primary_key.json")
+    assert [
+        ["1", "hello"], ["2", "world"], ["3", ""]
+    ] == response.json["rows"]
+    response = app_client_in_memory.get("/-/stats.json")
+    assert (["fixtures"] if in_memory else []) == (
+        response.json["memory_databases"]
+    )
+    response = app_client.get("/-/stats.json")
+    assert [] == response.json["memory_databases"]
+
+
+def test_mmap_size_metadata_override(app_client_with_mmap):
+    ds = app_client_with_mmap.ds
+    ds.metadata["databases"]["fixtures"]["mmap_size_mb"] = 0
+    try:
+        conn = ds.connect("fixtures")
+        assert 0 == conn.execute("PRAGMA mmap_size").fetchone()[0]
+    finally:
+        del ds.metadata["databases"]["fixtures"]["mmap_size_mb"]
+
+
+def test_query_cache(app_client_with_query_cache):
+    path = "/fixtures/facetable.json?_facet=state"
+    stats = app_client_with_query_cache.ds.query_cache.stats
+    first = app_client_with_query_cache.get(path).json
+    hits = stats()["hits"]
+    second = app_client_with_query_cache.get(path).json
+    assert stats()["hits"] > hits
+    assert first["rows"] == second["rows"]
+    assert first["facet_results"] == second["facet_results"]
+    assert first["filtered_table_rows_count"] == second["filtered_table_rows_count"]
+    # ?_nocache=1 runs the page, count and facet queries again
+    misses, entries = stats()["misses"], stats()["entries"]
+    app_client_with_query_cache.get(path + "&_nocache=1")
+    assert (misses, entries) == (stats()["misses"], stats()["entries"])
+
+
+def test_count_cache(app_client, monkeypatch):
+    ds = app_client.ds
+    workloads = []
+    monkeypatch.setattr(ds, "execute", recording(ds.execute, workloads))
+    path = "/fixtures/compound_three_primary_keys.json?content__not=count-cache"
+    first = app_client.get(path).json
+    assert 1 == workloads.count("count")
+    # The count is reused for the next page and for the CSV export
+    second = app_client.get(first["next_url"]).json
+    assert first["filtered_table_rows_count"] == (
+        second["filtered_table_rows_count"]
+    )
+    app_client.get(path.replace(".json", ".csv"))
+    assert 1 == workloads.count("count")
+    # ?_nocache=1 counts the rows again
+    app_client.get(path + "&_nocache=1")
+    assert 2 == workloads.count("count")
+
+
+def test_unfiltered_count_comes_from_inspect(app_client, monkeypatch):
+    ds = app_client.ds
+    workloads = []
+    monkeypatch.setattr(ds, "execute", recording(ds.execute, workloads))
+    response = app_client.get("/fixtures/facetable.json?_nocache=1")
+    assert "count" not in workloads
+    assert 15 == response.json["filtered_table_rows_count"]
+    assert not response.json["filtered_table_rows_count_approximate"]
+
+
+@pytest.mark.parametrize("client,path,expected_count,expected_approximate", [
+    # inspect only estimated the number of rows, from max(rowid)
+    (
+        "app_client_approximate_counts",
+        "/fixtures/facetable.json?_nocache=1",
+        15,
+        True,
+    ),
+    # No sqlite_stat1 to estimate from
+    ("app_client", "/fixtures/facetable.json?_nocache=1&state=CA", None, False),
+])
+def test_count_estimate_when_count_times_out(
+    request, monkeypatch, client, path, expected_count, expected_approximate
+):
+    app_client = request.getfixturevalue(client)
+    ds = app_client.ds
+    execute = ds.execute
+
+    async def interrupted_count(*args, **kwargs):
+        if kwargs.get("workload") == "count":
+            raise InterruptedError("interrupted")
+        return await execute(*args, **kwargs)
+
+    monkeypatch.setattr(ds, "execute", interrupted_count)
+    response = app_client.get(path)
+    assert expected_count == response.json["filtered_table_rows_count"]
+    assert expected_approximate == (
+        response.json["filtered_table_rows_count_approximate"]
+    )
+
+
+def test_stats_json(app_client_with_query_cache):
+    response = app_client_with_query_cache.get("/-/stats.json")
+    assert {
+        "enabled", "max_bytes", "bytes", "entries", "hits", "misses", "evictions",
+    } == set(response.json["query_cache"].keys())
+    assert response.json["query_cache"]["enabled"]
+    pool_stats = response.json["connections"]["fixtures"]
+    # num_sql_threads plus export_sql_threads
+    assert 5 == pool_stats["size"]
+    assert pool_stats["checkouts"] > 0
+    assert 0 == pool_stats["in_use"]
+
+
+def test_identical_concurrent_queries_share_execution(app_client):
+    ds = app_client.ds
+    loop = asyncio.new_event_loop()
+    shared = ds.in_flight_shared
+
+    async def run_queries():
+        return await asyncio.gather(*[
+            ds.execute("fixtures", "select sleep(0.05), 1 as one")
+            for i in range(5)
+        ] + [
+            ds.execute("fixtures", "select sleep(0.05), 2 as two")
+        ])
+
+    try:
+        results = loop.run_until_complete(run_queries())
+    finally:
+        loop.close()
+    assert all(r is results[0] for r in results[:5])
+    assert results[5] is not results[0]
+    assert 4 == ds.in_flight_shared - shared
+    assert 0 == ds.stats()["in_flight_queries"]["executing"]
+
+
+def test_executor_lanes():
+    for client in app_client(config={
+        "facet_sql_threads": 2,
+        "count_sql_threads": 1,
+        "sql_threads_per_database": True,
+    }):
+        response = client.get(
+            "/fixtures/facetable.json?_facet=state&city_id__gt=0"
+        )
+        assert 200 == response.status
+        assert 1 == len(response.json["facet_results"])
+        executors = client.get("/-/stats.json").json["executors"]
+        assert 2 == executors["fixtures:facet"]["max_workers"]
+        assert executors["fixtures:facet"]["completed"] >= 1
+        assert executors["fixtures:count"]["completed"] >= 1
+        # Suggested facets have no lane of their own
+        assert "fixtures:suggest" not in executors
+        # Pool is sized for every thread that can query the database
+        assert 8 == client.ds.connection_pool("fixtures").size
+
+
+def test_table_queries_run_concurrently(app_client, monkeypatch):
+    ds = app_client.ds
+    in_flight = []
+    snapshots = []
+
+    def tracking(method):
+        async def tracking_method(*args, **kwargs):
+            workload = kwargs.get("workload")
+            in_flight.append(workload)
+            snapshots.append(set(in_flight))
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                in_flight.remove(workload)
+        return tracking_method
+
+    monkeypatch.setattr(ds, "execute", tracking(ds.execute))
+    monkeypatch.setattr(ds, "execute_fn", tracking(ds.execute_fn))
+    # Filtered, so the count has to be queried rather than read from inspect
+    response = app_client.get(
+        "/fixtures/facetable.json?_facet=state&planet_int=1&_nocache=1"
+    )
+    assert 200 == response.status
+    assert 14 == response.json["filtered_table_rows_count"]
+    assert "state" in response.json["facet_results"]
+    assert response.json["suggested_facets"]
+    # The page, its count, its facet and its suggested facets were all
+    # waiting on the database at the same time
+    assert {"primary", "count", "facet", "suggest"} in snapshots
+
+
+@pytest.mark.parametrize("error", [
+    InterruptedError("interrupted"),
+    QueueFullError("Too many queued queries for facet"),
+])
+def test_table_query_errors_handled_per_query(app_client, monkeypatch, error):
+    ds = app_client.ds
+    execute = ds.execute
+
+    async def failing_facet(*args, **kwargs):
+        if kwargs.get("workload") == "facet":
+            raise error
+        return await execute(*args, **kwargs)
+
+    monkeypatch.setattr(ds, "execute", failing_facet)
+    response = app_client.get(
+        "/fixtures/facetable.json?_facet=state&planet_int=1&_nocache=1"
+    )
+    # Only the facet is lost - the rest of the page is unaffected
+    assert 200 == response.status
+    assert {} == response.json["facet_results"]
+    assert 14 == len(response.json["rows"])
+    assert 14 == response.json["filtered_table_rows_count"]
+    assert response.json["suggested_facets"]
+
+
+@pytest.mark.parametrize("path", [
+    "/fixtures.json?sql=select+1",
+    "/fixtures/facetable.json?_facet=state",
+])
+def test_queue_full_returns_503(app_client, monkeypatch, path):
+    lane = app_client.ds.executor_lanes.lane("fixtures")
+
+    def run(fn):
+        raise QueueFullError("Too many queued queries for primary")
+
+    monkeypatch.setattr(lane, "run", run)
+    response = app_client.get(path)
+    assert 503 == response.status
+    assert "1" == response.headers["Retry-After"]
+    assert "Too many queued queries for primary" == response.json["error"]
+
+
+SLOW_SQL = """
+    with recursive counter(x) as (
+        select 1 union all select x + 1 from counter where x < 1000000000
+    ) select count(*) from counter
+"""
+
+
+def test_cancelled_query_is_interrupted():
+    for client in app_client(sql_time_limit_ms=20000):
+        ds = client.ds
+        lane = ds.executor_lanes.lane("fixtures")
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            task = asyncio.ensure_future(ds.execute("fixtures", SLOW_SQL))
+            await asyncio.sleep(0.1)
+            assert 1 == lane.running
+            start = time.time()
+            task.cancel()
+            while lane.running:
+                await asyncio.sleep(0.01)
+            return time.time() - start
+
+        try:
+            elapsed = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        # The thread was handed back long before the 20s time limit
+        assert elapsed < 2
+        assert 0 == ds.connection_pool("fixtures").in_use
+
+
+def test_cancel_on_disconnect():
+    class Transport:
+        closing = False
+
+        def is_closing(self):
+            return self.closing
+
+    transport = Transport()
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        assert "done" == await cancel_on_disconnect(transport, asyncio.sleep(0, "done"))
+        slow = asyncio.ensure_future(
+            cancel_on_disconnect(transport, asyncio.sleep(10))
+        )
+        await asyncio.sleep(0.05)
+        transport.closing = True
+        return await asyncio.wait_for(slow, 1)
+
+    try:
+        assert loop.run_until_complete(run()) is None
+    finally:
+        loop.close()
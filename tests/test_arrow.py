@@ -0,0 +1,158 @@
+from .fixtures import ( # noqa
+    app_client,
+)
+from datasette import arrow
+import io
+import pytest
+import urllib
+
+requires_pyarrow = pytest.mark.skipif(
+    arrow.pyarrow is None, reason="pyarrow is not installed"
+)
+
+
+def read_arrow(response):
+    return arrow.pyarrow.ipc.open_stream(io.BytesIO(response.body)).read_all()
+
+
+def column_types(table):
+    return {field.name: field.type for field in table.schema}
+
+
+@pytest.mark.parametrize('declared_type,expected', [
+    ('INTEGER', 'int'),
+    ('BIGINT', 'int'),
+    ('VARCHAR(255)', 'str'),
+    ('text', 'str'),
+    ('BLOB', None),
+    ('', None),
+    (None, None),
+    ('DOUBLE PRECISION', 'float'),
+    ('NUMERIC', None),
+    ('DATETIME', None),
+])
+def test_declared_kind(declared_type, expected):
+    assert expected == arrow.declared_kind(declared_type)
+
+
+@pytest.mark.parametrize('declared_type,values,expected', [
+    ('INTEGER', [], 'int'),
+    ('', [None, None], 'str'),
+    ('', [1, 2, None], 'int'),
+    ('REAL', [1, 2], 'float'),
+    ('', [1, 2.5], 'float'),
+    ('INTEGER', [1, 'one'], 'str'),
+    ('', [b'\x00', 'one'], 'bytes'),
+    ('TEXT', ['one'], 'str'),
+])
+def test_infer_kind(declared_type, values, expected):
+    assert expected == arrow.infer_kind(declared_type, values)
+
+
+def test_arrow_without_pyarrow(app_client, monkeypatch):
+    monkeypatch.setattr(arrow, 'pyarrow', None)
+    response = app_client.get('/fixtures/simple_primary_key.arrow')
+    assert response.status == 501
+    assert 'pip install datasette[arrow]' in response.text
+
+
+@requires_pyarrow
+def test_table_arrow(app_client):
+    response = app_client.get('/fixtures/compound_three_primary_keys.arrow')
+    assert response.status == 200
+    assert 'application/vnd.apache.arrow.stream' == (
+        response.headers['Content-Type']
+    )
+    table = read_arrow(response)
+    # Every row, not just the first max_returned_rows
+    assert 1001 == table.num_rows
+    assert ['pk1', 'pk2', 'pk3', 'content'] == table.schema.names
+    assert {
+        'pk1': 'a', 'pk2': 'a', 'pk3': 'a', 'content': 'a-a-a',
+    } == {name: values[0] for name, values in table.to_pydict().items()}
+
+
+@requires_pyarrow
+def test_table_arrow_types(app_client):
+    response = app_client.get('/fixtures/facetable.arrow?_labels=on')
+    assert response.status == 200
+    table = read_arrow(response)
+    types = column_types(table)
+    assert arrow.pyarrow.int64() == types['pk']
+    assert arrow.pyarrow.int64() == types['city_id']
+    assert arrow.pyarrow.string() == types['city_id_label']
+    assert arrow.pyarrow.string() == types['state']
+    columns = table.to_pydict()
+    assert 1 == columns['city_id'][0]
+    assert 'San Francisco' == columns['city_id_label'][0]
+
+
+@requires_pyarrow
+def test_custom_sql_arrow(app_client):
+    response = app_client.get(
+        '/fixtures.arrow?sql=select+1+as+n,+0.5+as+f,+null+as+empty'
+        '&_dl=1'
+    )
+    assert response.status == 200
+    assert (
+        'attachment; filename="fixtures.arrow"' ==
+        response.headers['Content-Disposition']
+    )
+    table = read_arrow(response)
+    assert {'n': [1], 'f': [0.5], 'empty': [None]} == table.to_pydict()
+    assert arrow.pyarrow.float64() == column_types(table)['f']
+
+
+@requires_pyarrow
+def test_custom_sql_arrow_no_rows(app_client):
+    response = app_client.get(
+        '/fixtures.arrow?sql=select+*+from+simple_primary_key+where+0'
+    )
+    assert response.status == 200
+    table = read_arrow(response)
+    assert 0 == table.num_rows
+    assert ['id', 'content'] == table.schema.names
+
+
+@requires_pyarrow
+def test_arrow_export_aborted_on_value_that_does_not_fit(app_client):
+    # 1,000 integers fix the column's type before the 1.5 is read
+    sql = (
+        'with recursive c(n) as (select 1 union all select n + 1 from c '
+        'where n < 1001) select case when n = 1001 then 1.5 else n end as v '
+        'from c'
+    )
+    with pytest.raises(ValueError) as e:
+        app_client.get(
+            '/fixtures.arrow?' + urllib.parse.urlencode({'sql': sql})
+        )
+    assert 'Response payload is not completed' in str(e.value)
+
+
+@requires_pyarrow
+def test_writer_converts_later_values():
+    writer = arrow.ArrowStreamWriter(['i', 'f', 's'])
+    body = writer.write([[1, 0.5, 'one']])
+    body += writer.write([[2.0, 2, 3]])
+    body += writer.close()
+    table = arrow.pyarrow.ipc.open_stream(io.BytesIO(body)).read_all()
+    assert {
+        'i': [1, 2], 'f': [0.5, 2.0], 's': ['one', '3'],
+    } == table.to_pydict()
+
+
+@requires_pyarrow
+@pytest.mark.parametrize('column,value', [
+    ('i', 1.5),
+    ('i', 'one'),
+    ('f', 'one'),
+    ('f', 2 ** 53 + 1),
+])
+def test_writer_rejects_values_that_do_not_fit(column, value):
+    writer = arrow.ArrowStreamWriter(['i', 'f'])
+    writer.write([[1, 0.5]])
+    row = {'i': 2, 'f': 1.5}
+    row[column] = value
+    with pytest.raises(arrow.ArrowTypeError) as e:
+        writer.write([[row['i'], row['f']]])
+    assert 'Column {} was exported as'.format(column) in str(e.value)
@@ -0,0 +1,54 @@
+from datasette.cache import QueryCache, params_key, results_size
+from datasette.utils import Results
+import pytest
+
+
+def make_results(n):
+    return Results([("x" * 100,)] * n, False, (("value",),))
+
+
+def test_query_cache_hit_and_miss():
+    cache = QueryCache(1024 * 1024)
+    assert cache.get("a") is None
+    results = make_results(1)
+    cache.set("a", results)
+    assert results is cache.get("a")
+    assert {"hits": 1, "misses": 1, "entries": 1} == {
+        key: cache.stats()[key] for key in ("hits", "misses", "entries")
+    }
+
+
+def test_query_cache_evicts_least_recently_used():
+    size = results_size(make_results(1))
+    cache = QueryCache(size * 2)
+    cache.set("a", make_results(1))
+    cache.set("b", make_results(1))
+    # Touch "a" so that "b" becomes the least recently used
+    cache.get("a")
+    cache.set("c", make_results(1))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert 1 == cache.evictions
+    assert cache.bytes <= cache.max_bytes
+
+
+def test_query_cache_skips_results_larger_than_cache():
+    cache = QueryCache(100)
+    cache.set("a", make_results(10))
+    assert cache.get("a") is None
+    assert 0 == cache.bytes
+
+
+def test_query_cache_disabled():
+    assert not QueryCache(0).enabled
+
+
+@pytest.mark.parametrize('params,expected', [
+    (None, ()),
+    ({}, ()),
+    ({"b": 1, "a": "2"}, (("a", "2"), ("b", 1))),
+    ([1, "2"], (1, "2")),
+])
+def test_params_key(params, expected):
+    assert expected == params_key(params)
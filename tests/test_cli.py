@@ -0,0 +1,25 @@
+from datasette.cli import Config
+import click
+import pytest
+
+
+@pytest.mark.parametrize('config,expected', [
+    ('default_page_size:50', ('default_page_size', 50)),
+    ('allow_facet:off', ('allow_facet', False)),
+    ('hash_strategy:tree', ('hash_strategy', 'tree')),
+    ('inspect_counts:deferred', ('inspect_counts', 'deferred')),
+])
+def test_config(config, expected):
+    assert expected == Config().convert(config, None, None)
+
+
+@pytest.mark.parametrize('config', [
+    'default_page_size:fifty',
+    'allow_facet:maybe',
+    'hash_strategy:md5',
+    'inspect_counts:approx',
+    'not_an_option:1',
+])
+def test_config_invalid(config):
+    with pytest.raises(click.BadParameter):
+        Config().convert(config, None, None)
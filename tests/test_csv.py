@@ -96,3 +96,55 @@ def test_table_csv_stream(app_client):
         "/fixtures/compound_three_primary_keys.csv?_stream=1"
     )
     assert 1002 == len([b for b in response.body.split(b"\r\n") if b])
+
+
+def test_table_csv_stream_with_labels(app_client):
+    response = app_client.get('/fixtures/facetable.csv?_labels=1&_stream=1')
+    assert response.status == 200
+    assert EXPECTED_TABLE_WITH_LABELS_CSV == response.text
+
+
+def test_custom_sql_csv_stream(app_client):
+    # Every row, not just the first max_returned_rows
+    response = app_client.get(
+        '/fixtures.csv?sql=select+pk1,+pk2,+pk3+from+compound_three_primary_keys'
+        '&_stream=1'
+    )
+    assert response.status == 200
+    assert 1002 == len([b for b in response.body.split(b'\r\n') if b])
+
+
+def test_custom_sql_csv_stream_invalid_sql(app_client):
+    response = app_client.get(
+        '/fixtures.csv?sql=select+*+from+no_such_table&_stream=1'
+    )
+    assert response.status == 400
+
+
+def test_table_csv_stream_uses_one_query(app_client, monkeypatch):
+    ds = app_client.ds
+    executed = []
+    streamed = []
+    execute = ds.execute
+    execute_stream = ds.execute_stream
+
+    def recording_execute(db_name, sql, *args, **kwargs):
+        executed.append(sql)
+        return execute(db_name, sql, *args, **kwargs)
+
+    def recording_execute_stream(db_name, sql, *args, **kwargs):
+        streamed.append(sql)
+        return execute_stream(db_name, sql, *args, **kwargs)
+
+    monkeypatch.setattr(ds, 'execute', recording_execute)
+    monkeypatch.setattr(ds, 'execute_stream', recording_execute_stream)
+    response = app_client.get(
+        '/fixtures/compound_three_primary_keys.csv?_stream=1&content__not=x'
+        '&_sort_desc=content'
+    )
+    lines = [b for b in response.body.split(b'\r\n') if b]
+    assert 1002 == len(lines)
+    assert 1 == len(streamed)
+    assert 'limit' not in streamed[0]
+    # No page, count or facet queries
+    assert not any('compound_three_primary_keys' in sql for sql in executed)
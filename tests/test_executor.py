@@ -0,0 +1,199 @@
+from datasette.executor import (
+    ExecutorLane,
+    ExecutorLanes,
+    QueueFullError,
+    RowStream,
+)
+from datasette.utils import InterruptedError
+import asyncio
+import pytest
+import threading
+
+
+def make_lanes(per_database=False):
+    return ExecutorLanes({
+        "primary": 3,
+        "facet": 2,
+        "suggest": 0,
+        "count": 0,
+        "export": 1,
+    }, per_database=per_database)
+
+
+@pytest.mark.parametrize('per_database,db_name,workload,expected', [
+    (False, "db", "primary", "primary"),
+    (False, "db", "facet", "facet"),
+    (False, "db", "suggest", "primary"),
+    (True, "db", "facet", "db:facet"),
+    (True, "db", "count", "db:primary"),
+    (True, None, "export", "export"),
+])
+def test_lane_name(per_database, db_name, workload, expected):
+    assert expected == make_lanes(per_database).lane_name(db_name, workload)
+
+
+def test_unknown_workload():
+    with pytest.raises(ValueError):
+        make_lanes().lane("db", "nope")
+
+
+def test_lanes_are_reused():
+    lanes = make_lanes()
+    assert lanes.lane("one", "facet") is lanes.lane("two", "facet")
+    assert lanes.lane("one", "facet") is not lanes.lane("one", "primary")
+    assert 2 == lanes.lane("one", "facet").max_workers
+
+
+def test_max_workers():
+    assert 6 == make_lanes().max_workers()
+
+
+def test_lane_run_counts_work():
+    lanes = make_lanes()
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        return await lanes.lane("db", "facet").run(lambda: 42)
+
+    try:
+        result = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert 42 == result
+    assert ["facet"] == list(lanes.stats().keys())
+    stats = lanes.stats()["facet"]
+    assert {"max_workers": 2, "queued": 0, "running": 0, "completed": 1} == {
+        key: stats[key] for key in ("max_workers", "queued", "running", "completed")
+    }
+
+
+def run_in_new_loop(coroutine_fn):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine_fn())
+    finally:
+        loop.close()
+
+
+def test_lane_rejects_when_queue_is_full():
+    lane = ExecutorLane("test", 1, max_queued=1)
+    release = threading.Event()
+
+    async def run():
+        running = lane.run(release.wait)
+        queued = lane.run(lambda: "queued")
+        with pytest.raises(QueueFullError):
+            lane.run(lambda: "rejected")
+        release.set()
+        return await running, await queued
+
+    assert (True, "queued") == run_in_new_loop(run)
+    assert 1 == lane.stats()["rejected"]
+
+
+def test_lane_rejects_after_max_queue_wait():
+    lane = ExecutorLane("test", 1, max_queue_wait_ms=20)
+    release = threading.Event()
+    ran = []
+
+    async def run():
+        running = lane.run(lambda: release.wait(1))
+        with pytest.raises(QueueFullError):
+            await lane.run(lambda: ran.append(1))
+        release.set()
+        await running
+
+    run_in_new_loop(run)
+    lane.executor.shutdown()
+    # The abandoned job never ran and its thread was handed straight back
+    assert [] == ran
+    stats = lane.stats()
+    assert {"queued": 0, "running": 0, "rejected": 1, "completed": 1} == {
+        key: stats[key] for key in ("queued", "running", "rejected", "completed")
+    }
+
+
+def produce(stream, batches, produced):
+    stream.start([("n",)])
+    for i in range(batches):
+        if not stream.put([(i,)]):
+            return "closed"
+        produced.append(i)
+    stream.finish()
+    return "finished"
+
+
+def test_row_stream_applies_backpressure():
+    lane = ExecutorLane("test", 1)
+    produced = []
+
+    async def run():
+        stream = RowStream(asyncio.get_event_loop(), max_batches=2)
+        future = lane.run(lambda: produce(stream, 10, produced))
+        assert [("n",)] == await stream.started(future)
+        await asyncio.sleep(0.05)
+        # Two batches queued, with the worker waiting to add a third
+        assert 2 == len(produced)
+        batches = []
+        while True:
+            batch = await stream.fetch()
+            if batch is None:
+                break
+            batches.extend(batch)
+        return batches, await future
+
+    batches, result = run_in_new_loop(run)
+    assert [(i,) for i in range(10)] == batches
+    assert "finished" == result
+
+
+def test_row_stream_close_stops_worker():
+    lane = ExecutorLane("test", 1)
+    produced = []
+
+    async def run():
+        stream = RowStream(asyncio.get_event_loop(), max_batches=1)
+        future = lane.run(lambda: produce(stream, 10, produced))
+        await stream.started(future)
+        assert [(0,)] == await stream.fetch()
+        stream.close()
+        assert None is await stream.fetch()
+        return await future
+
+    assert "closed" == run_in_new_loop(run)
+    assert len(produced) < 10
+
+
+def test_row_stream_raises_errors_before_start():
+    lane = ExecutorLane("test", 1)
+
+    def fail(stream):
+        stream.fail(ValueError("bad"))
+
+    async def run():
+        stream = RowStream(asyncio.get_event_loop())
+        future = lane.run(lambda: fail(stream))
+        with pytest.raises(ValueError):
+            await stream.started(future)
+
+    run_in_new_loop(run)
+
+
+
+def test_row_stream_gives_up_when_nothing_reads():
+    lane = ExecutorLane("test", 1)
+    produced = []
+
+    async def run():
+        stream = RowStream(
+            asyncio.get_event_loop(), max_batches=1, max_wait=0.2
+        )
+        future = lane.run(lambda: produce(stream, 10, produced))
+        await stream.started(future)
+        # Nothing fetches, so the worker stops waiting instead of blocking
+        assert "closed" == await future
+        with pytest.raises(InterruptedError):
+            await stream.fetch()
+
+    run_in_new_loop(run)
+    assert [0] == produced
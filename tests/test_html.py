@@ -1,8 +1,10 @@
 from bs4 import BeautifulSoup as Soup
 from .fixtures import ( # noqa
     app_client,
+    app_client_approximate_counts,
     app_client_shorter_time_limit,
 )
+from datasette.utils import InterruptedError
 import pytest
 import re
 import urllib.parse
@@ -21,6 +23,18 @@ def test_database_page(app_client):
     assert 'fixtures' in response.text
 
 
+def test_approximate_counts(app_client_approximate_counts, app_client):
+    response = app_client_approximate_counts.get('/')
+    assert re.search(r'~[\d,]+ rows in \d+ tables', response.text)
+    response = app_client_approximate_counts.get('/fixtures')
+    soup = Soup(response.body, 'html.parser')
+    assert any(
+        p.text.startswith('~') for p in soup.select('.db-table p')
+    )
+    response = app_client.get('/')
+    assert not re.search(r'~[\d,]+ rows', response.text)
+
+
 def test_invalid_custom_sql(app_client):
     response = app_client.get(
         '/fixtures?sql=.schema'
@@ -309,6 +323,30 @@ def test_facets_persist_through_filter_form(app_client):
     ]
 
 
+def test_facet_timed_out(app_client, monkeypatch):
+    ds = app_client.ds
+    execute = ds.execute
+
+    async def interrupted_facet(*args, **kwargs):
+        if kwargs.get('workload') == 'facet':
+            raise InterruptedError('interrupted')
+        return await execute(*args, **kwargs)
+
+    monkeypatch.setattr(ds, 'execute', interrupted_facet)
+    response = app_client.get(
+        '/fixtures/facetable?_facet=state&_nocache=1'
+    )
+    assert response.status == 200
+    timed_out = Soup(response.body, 'html.parser').find(
+        'p', {'class': 'facets-timed-out'}
+    )
+    assert 'These facets timed out: state' == timed_out.text
+    # The rest of the page is still shown
+    assert 15 == len(
+        Soup(response.body, 'html.parser').find('tbody').findAll('tr')
+    )
+
+
 @pytest.mark.parametrize('path,expected_classes', [
     ('/', ['index']),
     ('/fixtures', ['db', 'db-fixtures']),
@@ -1,8 +1,24 @@
 from datasette.app import Datasette
+from datasette import inspect
+from datasette.inspect import (
+    InspectFile,
+    LazyTables,
+    inspect_cache_path,
+    inspect_estimated_count,
+    inspect_hash,
+    inspect_tables,
+    load_inspect_file,
+    write_inspect_file,
+)
+from pathlib import Path
+import collections
+import hashlib
+import json
 import os
 import pytest
 import sqlite3
 import tempfile
+from unittest.mock import patch
 
 
 TABLES = '''
@@ -69,6 +85,38 @@ def test_inspect_hidden_tables(ds_instance):
     )
 
 
+def test_inspect_tables_uses_constant_number_of_queries(tmpdir):
+    def count_queries(num_tables):
+        filepath = str(tmpdir / 'tables_{}.db'.format(num_tables))
+        conn = sqlite3.connect(filepath)
+        conn.executescript(TABLES)
+        for i in range(num_tables):
+            conn.execute(
+                'create table t{} (id integer primary key, county integer '
+                'references county(id))'.format(i)
+            )
+        queries = []
+        # Statements run inside a table-valued pragma function are traced
+        # as comments, so they are not counted
+        conn.set_trace_callback(
+            lambda sql: None if sql.startswith('--') else queries.append(sql)
+        )
+        conn.row_factory = sqlite3.Row
+        inspect_tables(conn, {}, counts=collections.defaultdict(int))
+        return len(queries)
+
+    assert count_queries(1) == count_queries(20)
+
+
+def test_inspect_tables_without_table_valued_pragmas(ds_instance):
+    conn = sqlite3.connect(ds_instance.files[0])
+    conn.row_factory = sqlite3.Row
+    expected = inspect_tables(conn, {})
+    error = sqlite3.OperationalError('no such table: pragma_table_info')
+    with patch('datasette.inspect.get_all_columns', side_effect=error):
+        assert expected == inspect_tables(conn, {})
+
+
 def test_inspect_foreign_keys(ds_instance):
     info = ds_instance.inspect()
     tables = info['fixtures']['tables']
@@ -101,3 +149,252 @@ def test_inspect_foreign_keys(ds_instance):
         key=lambda d: d['column']
     )
     assert [] == election_results['foreign_keys']['incoming']
+
+
+def test_inspect_processes(ds_instance):
+    filepath = ds_instance.files[0]
+    ds = Datasette([filepath], config={
+        'inspect_processes': 2,
+        'inspect_cache': False,
+    })
+    assert ds_instance.inspect() == ds.inspect()
+
+
+def test_inspect_cache(tmpdir):
+    filepath = str(tmpdir / 'fixtures.db')
+    conn = sqlite3.connect(filepath)
+    conn.executescript(TABLES)
+    conn.close()
+    info = Datasette([filepath]).inspect()
+    assert inspect_cache_path(Path(filepath)).exists()
+    with patch('datasette.app.inspect_hash', return_value='x') as inspect_hash:
+        # Unchanged files are not inspected again
+        assert info == Datasette([filepath]).inspect()
+        assert not inspect_hash.called
+        # Unless the cache has been turned off
+        Datasette([filepath], config={'inspect_cache': False}).inspect()
+        assert inspect_hash.called
+        inspect_hash.reset_mock()
+        # Changes to metadata invalidate the cache
+        Datasette([filepath], metadata={'databases': {'fixtures': {
+            'tables': {'office': {'hidden': True}}
+        }}}).inspect()
+        assert inspect_hash.called
+    # As do changes to the file itself
+    conn = sqlite3.connect(filepath)
+    conn.execute('insert into county (name) values ("Alameda")')
+    conn.commit()
+    conn.close()
+    info = Datasette([filepath]).inspect()
+    assert 1 == info['fixtures']['tables']['county']['count']
+
+
+@pytest.mark.parametrize('strategy', ('sha256', 'blake2b', 'tree', 'header'))
+def test_inspect_hash_strategies(tmpdir, strategy):
+    filepath = Path(str(tmpdir / 'fixtures.db'))
+    conn = sqlite3.connect(str(filepath))
+    conn.executescript(TABLES)
+    conn.close()
+    copy = Path(str(tmpdir / 'copy.db'))
+    copy.write_bytes(filepath.read_bytes())
+    hash = inspect_hash(filepath, strategy)
+    assert hash == inspect_hash(copy, strategy)
+    conn = sqlite3.connect(str(filepath))
+    conn.execute('insert into county (name) values ("Alameda")')
+    conn.commit()
+    conn.close()
+    assert hash != inspect_hash(filepath, strategy)
+
+
+def test_inspect_tree_hash_chunks(tmpdir):
+    filepath = Path(str(tmpdir / 'data'))
+    filepath.write_bytes(os.urandom(1000))
+    with patch.object(inspect, 'TREE_CHUNK_SIZE', 100):
+        hash = inspect_hash(filepath, 'tree')
+        # Identical chunks at different offsets still change the hash
+        filepath.write_bytes(filepath.read_bytes()[100:] + filepath.read_bytes()[:100])
+        assert hash != inspect_hash(filepath, 'tree')
+    assert hash != inspect_hash(filepath, 'tree')
+
+
+def test_inspect_hash_empty_file(tmpdir):
+    filepath = Path(str(tmpdir / 'empty.db'))
+    filepath.write_bytes(b'')
+    assert hashlib.blake2b().hexdigest() == inspect_hash(filepath, 'blake2b')
+    assert 128 == len(inspect_hash(filepath, 'tree'))
+
+
+def test_inspect_approximate_counts(tmpdir):
+    filepath = str(tmpdir / 'fixtures.db')
+    conn = sqlite3.connect(filepath)
+    conn.executescript(TABLES)
+    conn.executemany(
+        'insert into county (id, name) values (?, ?)',
+        [(1, 'Alameda'), (5, 'Marin')]
+    )
+    conn.executemany(
+        'insert into party (name) values (?)', [('a',), ('b',), ('c',)]
+    )
+    conn.execute('analyze party')
+    conn.commit()
+    conn.close()
+    ds = Datasette([filepath], config={
+        'inspect_counts': 'approximate',
+        'inspect_cache': False,
+    })
+    tables = ds.inspect()['fixtures']['tables']
+    # From max(rowid)
+    assert 5 == tables['county']['count']
+    assert tables['county']['count_approximate']
+    # From sqlite_stat1
+    assert 3 == tables['party']['count']
+    assert tables['party']['count_approximate']
+    # Exact counts are only used in the default mode
+    exact_tables = Datasette([filepath], config={
+        'inspect_cache': False,
+    }).inspect()['fixtures']['tables']
+    assert 2 == exact_tables['county']['count']
+    assert 'count_approximate' not in exact_tables['county']
+    # refine_counts() replaces the estimates with exact counts
+    ds.refine_counts().join()
+    assert 2 == tables['county']['count']
+    assert 'count_approximate' not in tables['county']
+    assert ds.refine_counts() is None
+    # Using a pooled connection, not a new one
+    pool = ds.connection_pool('fixtures')
+    assert 1 == pool.checkouts
+    assert 1 == pool.open
+
+
+def test_lazy_inspect(ds_instance):
+    ds = Datasette(ds_instance.files, config={
+        'lazy_inspect': True,
+        'inspect_cache': False,
+    })
+    tables = ds.inspect()['fixtures']['tables']
+    assert isinstance(tables, LazyTables)
+    assert 0 == tables.inspected
+    assert 'county' in tables
+    assert 'not_a_table' not in tables
+    assert 0 == tables.inspected
+    expected = ds_instance.inspect()['fixtures']['tables']
+    assert expected['county'] == tables['county']
+    assert 1 == tables.inspected
+    assert tables['county'] is tables['county']
+    assert expected == ds.materialized_inspect()['fixtures']['tables']
+    assert len(expected) == tables.inspected
+
+
+def test_binary_inspect_file(ds_instance, tmpdir):
+    data = ds_instance.materialized_inspect()
+    binary_path = str(tmpdir / 'inspect-data.bin')
+    with open(binary_path, 'wb') as fp:
+        write_inspect_file(fp, data)
+    json_path = str(tmpdir / 'inspect-data.json')
+    with open(json_path, 'w') as fp:
+        json.dump(data, fp)
+    assert os.path.getsize(binary_path) < os.path.getsize(json_path)
+    loaded = load_inspect_file(binary_path)
+    assert isinstance(loaded, InspectFile)
+    assert ['fixtures'] == list(loaded)
+    ds = Datasette(ds_instance.files, inspect_data=loaded)
+    ds.warm_connections()
+    # Connecting only needs the database file, not its inspect data
+    assert {} == loaded._databases
+    assert data == loaded
+    assert data == load_inspect_file(json_path)
+    assert data['fixtures']['tables'] == ds.inspect()['fixtures']['tables']
+
+
+def test_warm_connections_does_not_inspect(ds_instance):
+    ds = Datasette(ds_instance.files)
+    ds.warm_connections()
+    assert not ds._inspect
+
+
+@pytest.mark.parametrize('value', [
+    None,
+    True,
+    False,
+    0,
+    -1,
+    127,
+    128,
+    -2 ** 70,
+    2 ** 70,
+    1.5,
+    float('-inf'),
+    '',
+    'caf\u00e9 \U0001f600',
+    b'\x00\xff',
+    [],
+    [1, [2, 'three'], {'four': None}],
+    {'a': {'b': [1.0, False]}, 1: 'one'},
+])
+def test_inspect_value_round_trip(value):
+    assert value == inspect.InspectDecoder(
+        inspect.encode_inspect_data(value)
+    ).decode()
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'x',
+    b's\x05abc',
+    b'l\x02N',
+    b'NN',
+    b'i\xff',
+])
+def test_inspect_decoder_rejects_corrupt_data(data):
+    with pytest.raises(ValueError):
+        inspect.InspectDecoder(data).decode()
+
+
+def test_binary_inspect_file_version_mismatch(ds_instance, tmpdir):
+    binary_path = str(tmpdir / 'inspect-data.bin')
+    with open(binary_path, 'wb') as fp:
+        write_inspect_file(fp, ds_instance.materialized_inspect())
+    with patch.object(inspect, 'INSPECT_FILE_VERSION', 3):
+        with pytest.raises(ValueError):
+            load_inspect_file(binary_path)
+
+
+@pytest.mark.parametrize('from_sql,params,expected', [
+    # Two rows per state according to sqlite_stat1
+    ('from places where state = ?', ['CA'], 2),
+    ('from places where state = ? and city = ?', ['CA', 'Oakland'], 1),
+    ('from places where rowid = ?', [1], 1),
+    # Not using an index with equality constraints
+    ('from places where state > ?', ['CA'], None),
+    ('from places where city like ?', ['%a%'], None),
+    # Has a subquery
+    (
+        'from places where state = ? and rowid in (select rowid from places)',
+        ['CA'],
+        None,
+    ),
+])
+def test_inspect_estimated_count(from_sql, params, expected):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE places (state TEXT, city TEXT);
+    CREATE INDEX places_state_city ON places (state, city);
+    ''')
+    conn.executemany('INSERT INTO places VALUES (?, ?)', [
+        (state, '{} {}'.format(state, i))
+        for i in range(2)
+        for state in ('CA', 'MI', 'NY', 'TX', 'WA', 'OR', 'NV', 'AZ')
+    ])
+    conn.execute('ANALYZE')
+    assert expected == inspect_estimated_count(conn, 'places', from_sql, params)
+
+
+def test_inspect_estimated_count_without_analyze():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE places (state TEXT, city TEXT);
+    CREATE INDEX places_state ON places (state);
+    ''')
+    assert None is inspect_estimated_count(
+        conn, 'places', 'from places where state = ?', ['CA']
+    )
@@ -0,0 +1,145 @@
+from datasette.pool import ConnectionPool
+import pytest
+import sqlite3
+import threading
+
+
+def make_pool(size=2):
+    return ConnectionPool(
+        lambda: sqlite3.connect(":memory:", check_same_thread=False), size
+    )
+
+
+def test_warm_opens_every_connection():
+    pool = make_pool(3)
+    pool.warm()
+    assert {"open": 3, "idle": 3, "in_use": 0} == {
+        key: pool.stats()[key] for key in ("open", "idle", "in_use")
+    }
+
+
+def test_connections_are_reused():
+    pool = make_pool()
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        pass
+    assert conn1 is conn2
+    assert 1 == pool.open
+    assert 2 == pool.checkouts
+
+
+def test_pool_is_bounded():
+    pool = make_pool(1)
+    conn = pool.acquire()
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    thread.start()
+    thread.join(0.1)
+    # Second thread is waiting for the only connection
+    assert [] == acquired
+    pool.release(conn)
+    thread.join()
+    assert [conn] == acquired
+    assert 1 == pool.open
+    assert 1 == pool.waits
+
+
+def test_operational_errors_keep_connection():
+    pool = make_pool()
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.connection() as conn:
+            conn.execute("select * from no_such_table")
+    assert 0 == pool.discarded
+    assert 1 == pool.stats()["idle"]
+
+
+@pytest.mark.parametrize("sql,params,error", [
+    ("select ?", [1, 2], sqlite3.ProgrammingError),
+    (
+        "create temp table t (id integer primary key); "
+        "insert into t values (1); insert into t values (1)",
+        None,
+        sqlite3.IntegrityError,
+    ),
+])
+def test_query_errors_keep_connection(sql, params, error):
+    pool = make_pool()
+    with pytest.raises(error):
+        with pool.connection() as conn:
+            if params is None:
+                conn.executescript(sql)
+            else:
+                conn.execute(sql, params)
+    assert 0 == pool.discarded
+    assert 1 == pool.stats()["idle"]
+
+
+def test_broken_connections_are_discarded():
+    pool = make_pool()
+    with pytest.raises(sqlite3.DatabaseError):
+        with pool.connection() as conn:
+            raise sqlite3.DatabaseError("database disk image is malformed")
+    assert {"open": 0, "discarded": 1} == {
+        key: pool.stats()[key] for key in ("open", "discarded")
+    }
+    assert "malformed" in pool.last_error
+    with pool.connection() as conn2:
+        assert conn2 is not conn
+
+
+def test_waiter_gets_replacement_for_discarded_connection():
+    pool = make_pool(1)
+    conn = pool.acquire()
+    acquired = []
+    thread = threading.Thread(
+        target=lambda: acquired.append(pool.acquire()), daemon=True
+    )
+    thread.start()
+    thread.join(0.1)
+    assert [] == acquired
+    pool.release(conn, discard=True)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert 1 == len(acquired)
+    assert acquired[0] is not conn
+    assert {"open": 1, "in_use": 1, "waits": 1, "discarded": 1} == {
+        key: pool.stats()[key]
+        for key in ("open", "in_use", "waits", "discarded")
+    }
+
+
+def test_waiter_opens_connection_after_failed_connect():
+    attempts = []
+    connecting = threading.Event()
+    fail = threading.Event()
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            connecting.set()
+            fail.wait()
+            raise sqlite3.OperationalError("unable to open database file")
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    pool = ConnectionPool(connect, 1)
+    failing = threading.Thread(
+        target=lambda: pytest.raises(sqlite3.OperationalError, pool.acquire),
+        daemon=True,
+    )
+    failing.start()
+    connecting.wait()
+    acquired = []
+    thread = threading.Thread(
+        target=lambda: acquired.append(pool.acquire()), daemon=True
+    )
+    thread.start()
+    thread.join(0.1)
+    # Waiting for the slot taken by the first connection attempt
+    assert [] == acquired
+    fail.set()
+    failing.join(1)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert 1 == len(acquired)
+    assert "unable to open" in pool.last_error
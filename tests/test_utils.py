@@ -234,6 +234,89 @@ def test_detect_fts():
     assert None is utils.detect_fts(conn, 'Test_View')
     assert None is utils.detect_fts(conn, 'r')
     assert 'Street_Tree_List_fts' == utils.detect_fts(conn, 'Street_Tree_List')
+    tables = ['Dumb_Table', 'Test_View', 'r', 'Street_Tree_List']
+    assert {
+        table: utils.detect_fts(conn, table) for table in tables
+    } == utils.detect_all_fts(conn, tables)
+
+
+def test_get_all_columns():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE one (id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE two (b TEXT, a TEXT, c TEXT, PRIMARY KEY (a, b));
+    CREATE VIEW three AS SELECT * FROM one;
+    ''')
+    assert {
+        'one': [('id', 1), ('name', 0)],
+        'two': [('b', 2), ('a', 1), ('c', 0)],
+    } == utils.get_all_columns(conn)
+
+
+def test_get_all_indexed_columns():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE one (id INTEGER PRIMARY KEY, a TEXT, b TEXT, c TEXT);
+    CREATE INDEX one_a_b ON one (a, b);
+    CREATE INDEX one_c_partial ON one (c) WHERE c IS NOT NULL;
+    CREATE TABLE two (x TEXT, y TEXT, PRIMARY KEY (y, x));
+    CREATE TABLE three (z TEXT);
+    ''')
+    assert {
+        'one': ['a'],
+        'two': ['y'],
+    } == utils.get_all_indexed_columns(conn)
+
+
+def test_count_facet_values():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (a, b)')
+    conn.executemany('INSERT INTO t VALUES (?, ?)', [
+        ('x', 2), ('y', 'two'), ('x', 1), (None, 2), ('z', 1.5),
+        ('y', 1), (1, None), ('x', b'blob'), ('z', 2),
+    ])
+    facet_counts = utils.count_facet_values(
+        conn, ['a', 'b'], 'from t', [], 3, batch_size=2
+    )
+    # Same results as a group by query for each column
+    for column in ('a', 'b'):
+        assert [tuple(row) for row in conn.execute('''
+            select {column}, count(*) from t where {column} is not null
+            group by {column} order by count(*) desc, {column} limit 3
+        '''.format(column=column))] == facet_counts[column]
+    assert [('x', 3), ('y', 2), ('z', 2)] == facet_counts['a']
+
+
+def test_count_distinct_values():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, a TEXT, b INTEGER)')
+    conn.executemany('INSERT INTO t (a, b) VALUES (?, ?)', [
+        ('x', 1), ('y', None), ('x', 3), (None, 4), ('x', 5),
+    ])
+    assert {'id': 3, 'a': 2, 'b': 3} == utils.count_distinct_values(
+        conn, ['id', 'a', 'b'], 'from t', [], 2, batch_size=2
+    )
+    assert {'id': 2, 'a': 1, 'b': 2} == utils.count_distinct_values(
+        conn, ['id', 'a', 'b'], 'from t where id > ?', [3], 2
+    )
+    # Only the first three rows are checked
+    assert {'id': 3, 'a': 2, 'b': 2} == utils.count_distinct_values(
+        conn, ['id', 'a', 'b'], 'from t', [], 5, sample_size=3
+    )
+
+
+def test_count_distinct_values_interrupted():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, a TEXT)')
+    conn.executemany('INSERT INTO t (a) VALUES (?)', [('x',)] * 10)
+    # Interrupted while reading the third batch of rows
+    rows_read = []
+    conn.create_function('read_row', 0, lambda: rows_read.append(1) or 1)
+    conn.set_progress_handler(lambda: len(rows_read) > 6, 1)
+    # id is known to have too many values by then, but a is not decided
+    assert {'id': 3} == utils.count_distinct_values(
+        conn, ['id', 'a'], 'from t where read_row()', [], 2, batch_size=2
+    )
 
 
 @pytest.mark.parametrize('url,expected', [
@@ -375,3 +458,56 @@ def test_path_with_format(path, format, extra_qs, expected):
     )
     actual = utils.path_with_format(request, format, extra_qs)
     assert expected == actual
+
+
+@pytest.mark.parametrize('data', [
+    {'columns': ['a', 'b'], 'rows': [], 'truncated': False},
+    {
+        'database': 'fixtures',
+        'rows': [
+            [1, 'one', 1.5, None],
+            [2, 'twö "quoted"\n', float('nan'), True],
+            [3, b'bytes', float('-inf'), {'value': 1, 'label': 'x'}],
+        ],
+        'query_ms': 1.2,
+    },
+    [[i, str(i)] for i in range(250)],
+    [{'a': 1}],
+    {'ok': False, 'error': 'Invalid _shape: foo'},
+    [1, 2, 3],
+])
+def test_json_chunks(data):
+    expected = json.dumps(data, cls=utils.CustomJSONEncoder)
+    assert expected == ''.join(utils.json_chunks(data))
+
+
+def test_json_chunks_rows_as_objects():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("select 1 as id, 'hello' as name").fetchall()
+    rows += [[2, None]]
+    chunks = list(utils.json_chunks(
+        {'columns': ['id', 'name'], 'rows': rows},
+        columns=['id', 'name'],
+        rows_as_objects=True,
+        chunk_rows=1,
+    ))
+    assert [
+        '{"columns": ["id", "name"]',
+        ', "rows": ',
+        '[{"id": 1, "name": "hello"}',
+        ', {"id": 2, "name": null}',
+        ']',
+        '}',
+    ] == chunks
+    assert {
+        'columns': ['id', 'name'],
+        'rows': [{'id': 1, 'name': 'hello'}, {'id': 2, 'name': None}],
+    } == json.loads(''.join(chunks))
+
+
+def test_json_chunks_rows_as_objects_repeated_columns():
+    chunks = utils.json_chunks(
+        [[1, 2, 3]], columns=['a', 'b', 'a'], rows_as_objects=True
+    )
+    assert '[{"a": 3, "b": 2}]' == ''.join(chunks)